@@ -1,8 +1,7 @@
-from sys import argv
+import argparse
 import torch
 import glob
 import re
-import numpy as np
 
 
 def get_checkpoints(path):
@@ -11,64 +10,107 @@ def get_checkpoints(path):
   return path_list
 
 def sort_checkpoints(path_list):
-  iter_list = []
-  saved_models = []
+  """ (step, path) of the `*_step_N.pt` checkpoints, by step """
+  steps = []
+  p = re.compile(r'_step_(\d+)\.pt$')
   for path in path_list:
     # path: model_step_100000.pt
-    p = re.compile(r'_step_(.*)\.pt$')
     matches = p.findall(path)
     if len(matches) > 0:
-      i = int(matches[0])
-      saved_models.append(path)
-      iter_list.append(i)
-  sorted_index = np.argsort(iter_list)
-  path_list = [saved_models[i] for i in sorted_index]
-  return path_list
+      steps.append((int(matches[0]), path))
+  return sorted(steps)
 
-if __name__=="__main__":
-  script, model_save_dir, ensemble_path , number = argv
-  if model_save_dir is None:
-    print("model_save_dir error")
-  print(model_save_dir)
+def validation_ppl(log_file):
+  """ Validation perplexity of each step of a training log """
+  p = re.compile(r'Step: *(\d+); Validation perplexity: (\S+)')
+  ppl = {}
+  with open(log_file) as f:
+    for line in f:
+      matches = p.findall(line)
+      # with -mlm_distill the MLM validation follows the NMT one
+      if matches and int(matches[0][0]) not in ppl:
+        ppl[int(matches[0][0])] = float(matches[0][1])
+  return ppl
+
+def select_checkpoints(checkpoints, number=None, min_step=None, max_step=None,
+                       log_file=None):
+  """
+  The checkpoints in the step range, then the `number` last ones, or the
+  `number` ones of best validation perplexity in `log_file`.
+  """
+  checkpoints = [(step, path) for step, path in checkpoints
+                 if (min_step is None or step >= min_step)
+                 and (max_step is None or step <= max_step)]
+  if log_file is not None:
+    ppl = validation_ppl(log_file)
+    checkpoints = [(step, path) for step, path in checkpoints if step in ppl]
+    checkpoints = sorted(checkpoints, key=lambda c: ppl[c[0]])[:number]
+    return sorted(checkpoints)
+  if number is not None:
+    checkpoints = checkpoints[-number:]
+  return checkpoints
+
+def accumulate(sums, state_dict):
+  """ Adds the floating point weights of `state_dict` to the fp32 `sums` """
+  for key, value in state_dict.items():
+    if not value.is_floating_point():
+      sums[key] = value
+    elif key not in sums:
+      # a copy: tied weights share their storage in the checkpoint
+      sums[key] = value.to(torch.float32, copy=True)
+    else:
+      sums[key].add_(value)
 
-  checkpoints_list = get_checkpoints(model_save_dir)
-  checkpoints_list = sort_checkpoints(checkpoints_list)
-  checkpoints_list = checkpoints_list[-int(number):]
-  print("Averaging checkpoints: \n{}".format(checkpoints_list))
-  
-  print("start average the last {} model".format(number)) 
-  model_list = []
-  generator_list = []
-  for checkpoint_path in checkpoints_list:
-    checkpoint = torch.load(checkpoint_path)
-    model_list.append(checkpoint['model'])
-    generator_list.append(checkpoint['generator'])
-    vocab = checkpoint['vocab']
-    opt = checkpoint['opt']
-    optim = checkpoint['optim']
-  
-  model_dict = {}
-  generator_dict = {}
-  for model, generator in zip(model_list, generator_list):
-    for key, value in model.items():
-      value_sum = model_dict.get(key, 0)
-      value_sum += value
-      model_dict[key] = value_sum
-    for key, value in generator.items():
-      value_sum = generator_dict.get(key, 0)
-      value_sum += value
-      generator_dict[key] = value_sum
-  
-  model_dict_avg = {}
-  generator_dict_avg = {}
-  for key, value in model_dict.items():
-    model_dict_avg[key] = value / float(number)
-  for key, value in generator_dict.items():
-    generator_dict_avg[key] = value / float(number)
-  
-  checkpoint_ensemble = {'vocab':vocab, 'opt': opt, 'model': model_dict_avg, 'generator':generator_dict_avg, 'optim':optim}
-  torch.save(checkpoint_ensemble, ensemble_path)
-  print("ensemble end and save model to {}".format(ensemble_path))
+def load_checkpoint(path):
+  """
+  `path` memory-mapped: only the tensors read are paged in, not the
+  optimizer state. torch < 2.1 cannot, and loads all of it.
+  """
+  try:
+    return torch.load(path, map_location='cpu', mmap=True)
+  except TypeError:
+    return torch.load(path, map_location='cpu')
 
+def main(args):
+  checkpoints = select_checkpoints(
+    sort_checkpoints(get_checkpoints(args.model_save_dir)), args.number,
+    args.min_step, args.max_step, args.best_from_log)
+  if not checkpoints:
+    raise ValueError("no checkpoint selected in %s" % args.model_save_dir)
+  print("Averaging checkpoints: \n{}".format([path for _, path in checkpoints]))
 
-  
\ No newline at end of file
+  # one checkpoint mapped at a time besides the sums, the optimizer state
+  # is never read
+  model_sums, generator_sums, dtypes = {}, {}, {}
+  for _, checkpoint_path in checkpoints:
+    checkpoint = load_checkpoint(checkpoint_path)
+    accumulate(model_sums, checkpoint['model'])
+    accumulate(generator_sums, checkpoint['generator'])
+    for name in ['model', 'generator']:
+      dtypes[name] = {k: v.dtype for k, v in checkpoint[name].items()}
+    vocab, opt = checkpoint['vocab'], checkpoint['opt']
+    del checkpoint
+
+  number = len(checkpoints)
+  def average(sums, dtypes):
+    return {k: v.div_(number).to(dtypes[k]) if v.is_floating_point() else v
+            for k, v in sums.items()}
+  checkpoint_ensemble = {'vocab': vocab, 'opt': opt,
+                         'model': average(model_sums, dtypes['model']),
+                         'generator': average(generator_sums, dtypes['generator'])}
+  torch.save(checkpoint_ensemble, args.ensemble_path)
+  print("ensemble of {} checkpoints end and save model to {}".format(number, args.ensemble_path))
+
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser(description="Average the weights of the checkpoints of a training run into a model for translation (without optimizer state)")
+  parser.add_argument("model_save_dir", help="directory of the *_step_N.pt checkpoints")
+  parser.add_argument("ensemble_path", help="averaged checkpoint")
+  parser.add_argument("number", type=int, nargs='?', default=None,
+                      help="number of checkpoints averaged, the last ones (default: all selected)")
+  parser.add_argument("--min_step", type=int, default=None, help="first step of the checkpoints averaged")
+  parser.add_argument("--max_step", type=int, default=None, help="last step of the checkpoints averaged")
+  parser.add_argument("--best_from_log", default=None,
+                      help="training log: average the `number` checkpoints of lowest validation perplexity instead of the last ones")
+  args = parser.parse_args()
+  main(args)
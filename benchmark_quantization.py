@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Translate a held-out file with the fp32 and the dynamic int8 model on cpu,
+report the decoding time of both and the BLEU delta.
+"""
+from __future__ import unicode_literals
+import codecs
+import copy
+import time
+import configargparse
+import sacrebleu
+
+from utils.logging import init_logger
+from inputters.dataset import make_text_iterator_from_file
+import onmt.opts as opts
+from onmt.translator import build_translator
+
+
+def read_lines(path):
+  # padded sentence slots of document batches are written as empty lines
+  with codecs.open(path, 'r', 'utf-8') as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def translate(opt, output):
+  start = time.time()
+  translator = build_translator(opt)
+  load_time = time.time() - start
+  tgt_tran_iter = None
+  if opt.tgt_tran is not None:
+    tgt_tran_iter = make_text_iterator_from_file(opt.tgt_tran)
+  out_file = codecs.open(output, 'w+', 'utf-8')
+  start = time.time()
+  translator.translate(src_data_iter=make_text_iterator_from_file(opt.src),
+                       tgt_data_iter=None,
+                       tgt_tran_data_iter=tgt_tran_iter,
+                       batch_size=opt.batch_size,
+                       out_file=out_file)
+  out_file.close()
+  return load_time, time.time() - start
+
+
+def main(opt):
+  fp32_opt = copy.deepcopy(opt)
+  fp32_opt.quantize = 'none'
+  int8_opt = copy.deepcopy(opt)
+  int8_opt.quantize = 'dynamic_int8'
+
+  results = {}
+  for name, mode_opt in [('fp32', fp32_opt), ('int8', int8_opt)]:
+    output = opt.output + '.' + name
+    load_time, decode_time = translate(mode_opt, output)
+    results[name] = (load_time, decode_time, read_lines(output))
+
+  refs = read_lines(opt.reference)
+  bleu = {name: sacrebleu.corpus_bleu(hyps, [refs]).score
+          for name, (_, _, hyps) in results.items()}
+  agreement = sacrebleu.corpus_bleu(results['int8'][2], [results['fp32'][2]]).score
+  for name in ['fp32', 'int8']:
+    load_time, decode_time, _ = results[name]
+    print("%s: load %.1fs, decode %.1fs, BLEU %.2f" % (name, load_time, decode_time, bleu[name]))
+  print("speed-up x%.2f, BLEU delta %+.2f, BLEU of int8 against fp32 %.2f" % (
+    results['fp32'][1] / results['int8'][1], bleu['int8'] - bleu['fp32'], agreement))
+
+
+if __name__ == "__main__":
+  parser = configargparse.ArgumentParser(
+    description='benchmark_quantization.py',
+    config_file_parser_class=configargparse.YAMLConfigFileParser,
+    formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+  opts.config_opts(parser)
+  opts.translate_opts(parser)
+  parser.add('--reference', '-reference', required=True,
+             help="Reference translation of -src, one sentence per line")
+
+  opt = parser.parse_args()
+  init_logger(opt.log_file)
+  main(opt)
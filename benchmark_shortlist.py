@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Translate a held-out file with the full softmax and with the -shortlist
+vocabulary, report the decoding time of both and the BLEU delta.
+"""
+from __future__ import unicode_literals
+import copy
+import configargparse
+import sacrebleu
+
+from utils.logging import init_logger
+import onmt.opts as opts
+from benchmark_quantization import read_lines, translate
+
+
+def main(opt):
+  full_opt = copy.deepcopy(opt)
+  full_opt.shortlist = None
+
+  results = {}
+  for name, mode_opt in [('full', full_opt), ('shortlist', opt)]:
+    output = opt.output + '.' + name
+    _, decode_time = translate(mode_opt, output)
+    results[name] = (decode_time, read_lines(output))
+
+  refs = read_lines(opt.reference)
+  bleu = {name: sacrebleu.corpus_bleu(hyps, [refs]).score
+          for name, (_, hyps) in results.items()}
+  identical = sum(a == b for a, b in zip(results['full'][1], results['shortlist'][1]))
+  for name in ['full', 'shortlist']:
+    print("%s: decode %.1fs, BLEU %.2f" % (name, results[name][0], bleu[name]))
+  print("speed-up x%.2f, BLEU delta %+.2f, %d/%d identical translations" % (
+    results['full'][0] / results['shortlist'][0], bleu['shortlist'] - bleu['full'],
+    identical, len(results['full'][1])))
+
+
+if __name__ == "__main__":
+  parser = configargparse.ArgumentParser(
+    description='benchmark_shortlist.py',
+    config_file_parser_class=configargparse.YAMLConfigFileParser,
+    formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+  opts.config_opts(parser)
+  opts.translate_opts(parser)
+  parser.add('--reference', '-reference', required=True,
+             help="Reference translation of -src, one sentence per line")
+
+  opt = parser.parse_args()
+  if opt.shortlist is None:
+    parser.error("-shortlist is required")
+  init_logger(opt.log_file)
+  main(opt)
@@ -0,0 +1,49 @@
+import argparse
+import codecs
+from collections import Counter
+
+
+def sentence_pairs(src_path, tgt_path):
+  with codecs.open(src_path, 'r', 'utf-8') as src_file, \
+      codecs.open(tgt_path, 'r', 'utf-8') as tgt_file:
+    for src_doc, tgt_doc in zip(src_file, tgt_file):
+      src_sents, tgt_sents = src_doc.strip().split(" ||| "), tgt_doc.strip().split(" ||| ")
+      # documents are aligned sentence by sentence
+      if len(src_sents) != len(tgt_sents):
+        src_sents, tgt_sents = [" ".join(src_sents)], [" ".join(tgt_sents)]
+      for src, tgt in zip(src_sents, tgt_sents):
+        yield set(src.split()), set(tgt.split())
+
+
+def main(args):
+  src_counts, tgt_counts, pair_counts = Counter(), Counter(), Counter()
+  for src_words, tgt_words in sentence_pairs(args.src, args.tgt):
+    src_counts.update(src_words)
+    tgt_counts.update(tgt_words)
+    pair_counts.update((s, t) for s in src_words for t in tgt_words)
+
+  # Dice coefficient of the sentence co-occurrences: unlike p(t|s) it
+  # does not rank the frequent target words first for every source word
+  translations = {}
+  for (s, t), count in pair_counts.items():
+    if count < args.min_count:
+      continue
+    dice = 2. * count / (src_counts[s] + tgt_counts[t])
+    translations.setdefault(s, []).append((dice, t))
+
+  with codecs.open(args.output, 'w', 'utf-8') as f:
+    for s in sorted(translations, key=lambda w: -src_counts[w]):
+      best = sorted(translations[s], reverse=True)[:args.per_word]
+      f.write(" ".join([s] + [t for _, t in best]) + "\n")
+  print("{} source words, {} co-occurring word pairs".format(len(translations), len(pair_counts)))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Learn the lexical translation table of translate.py -shortlist from the training data")
+  parser.add_argument("--src", required=True, help="training source documents, sentences separated by ' ||| '")
+  parser.add_argument("--tgt", required=True, help="training target documents")
+  parser.add_argument("--output", required=True, help="lexical table, one 'src_word tgt_word ...' line per source word")
+  parser.add_argument("--per_word", type=int, default=100, help="translations kept per source word")
+  parser.add_argument("--min_count", type=int, default=2, help="minimum number of sentence co-occurrences")
+  args = parser.parse_args()
+  main(args)
@@ -0,0 +1,23 @@
+import argparse
+import os
+import torch
+
+from onmt.export import export_checkpoint, DTYPES
+
+
+def main(args):
+  checkpoint = torch.load(args.checkpoint, map_location=lambda storage, loc: storage)
+  artifact = export_checkpoint(checkpoint, args.dtype)
+  torch.save(artifact, args.output)
+  print("{} ({:.1f}MB) -> {} ({:.1f}MB, {})".format(
+    args.checkpoint, os.path.getsize(args.checkpoint) / 2**20,
+    args.output, os.path.getsize(args.output) / 2**20, args.dtype))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Export a training checkpoint as an inference-only artifact, translate.py -models takes either")
+  parser.add_argument("checkpoint", help="training checkpoint (*.pt)")
+  parser.add_argument("output", help="artifact file")
+  parser.add_argument("--dtype", choices=DTYPES, default='fp32', help="storage type of the weights, loaded as fp32")
+  args = parser.parse_args()
+  main(args)
@@ -3,11 +3,12 @@ import gc
 import glob
 import codecs
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, Counter
 import pprint
 import torch
 import torchtext.data
 from utils.logging import logger
+from utils.misc import use_gpu
 import onmt.constants as Constants
 from tkinter import _flatten
 def _getstate(self):
@@ -58,6 +59,18 @@ def save_fields_to_vocab(fields):
       vocab.append((k, f.vocab))
   return vocab
 
+def vocab_from_itos(itos):
+  """
+  Rebuild a Vocab object from its token list, as kept in inference artifacts.
+  """
+  vocab = torchtext.vocab.Vocab.__new__(torchtext.vocab.Vocab)
+  vocab.__setstate__({'itos': list(itos),
+                      'stoi': {w: i for i, w in enumerate(itos)},
+                      'freqs': Counter(),
+                      'vectors': None,
+                      'unk_index': 0})
+  return vocab
+
 def get_source_fields(fields=None, sentence_level=False, use_auto_trans=False):
   if fields is None:
     fields = {}
@@ -228,6 +241,8 @@ class DatasetIter(object):
     self.batch_size_fn = batch_size_fn
     self.device = device
     self.is_train = is_train
+    # number of lines in the shards before the current one
+    self.example_offset = 0
     self.cur_iter = self._next_dataset_iterator(datasets)
     # We have at least one dataset.
     assert self.cur_iter is not None
@@ -236,6 +251,7 @@ class DatasetIter(object):
     dataset_iter = (d for d in self.datasets)
     while self.cur_iter is not None:
       for batch in self.cur_iter:
+        batch.example_offset = self.example_offset
         yield batch
       self.cur_iter = self._next_dataset_iterator(dataset_iter)
 
@@ -250,6 +266,8 @@ class DatasetIter(object):
     try:
       # Drop the current dataset for decreasing memory
       if hasattr(self, "cur_dataset"):
+        # indices count the lines of a shard, filtered examples included
+        self.example_offset += max((ex.indices for ex in self.cur_dataset.examples), default=-1) + 1
         self.cur_dataset.examples = None
         gc.collect()
         del self.cur_dataset
@@ -411,7 +429,7 @@ def build_dataset_iter(datasets, fields, opt, is_train=True):
   else:
     batch_size_fn = None
 
-  if opt.gpu_ranks:
+  if use_gpu(opt):
     device = "cuda"
   else:
     device = "cpu"
@@ -100,8 +100,12 @@ class Beam():
     else:
       return self._compute_topk_scores_and_seq(curr_finished_seq, curr_finished_scores, curr_finished_scores, curr_finished_flags)
   
-  def advance(self, word_prob):
-    "Update beam status and check if finished or not."
+  def advance(self, word_prob, vocab_ids=None):
+    """
+    Update beam status and check if finished or not. Without `vocab_ids`
+    the columns of `word_prob` are the vocabulary, otherwise the target
+    ids in `vocab_ids` (a shortlist).
+    """
     
     if (self.minimal_relative_log_prob != 0.0):
       top_probs, _ = word_prob.topk(1, 1, True, True)
@@ -133,6 +137,8 @@ class Beam():
     
     topk_beam_index = topk_ids // num_words
     topk_ids %= num_words 
+    if vocab_ids is not None:
+      topk_ids = vocab_ids[topk_ids]
     # topk_beam_index: (size * 2,)
     # topk_ids: (size * 2,)
     
@@ -152,6 +158,10 @@ class Beam():
     
     return self.is_finished()
     
+  def finish(self):
+    "Mark the beam as finished without decoding (e.g. a padded sentence slot)."
+    self._done = True
+
   def get_current_state(self):
     "Get the outputs for the current timestep."
     return self.alive_seq
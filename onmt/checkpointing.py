@@ -0,0 +1,34 @@
+""" Activation checkpointing of encoder/decoder layers """
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def checkpointed_layers(layers, model_opt):
+  """
+  Indices of the `layers` whose activations are recomputed in backward.
+
+  `activation_checkpointing` is one of
+     none: keep all the activations
+     all: every layer
+     every_n: one layer out of `checkpoint_every_n`
+     doc_context: the document-context layers (see `doc_context_layers`)
+  """
+  mode = model_opt.activation_checkpointing
+  if mode == "all":
+    return set(range(len(layers)))
+  if mode == "every_n":
+    return set(range(0, len(layers), model_opt.checkpoint_every_n))
+  if mode == "doc_context":
+    return set(i for i, layer in enumerate(layers) if layer.doc_ctx_start)
+  return set()
+
+
+def maybe_checkpoint(module, enabled, *args, **kwargs):
+  """
+  Call `module`, dropping its inner activations when `enabled`. The dropout
+  RNG and autocast state are restored for the recomputation, so gradients
+  match the plain call.
+  """
+  if enabled and module.training and torch.is_grad_enabled():
+    return checkpoint(module, *args, use_reentrant=False, preserve_rng_state=True, **kwargs)
+  return module(*args, **kwargs)
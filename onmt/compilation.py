@@ -0,0 +1,61 @@
+""" torch.compile wrappers and shape bucketing for inference """
+import torch
+
+from utils.logging import logger
+
+
+def bucket(length, size):
+  """ `length` rounded up to a multiple of `size` """
+  return -(-length // size) * size
+
+
+def pad_to_bucket(seq, pad_idx, size):
+  """ Pads `seq` `[len x batch]` with `pad_idx` up to a bucket length """
+  length = seq.size(0)
+  if size <= 1 or length % size == 0:
+    return seq
+  pad = seq.new_full((bucket(length, size) - length, seq.size(1)), pad_idx)
+  return torch.cat([seq, pad], 0)
+
+
+def compile_errors():
+  """ Exceptions raised by torch.compile itself, not by the code compiled """
+  import torch._dynamo.exc
+  errors = (torch._dynamo.exc.TorchDynamoException,)
+  try:
+    import torch._inductor.exc
+    errors += tuple(getattr(torch._inductor.exc, name) for name in ('InductorError', 'LoweringException')
+                    if hasattr(torch._inductor.exc, name))
+  except ImportError:
+    pass
+  return errors
+
+
+class Compiled(object):
+  """
+  `fn` compiled with `torch.compile`. The sizes are traced as dynamic, so
+  together with bucketed lengths the number of graphs stays small. If
+  compiling fails, `fn` runs eagerly from then on. Other errors, of `fn`
+  itself or out of memory, are raised.
+  """
+
+  def __init__(self, fn, name):
+    self.fn = fn
+    self.name = name
+    self.compiled = torch.compile(fn, dynamic=True) if hasattr(torch, 'compile') else None
+    if self.compiled is None:
+      logger.info("torch.compile is not available, %s runs eagerly" % name)
+    else:
+      self.errors = compile_errors()
+
+  def __call__(self, *args, **kwargs):
+    if self.compiled is not None:
+      try:
+        return self.compiled(*args, **kwargs)
+      except self.errors as e:
+        # errors of `fn` met while tracing it are raised as they are
+        if isinstance(e, torch._dynamo.exc.TorchRuntimeError):
+          raise
+        logger.warning("compiling %s failed, falling back to eager" % self.name, exc_info=True)
+        self.compiled = None
+    return self.fn(*args, **kwargs)
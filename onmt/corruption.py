@@ -0,0 +1,100 @@
+""" Corruption of the masked language model inputs """
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class TokenCorruption(nn.Module):
+  """
+  Picks the tokens of a `[batch x len]` LongTensor with some probability,
+  never the special tokens, and replaces them by the mask token
+  (`mask_ratio` of them), a random word (`random_ratio`) or keeps them (the
+  rest). With `span_length` > 1 it picks spans of that many tokens instead,
+  about as many tokens in total. Everything runs on the device of the input
+  with a random generator of the module, see `manual_seed`.
+
+  Args:
+      special_tokens_idxs (list): ids never corrupted
+      vocab_size (int): random words are drawn from the whole vocabulary
+      mask_idx (int): id of the mask token
+      pad_idx (int): label of the tokens left as they are
+  """
+
+  def __init__(self, special_tokens_idxs, vocab_size, mask_idx, pad_idx,
+               mask_ratio=0.8, random_ratio=0.1, span_length=1):
+    super(TokenCorruption, self).__init__()
+    assert 0.0 <= mask_ratio and 0.0 <= random_ratio and mask_ratio + random_ratio <= 1.0
+    is_special = torch.zeros(vocab_size, dtype=torch.bool)
+    is_special[special_tokens_idxs] = True
+    self.register_buffer('is_special', is_special, persistent=False)
+    self.vocab_size = vocab_size
+    self.mask_idx = mask_idx
+    self.pad_idx = pad_idx
+    self.mask_ratio = mask_ratio
+    self.random_ratio = random_ratio
+    self.span_length = span_length
+    self.seed = None
+    self.generators = {}
+
+  @classmethod
+  def from_embeddings(cls, embeddings, opt):
+    # training options, missing from older checkpoints and exported models
+    return cls(embeddings.special_tokens_idxs, embeddings.word_vocab_size,
+               embeddings.mask_word_idx, embeddings.word_padding_idx,
+               getattr(opt, 'mlm_mask_ratio', 0.8),
+               getattr(opt, 'mlm_random_ratio', 0.1),
+               getattr(opt, 'mlm_span_length', 1))
+
+  def __getstate__(self):
+    # copies draw from generators of their own
+    state = self.__dict__.copy()
+    state['generators'] = {}
+    return state
+
+  def manual_seed(self, seed):
+    """ Seeds the generators, a different seed per rank """
+    self.seed = seed
+    self.generators = {}
+
+  def _generator(self, device):
+    if device not in self.generators:
+      generator = torch.Generator(device=device)
+      if self.seed is None:
+        generator.seed()
+      else:
+        generator.manual_seed(self.seed)
+      self.generators[device] = generator
+    return self.generators[device]
+
+  def select(self, inputs, prob, generator):
+    """ `[batch x len]` bool mask of the tokens to corrupt """
+    if self.span_length > 1:
+      starts = torch.rand(inputs.shape, device=inputs.device, generator=generator) < prob / self.span_length
+      # a start covers itself and the next span_length - 1 tokens
+      starts = F.pad(starts.float().unsqueeze(1), (self.span_length - 1, 0))
+      picked = F.max_pool1d(starts, self.span_length, stride=1).squeeze(1).bool()
+    else:
+      picked = torch.rand(inputs.shape, device=inputs.device, generator=generator) < prob
+    return picked & ~self.is_special[inputs]
+
+  def forward(self, inputs, prob, mask_ratio=None, random_ratio=None):
+    """
+    Corrupts `inputs` in place with probability `prob` per token.
+
+    Returns:
+        (inputs, labels): labels are the original tokens where corrupted
+        and `pad_idx` elsewhere
+    """
+    mask_ratio = self.mask_ratio if mask_ratio is None else mask_ratio
+    random_ratio = self.random_ratio if random_ratio is None else random_ratio
+    generator = self._generator(inputs.device)
+    picked = self.select(inputs, prob, generator)
+    labels = inputs.masked_fill(~picked, self.pad_idx)
+
+    choice = torch.rand(inputs.shape, device=inputs.device, generator=generator)
+    masked = picked & (choice < mask_ratio)
+    randomized = picked & (choice >= mask_ratio) & (choice < mask_ratio + random_ratio)
+    random_words = torch.randint(self.vocab_size, inputs.shape, device=inputs.device, generator=generator)
+    inputs.masked_fill_(masked, self.mask_idx)
+    inputs.copy_(torch.where(randomized, random_words, inputs))
+    return inputs, labels
@@ -6,25 +6,43 @@ import torch.nn as nn
 
 
 class PositionalEncoding(nn.Module):
-  def __init__(self, dropout, dim, max_len=5000):
-    pe = torch.zeros(max_len, dim)
-    position = torch.arange(0, max_len).unsqueeze(1)
-    div_term = torch.exp((torch.arange(0, dim, 2, dtype=torch.float) *
-                         -(math.log(10000.0) / dim)))
-    pe[:, 0::2] = torch.sin(position.float() * div_term)
-    pe[:, 1::2] = torch.cos(position.float() * div_term)
-    pe = pe.unsqueeze(1)
+  """
+  Sinusoidal position encoding. The table is grown on demand, follows the
+  device of the module and is not saved in checkpoints.
+  """
+  def __init__(self, dropout, dim, max_len=512):
     super(PositionalEncoding, self).__init__()
-    self.register_buffer('pe', pe)
+    self.register_buffer('pe', self._build_table(max_len, dim), persistent=False)
     self.dropout = nn.Dropout(p=dropout)
     self.dim = dim
 
-  def forward(self, emb, step=None):
+  @staticmethod
+  def _build_table(max_len, dim, device=None):
+    pe = torch.zeros(max_len, dim, device=device)
+    position = torch.arange(0, max_len, dtype=torch.float, device=device).unsqueeze(1)
+    div_term = torch.exp((torch.arange(0, dim, 2, dtype=torch.float, device=device) *
+                         -(math.log(10000.0) / dim)))
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+    return pe
+
+  def table(self, length, device):
+    """ `[>= length, dim]` position table on `device` """
+    if self.pe.size(0) < length:
+      self.pe = self._build_table(max(length, 2 * self.pe.size(0)), self.dim, device)
+    elif self.pe.device != device:
+      self.pe = self.pe.to(device)
+    return self.pe
+
+  def forward(self, emb, step=None, positions=None):
     emb = emb * math.sqrt(self.dim)
-    if step is None:
-      emb = emb + self.pe[:emb.size(0)]
+    if positions is not None:
+      # packed tokens: [tokens, dim], the table is grown by the caller
+      emb = emb + self.pe.index_select(0, positions)
+    elif step is None:
+      emb = emb + self.table(emb.size(0), emb.device)[:emb.size(0)].unsqueeze(1)
     else:
-      emb = emb + self.pe[step]
+      emb = emb + self.table(step + 1, emb.device)[step]
     emb = self.dropout(emb)
     return emb
 
@@ -87,15 +105,41 @@ class Embeddings(nn.Module):
       if fixed:
         self.word_lut.weight.requires_grad = False
 
-  def get_seg_emb(self, sent_num, doc_num, seq_len):
-    sent_idx = torch.range(0, sent_num - 1)
-    sent_seg_embedding = self.segment_emb(sent_idx.long().cuda())
-    sent_seg_embedding = sent_seg_embedding.unsqueeze(1).unsqueeze(0)
-    sent_seg_embedding = sent_seg_embedding.repeat_interleave(repeats=seq_len,dim=2)
-    sent_seg_embedding = sent_seg_embedding.repeat_interleave(repeats=doc_num,dim=0)
-    sent_seg_embedding = sent_seg_embedding.view(doc_num * sent_num, seq_len, -1).transpose(0, 1)
-    
-    return sent_seg_embedding
+  @staticmethod
+  def segment_index(sent_num, doc_num, device=None):
+    """ sentence slot of every row of a `[doc_num * sent_num]` batch """
+    return torch.arange(sent_num, device=device).repeat(doc_num)
+
+  def add_seg_emb(self, emb, sent_num):
+    """
+    Adds the segment embedding to `emb` `[len x doc_num * sent_num x dim]`,
+    broadcast over the documents and positions instead of materialized.
+    """
+    seq_len, batch_size = emb.size(0), emb.size(1)
+    seg_emb = self.segment_emb.weight[:sent_num]  # [sent_num, dim]
+    emb = emb.view(seq_len, batch_size // sent_num, sent_num, -1) + seg_emb
+    return emb.view(seq_len, batch_size, -1)
+
+  def packed_forward(self, source, packing, sent_num=None):
+    """
+    Computes the embeddings of the real tokens only.
+
+    Args:
+        source (`LongTensor`): index tensor `[len x batch]`
+        packing (:obj:`onmt.packing.Packing`): index of the real tokens
+    Return:
+        `FloatTensor`: word embeddings `[rows x len x embedding_size]`,
+        zeros on padding
+    """
+    words = packing.pack(packing.select_rows(source.transpose(0, 1)))
+    emb = self.word_lut(words)
+    if self.position_encoding:
+      pe = self.make_embedding[1]
+      pe.table(packing.seq_len, emb.device)
+      emb = pe(emb, positions=packing.positions)
+    if sent_num and self.segment_embedding:
+      emb = emb + self.segment_emb(packing.token_rows % sent_num)
+    return packing.unpack(emb)
 
   def forward(self, source, step=None, sent_num=None, pair_seg_emb=False):
     """
@@ -118,8 +162,5 @@ class Embeddings(nn.Module):
       source = self.make_embedding(source)
     # add segment embedding
     if sent_num and self.segment_embedding:
-      doc_num = int(source.size(1) / sent_num)
-      seq_len = source.size(0)
-      segment_emb = self.get_seg_emb(sent_num, doc_num, seq_len)
-      source = segment_emb + source
+      source = self.add_seg_emb(source, sent_num)
     return source
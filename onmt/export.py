@@ -0,0 +1,104 @@
+""" Inference-only model artifacts """
+import zipfile
+import torch
+
+ARTIFACT_FORMAT = 'distillation-dnmt-inference-v1'
+
+# options read while building the model or by the translator
+ARCH_OPTS = ['src_word_vec_size', 'tgt_word_vec_size', 'share_decoder_embeddings',
+             'share_embeddings', 'position_encoding', 'segment_embedding',
+             'enc_layers', 'dec_layers', 'enc_rnn_size', 'dec_rnn_size', 'heads',
+             'transformer_ff', 'dropout', 'optim', 'sentence_level',
+             'use_auto_trans', 'use_ord_ctx', 'doc_context_layers', 'cross_attn',
+             'cross_before', 'decoder_cross_before', 'cross_out_encoder',
+             'only_fixed', 'gated_auto_src', 'share_enc_cross_attn',
+             'share_dec_cross_attn', 'mlm_prob']
+
+# the weights are trained: no initialization or pretrained vectors, and no
+# MLM decoder, translation never runs it
+INFERENCE_OPTS = {'param_init': 0.0, 'param_init_glorot': False,
+                  'pre_word_vecs_enc': None, 'pre_word_vecs_dec': None,
+                  'fix_word_vecs_enc': False, 'fix_word_vecs_dec': False,
+                  'init_cross_sent': False, 'mlm_distill': False, 'new_gen': False,
+                  'share_mlm_decoder_embeddings': False}
+
+DTYPES = ['fp32', 'bf16', 'int8']
+
+
+def _encode(tensors, dtype, scales, memo):
+  """
+  `tensors` stored as `dtype`. int8 keeps a symmetric scale per row of the
+  matrices in `scales`, vectors stay fp32. `memo` keeps tied weights shared.
+  """
+  out = {}
+  for name, t in tensors.items():
+    if not t.is_floating_point():
+      out[name] = t
+      continue
+    key = (t.data_ptr(), t.size())
+    if key not in memo:
+      if dtype == 'int8' and t.dim() == 2:
+        scale = t.float().abs().amax(1).clamp(min=1e-12) / 127.
+        memo[key] = (torch.round(t.float() / scale.unsqueeze(1)).to(torch.int8), scale)
+      elif dtype == 'bf16':
+        memo[key] = (t.to(torch.bfloat16), None)
+      else:
+        memo[key] = (t.float(), None)
+    out[name], scale = memo[key]
+    if scale is not None:
+      scales[name] = scale
+  return out
+
+
+def _decode(tensors, scales):
+  out = {}
+  for name, t in tensors.items():
+    if name in scales:
+      t = t.float() * scales[name].unsqueeze(1)
+    elif t.is_floating_point():
+      t = t.float()
+    out[name] = t
+  return out
+
+
+def export_checkpoint(checkpoint, dtype='fp32'):
+  """
+  The inference artifact of a training checkpoint: the model and generator
+  weights as `dtype`, the vocabularies as token lists and the architecture
+  options, all plain containers so it loads with `weights_only`.
+  """
+  from onmt.transformer import drop_stale_buffers
+  model_opt = vars(checkpoint['opt'])
+  opt = {k: model_opt[k] for k in ARCH_OPTS if k in model_opt}
+  opt.update(INFERENCE_OPTS)
+  model = drop_stale_buffers({k: v for k, v in checkpoint['model'].items()
+                              if not k.startswith('mlm_decoder.')})
+  scales = {'model': {}, 'generator': {}}
+  memo = {}
+  return {'format': ARTIFACT_FORMAT,
+          'dtype': dtype,
+          'opt': opt,
+          'vocab': {k: list(v.itos) for k, v in checkpoint['vocab']},
+          'model': _encode(model, dtype, scales['model'], memo),
+          'generator': _encode(checkpoint['generator'], dtype, scales['generator'], memo),
+          'scales': scales}
+
+
+def is_artifact(path):
+  """ Tells an artifact from a training checkpoint without unpickling either """
+  if not zipfile.is_zipfile(path):
+    return False
+  with zipfile.ZipFile(path) as archive:
+    pickles = [n for n in archive.namelist() if n.endswith('/data.pkl')]
+    return len(pickles) == 1 and ARTIFACT_FORMAT.encode() in archive.read(pickles[0])
+
+
+def load_artifact(path):
+  """
+  The artifact at `path` with fp32 weights, in the `checkpoint` layout
+  `build_base_model` takes. Nothing but tensors and builtins is unpickled.
+  """
+  artifact = torch.load(path, map_location=lambda storage, loc: storage, weights_only=True)
+  for part in ['model', 'generator']:
+    artifact[part] = _decode(artifact[part], artifact['scales'][part])
+  return artifact
@@ -180,6 +180,19 @@ def train_opts(parser):
               help="""Save a checkpoint every X steps""")
     group.add('--keep_checkpoint', '-keep_checkpoint', type=int, default=-1,
               help="""Keep X checkpoints (negative: keep all)""")
+    group.add('--async_save', '-async_save', action='store_true',
+              help="""Copy the checkpoints to CPU memory and write them
+              in a background thread while training goes on""")
+    group.add('--average_decay', '-average_decay', type=float, default=0,
+              help="""Keep an exponential moving average of the weights
+              with this decay, e.g. 0.9999, saved with each checkpoint as
+              *_step_N.ema.pt for translation. 0 disables it""")
+    group.add('--average_every', '-average_every', type=int, default=1,
+              help="""Update the moving average every X steps""")
+    group.add('--average_cpu', '-average_cpu', action='store_true',
+              help="""Keep the moving average in CPU memory""")
+    group.add('--average_valid', '-average_valid', action='store_true',
+              help="""Validate with the moving average of the weights""")
 
     # GPU
     group.add('--gpuid', '-gpuid', default=[], nargs='*', type=int,
@@ -197,13 +210,28 @@ def train_opts(parser):
               help="IP of master for torch.distributed training.")
     group.add('--master_port', '-master_port', default=10000, type=int,
               help="Port of master for torch.distributed training.")
+    group.add('--ddp', '-ddp', action='store_true',
+              help="""Train the processes with DistributedDataParallel:
+                       gradients are all-reduced in buckets during the
+                       backward, and only on the last of -accum_count
+                       batches.""")
+    group.add('--ddp_bucket_mb', '-ddp_bucket_mb', default=25, type=int,
+              help="Size of the -ddp gradient buckets, in MB.")
+    group.add('--ddp_cpu', '-ddp_cpu', action='store_true',
+              help="""Run the -world_size processes (-gpu_ranks) on cpu,
+                       with -gpu_backend gloo.""")
 
     group.add('--seed', '-seed', type=int, default=-1,
               help="""Random seed used for the experiments
                        reproducibility.""")
     
     group.add('--mixed_precision', '-mixed_precision', action='store_true',
-              help="""use the mixed precision or not""")
+              help="""use the mixed precision or not, same as -precision auto""")
+    group.add('--precision', '-precision', default='fp32',
+              choices=['fp32', 'fp16', 'bf16', 'auto'],
+              help="""Autocast dtype of training and validation. fp16 scales
+                       the losses, bf16 does not. auto is fp16 on gpu and
+                       bf16 on cpu.""")
     group.add('--use_ord_ctx', '-use_ord_ctx',type=int, default=0,
               help="""use the mixed precision or not""")
     
@@ -236,6 +264,15 @@ def train_opts(parser):
 
     group.add('--mlm_prob', '-mlm_prob', type=float, default=0.15,
             help="probility of token that be masked in MASK LNAGUAGE MDOEL")
+
+    group.add('--mlm_mask_ratio', '-mlm_mask_ratio', type=float, default=0.8,
+            help="ratio of the masked tokens replaced by the mask token")
+
+    group.add('--mlm_random_ratio', '-mlm_random_ratio', type=float, default=0.1,
+            help="ratio of the masked tokens replaced by a random word, the others are kept")
+
+    group.add('--mlm_span_length', '-mlm_span_length', type=int, default=1,
+            help="mask spans of this many tokens instead of single tokens")
     
     group.add('--mlm_distill', '-mlm_distill', type=int, default=0,
             help="probility of token that be masked in MASK LNAGUAGE MDOEL")
@@ -251,6 +288,21 @@ def train_opts(parser):
    
     group.add('--distill_prob', '-distill_prob', type=float, default=0.15,
             help="probility of token that be masked in MASK LNAGUAGE MDOEL")
+
+    group.add('--distill_topk', '-distill_topk', type=int, default=0,
+            help="""Distill from the k most probable teacher words only
+                 (renormalized), with a sparse loss that builds no dense
+                 target. 0: the full teacher distribution""")
+    group.add('--teacher_cache', '-teacher_cache', type=str, default=None,
+            help="""Prefix of memory-mapped files with the top-k distributions
+                 of the frozen MLM teacher for every training target token.
+                 They are written once at -start_distill_step (if missing)
+                 and read by distillation instead of running the teacher.""")
+    group.add('--teacher_cache_topk', '-teacher_cache_topk', type=int, default=32,
+            help="Teacher entries cached per target token (6 bytes each)")
+    group.add('--teacher_cache_refresh_steps', '-teacher_cache_refresh_steps', type=int, default=0,
+            help="""Recompute the cached distributions with the masks chosen
+                 by the current student every this many steps. 0: never""")
     
     group.add('--share_mlm_decoder_embeddings', '-share_mlm_decoder_embeddings', type=int, default=0,
             help="if use target embedding as the init weight of generator of mlm decoder")
@@ -365,11 +417,26 @@ def train_opts(parser):
               help='Perfom validation every X steps')
     group.add('--valid_batch_size', '-valid_batch_size', type=int, default=1,
               help='Maximum batch size for validation')
+    group.add('--packed_execution', '-packed_execution', action='store_true',
+              help="""Run the encoder and decoder padding-free: entirely
+                       padded sentence slots are dropped and the
+                       position-wise modules only run over real tokens.""")
+    group.add('--activation_checkpointing', '-activation_checkpointing',
+              default='none', choices=['none', 'all', 'every_n', 'doc_context'],
+              help="""Recompute the activations of encoder/decoder layers in
+                       backward instead of storing them: all layers, one
+                       layer out of -checkpoint_every_n, or only the
+                       document-context layers (-doc_context_layers).""")
+    group.add('--checkpoint_every_n', '-checkpoint_every_n', type=int, default=2,
+              help="Checkpoint one layer out of N with -activation_checkpointing every_n")
     group.add('--max_generator_batches', '-max_generator_batches',
               type=int, default=32,
               help="""Maximum batches of words in a sequence to run
-                        the generator on in parallel. Higher is faster, but
-                        uses more memory.""")
+                        the generator, the loss and their backward on at
+                        once: chunks of this many target time steps times
+                        the batch width, so that the [tokens x vocab] scores
+                        of a batch are never all resident. Higher is faster,
+                        but uses more memory. 0 runs the whole batch at once.""")
     group.add('--train_steps', '-train_steps', type=int, default=100000,
               help='Number of training steps')
     group.add('--epochs', '-epochs', type=int, default=0,
@@ -378,6 +445,19 @@ def train_opts(parser):
               choices=['sgd', 'adagrad', 'adadelta', 'adam',
                        'sparseadam'],
               help="""Optimization method.""")
+    group.add('--optim_impl', '-optim_impl', default='foreach',
+              choices=['loop', 'foreach', 'fused'],
+              help="""Implementation of the optimizer step and of the
+                       gradient clipping: a loop over the parameters,
+                       multi-tensor (foreach) kernels, or the fused Adam
+                       kernel (adam on GPU, foreach otherwise).""")
+    group.add('--optim_flat_buffers', '-optim_flat_buffers',
+              action='store_true',
+              help="""Keep the trained parameters and their gradients in
+                       one flat buffer per device and dtype, so that zeroing
+                       and clipping the gradients are single kernels.
+                       Parameters without gradient in a step are then
+                       updated with a zero gradient.""")
     group.add('--adagrad_accumulator_init', '-adagrad_accumulator_init',
               type=float, default=0,
               help="""Initializes the accumulator values in adagrad.
@@ -469,6 +549,19 @@ def train_opts(parser):
                        help="""Log directory for Tensorboard.
                        This is also the name of the run.
                        """)
+    group.add('--metrics_file', '-metrics_file', type=str, default="",
+              help="""Append the training, validation and -profile_phases
+              reports to this file, one JSON object per line""")
+    group.add('--profile_phases', '-profile_phases', action="store_true",
+              help="""Log the time per step of each phase of training
+              (data, forward, loss, backward, ...) every -report_every
+              steps. Synchronizes the device around each phase.""")
+    group.add('--profile_steps', '-profile_steps', type=int, nargs=2,
+              default=None, metavar=('FIRST', 'LAST'),
+              help="""Capture a torch.profiler trace of these steps""")
+    group.add('--profile_dir', '-profile_dir', type=str, default="profile",
+              help="""Directory of the torch.profiler trace, for
+              tensorboard""")
 
 def translate_opts(parser):
     """ Translation / inference options """
@@ -540,3 +633,46 @@ def translate_opts(parser):
               help='Batch size')
     group.add('--gpu', '-gpu', type=int, default=-1,
                        help="Device to run on")
+    group.add('--precision', '-precision', default='fp32',
+              choices=['fp32', 'fp16', 'bf16', 'auto'],
+              help="""Autocast dtype of beam search and force decoding.
+                       auto is fp16 on gpu and bf16 on cpu.""")
+    group.add('--quantize', '-quantize', default='none',
+              choices=['none', 'dynamic_int8'],
+              help="""Run the attention projections, FFNs and generator with
+                       int8 weights and dynamically quantized activations
+                       (cpu only).""")
+    group.add('--quantize_embeddings', '-quantize_embeddings', action='store_true',
+              help="Also store the word embeddings as int8 rows with -quantize")
+    group.add('--quantized_cache', '-quantized_cache', type=str, default=None,
+              help="""Load the quantized model from this file, or save it
+                       there after quantizing. It is rebuilt when the
+                       checkpoint is newer.""")
+    group.add('--compile', '-compile', action='store_true',
+              help="""Run the encoder and the decoding steps through
+                       torch.compile graphs, falling back to eager if
+                       compiling fails.""")
+    group.add('--compile_bucket', '-compile_bucket', type=int, default=16,
+              help="""With -compile, pad source lengths and the decoding
+                       cache to multiples of this size to bound the
+                       number of compiled graphs.""")
+    group.add('--shortlist', '-shortlist', type=str, default=None,
+              help="""Lexical table from build_lexical_table.py. Beam
+                       search then scores only the translations of the
+                       source words, the -tgt_tran tokens and the
+                       -shortlist_frequent most frequent words.""")
+    group.add('--shortlist_per_word', '-shortlist_per_word', type=int, default=50,
+              help="Translations kept per source word of the lexical table")
+    group.add('--shortlist_frequent', '-shortlist_frequent', type=int, default=1000,
+              help="Most frequent target words always in the shortlist")
+    group.add('--shortlist_fallback', '-shortlist_fallback', type=float, default=0.,
+              help="""Score a step over the full vocabulary when the best
+                       word of a hypothesis has less shortlist probability
+                       than this. 0: never. A heuristic: the probability is
+                       renormalized over the shortlist, so it is higher than
+                       over the full vocabulary and a shortlist missing the
+                       right words is not reliably detected.""")
+    group.add('--packed_execution', '-packed_execution', action='store_true',
+              help="""Encode padding-free: entirely padded sentence slots
+                       are dropped and the position-wise modules only run
+                       over real tokens.""")
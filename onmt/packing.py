@@ -0,0 +1,78 @@
+""" Gather/scatter index for padding-free (packed) execution """
+import torch
+
+
+class Packing(object):
+  """
+  Index over the real tokens of a padded `[batch, seq_len]` batch.
+
+  Rows (sentence slots) that only hold padding are dropped as a whole, the
+  kept rows stay dense `[rows, seq_len, dim]` for attention while the
+  position-wise modules run over the flat `[tokens, dim]` view.
+
+  Args:
+     pad_mask (`BoolTensor`): `[batch, seq_len]`, true on padding.
+     rows (`LongTensor`): indices of the rows to keep, all rows if None.
+  """
+
+  def __init__(self, pad_mask, rows=None):
+    self.n_rows, self.seq_len = pad_mask.size()
+    if rows is None:
+      rows = torch.arange(self.n_rows, device=pad_mask.device)
+    self.rows = rows
+    self.pad_mask = pad_mask.index_select(0, rows)
+    self.tokens = (~self.pad_mask).view(-1).nonzero().squeeze(1)
+
+  @staticmethod
+  def non_empty_rows(*pad_masks):
+    """ Rows having a real token in at least one of `pad_masks` `[batch, seq_len]` """
+    keep = None
+    for pad_mask in pad_masks:
+      if pad_mask is None:
+        continue
+      row_keep = ~pad_mask.all(-1)
+      keep = row_keep if keep is None else keep | row_keep
+    return keep.nonzero().squeeze(1)
+
+  @property
+  def num_tokens(self):
+    return self.tokens.size(0)
+
+  @property
+  def positions(self):
+    """ position of every real token inside its sentence """
+    return self.tokens % self.seq_len
+
+  @property
+  def token_rows(self):
+    """ row of every real token in the original (uncompacted) batch """
+    return self.rows.index_select(0, self.tokens // self.seq_len)
+
+  def select_rows(self, x, dim=0):
+    """ `[batch, ...]` -> `[rows, ...]` """
+    return x.index_select(dim, self.rows)
+
+  def expand_rows(self, x, fill_value=0):
+    """ `[rows, ...]` -> `[batch, ...]`, dropped rows are `fill_value` """
+    out = x.new_full((self.n_rows,) + tuple(x.shape[1:]), fill_value)
+    return out.index_copy(0, self.rows, x)
+
+  def pack(self, x):
+    """ `[rows, seq_len, ...]` -> `[tokens, ...]` """
+    return x.reshape((-1,) + tuple(x.shape[2:])).index_select(0, self.tokens)
+
+  def unpack(self, x, base=None):
+    """
+    `[tokens, ...]` -> `[rows, seq_len, ...]`, padding positions are taken
+    from `base` (same shape as the output) or zeros.
+    """
+    shape = (self.rows.size(0), self.seq_len) + tuple(x.shape[1:])
+    if base is None:
+      flat = x.new_zeros((shape[0] * shape[1],) + tuple(x.shape[1:]))
+    else:
+      flat = base.reshape((-1,) + tuple(x.shape[1:]))
+    return flat.index_copy(0, self.tokens, x.to(flat.dtype)).view(shape)
+
+  def apply(self, fn, x):
+    """ Run the position-wise `fn` over the real tokens of `x` `[rows, seq_len, dim]` """
+    return self.unpack(fn(self.pack(x)), base=x)
@@ -0,0 +1,42 @@
+""" Dynamic int8 quantization for CPU inference """
+import os
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, \
+  float_qparams_weight_only_qconfig
+
+
+def quantize_model(model, embeddings=False):
+  """
+  Gives every `nn.Linear` (attention projections, FFNs, gates and the
+  generators) int8 weights, the activations are quantized on the fly.
+  With `embeddings`, the word look-up tables get weight-only int8 rows.
+  The model is quantized in place, it only runs on cpu afterwards.
+  """
+  qconfig_spec = {nn.Linear: default_dynamic_qconfig}
+  if embeddings:
+    for name, _ in model.named_modules():
+      if name.endswith('make_embedding.word'):
+        qconfig_spec[name] = float_qparams_weight_only_qconfig
+  return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def save_quantized(path, model, model_opt, vocab, embeddings=False):
+  """ Pickles the whole quantized model, so loading skips the fp32 checkpoint """
+  torch.save({'model': model, 'opt': model_opt, 'vocab': vocab,
+              'quantize_embeddings': embeddings}, path)
+
+
+def load_quantized(path, model_path, embeddings=False):
+  """
+  The cache written by `save_quantized`, None when it is missing, older
+  than the checkpoint at `model_path` or quantized with other settings.
+  """
+  if not os.path.exists(path) or \
+      os.path.getmtime(path) < os.path.getmtime(model_path):
+    return None
+  # a pickled module, not only tensors
+  cache = torch.load(path, map_location=lambda storage, loc: storage, weights_only=False)
+  if cache['quantize_embeddings'] != embeddings:
+    return None
+  return cache
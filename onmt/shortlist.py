@@ -0,0 +1,88 @@
+""" Vocabulary shortlists for beam search """
+import codecs
+import torch
+import torch.nn.functional as F
+
+
+def load_lexical_table(path, src_vocab, tgt_vocab, per_word):
+  """
+  The lexical table written by build_lexical_table.py, one line
+  `src_word tgt_word_1 tgt_word_2 ...` per source word with the best
+  translations first, as a `[src_vocab_size x per_word]` tensor of target
+  ids padded with -1. Words missing from the vocabularies are skipped.
+  """
+  table = torch.full((len(src_vocab), per_word), -1, dtype=torch.long)
+  with codecs.open(path, 'r', 'utf-8') as f:
+    for line in f:
+      words = line.split()
+      if not words or words[0] not in src_vocab.stoi:
+        continue
+      tgt_ids = [tgt_vocab.stoi[w] for w in words[1:] if w in tgt_vocab.stoi][:per_word]
+      table[src_vocab.stoi[words[0]], :len(tgt_ids)] = torch.tensor(tgt_ids, dtype=torch.long)
+  return table
+
+
+class Shortlist(object):
+  """
+  Restricts the generator of a batch to the translations of its source
+  words, the tokens of its auto-translation and the `frequent` most
+  frequent target words (the vocabularies are sorted by frequency, after
+  the special tokens).
+
+  Args:
+      table (LongTensor): `[src_vocab_size x per_word]` target ids, -1 pads
+      tgt_vocab_size (int): size of the full output layer
+      frequent (int): number of most frequent target words always kept
+      fallback (float): a step runs the full generator if the best word of
+          some hypothesis has less shortlist probability than this, 0 never.
+          A heuristic: the probability is renormalized over the shortlist,
+          which makes it higher than over the full vocabulary, so a
+          shortlist missing the right words is not reliably detected.
+  """
+
+  def __init__(self, table, tgt_vocab_size, frequent=1000, fallback=0., device=None):
+    self.table = table.to(device)
+    self.frequent = torch.arange(min(frequent, tgt_vocab_size), device=device)
+    self.fallback = fallback
+
+  @classmethod
+  def from_opt(cls, opt, fields, device):
+    table = load_lexical_table(opt.shortlist, fields["src"].vocab, fields["tgt"].vocab,
+                               opt.shortlist_per_word)
+    return cls(table, len(fields["tgt"].vocab), opt.shortlist_frequent,
+               opt.shortlist_fallback, device)
+
+  def vocab_ids(self, src_seq, tgt_tran=None):
+    """ Sorted target ids of the shortlist for a batch """
+    candidates = [self.frequent, self.table[src_seq.unique()].view(-1)]
+    if tgt_tran is not None:
+      candidates.append(tgt_tran.unique())
+    ids = torch.cat(candidates).unique()
+    return ids[ids >= 0]
+
+  def restrict(self, generator, vocab_ids):
+    """ The rows of the output layer of `generator` for `vocab_ids` """
+    linear = generator[0]
+    # dynamically quantized layers expose their parameters as methods
+    weight = linear.weight() if callable(linear.weight) else linear.weight
+    bias = linear.bias() if callable(linear.bias) else linear.bias
+    if weight.is_quantized:
+      weight = weight.dequantize()
+    weight = weight.index_select(0, vocab_ids)
+    if bias is not None:
+      bias = bias.index_select(0, vocab_ids)
+    return vocab_ids, weight, bias
+
+  def log_probs(self, generator, restricted, dec_output):
+    """
+    Log-probabilities of `dec_output` over the shortlist and the target ids
+    of their columns, or over the full vocabulary (ids None) on fallback.
+    """
+    vocab_ids, weight, bias = restricted
+    word_prob = generator[1](F.linear(dec_output, weight, bias))
+    # the mass of the shortlist in the full distribution would need the
+    # full output layer, which the shortlist is there to avoid
+    if self.fallback > 0 and \
+        word_prob.max(-1)[0].exp().min().item() < self.fallback:
+      return generator(dec_output), None
+    return word_prob, vocab_ids
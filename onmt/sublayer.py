@@ -63,7 +63,7 @@ class MultiHeadedAttention(nn.Module):
     self.final_linear = nn.Linear(model_dim, model_dim)
 
   def forward(self, key, value, query, mask=None,
-              layer_cache=None, type=None):
+              layer_cache=None, type=None, cache_pos=None):
     """
     Compute the context vector and the attention vectors.
 
@@ -76,6 +76,8 @@ class MultiHeadedAttention(nn.Module):
              query vectors  `[batch, query_len, dim]`
        mask: binary mask indicating which keys have
              non-zero attention `[batch, query_len, key_len]`
+       cache_pos (`LongTensor`): `[1]` position of the step in a
+             fixed-size self-attention cache of `mask.size(-1)` steps
     Returns:
        (`FloatTensor`, `FloatTensor`) :
 
@@ -109,7 +111,16 @@ class MultiHeadedAttention(nn.Module):
           key = shape(key)
           value = shape(value)
 
-          if layer_cache is not None:
+          if cache_pos is not None:
+              if layer_cache["self_keys"] is None:
+                  cache_shape = (key.size(0), head_count, mask.size(-1), dim_per_head)
+                  layer_cache["self_keys"] = key.new_zeros(cache_shape)
+                  layer_cache["self_values"] = value.new_zeros(cache_shape)
+              layer_cache["self_keys"].index_copy_(2, cache_pos, key)
+              layer_cache["self_values"].index_copy_(2, cache_pos, value)
+              key = layer_cache["self_keys"]
+              value = layer_cache["self_values"]
+          elif layer_cache is not None:
               device = key.device
               if layer_cache["self_keys"] is not None:
                   key = torch.cat(
@@ -126,10 +137,11 @@ class MultiHeadedAttention(nn.Module):
         query = self.linear_query(query)
         if layer_cache is not None:
           if layer_cache["auto_memory_keys"] is None:
+            # contiguous, the strides stay the same when the beams are reordered
             key, value = self.linear_keys(key),\
                          self.linear_values(value)
-            key = shape(key)
-            value = shape(value)
+            key = shape(key).contiguous()
+            value = shape(value).contiguous()
           else:
             key, value = layer_cache["auto_memory_keys"],\
                        layer_cache["auto_memory_values"]
@@ -147,8 +159,8 @@ class MultiHeadedAttention(nn.Module):
           if layer_cache["memory_keys"] is None:
             key, value = self.linear_keys(key),\
                          self.linear_values(value)
-            key = shape(key)
-            value = shape(value)
+            key = shape(key).contiguous()
+            value = shape(value).contiguous()
           else:
             key, value = layer_cache["memory_keys"],\
                        layer_cache["memory_values"]
@@ -2,6 +2,7 @@
 This file is for models creation, which consults options
 and creates each encoder and decoder accordingly.
 """
+import argparse
 import re
 import torch
 import torch.nn as nn
@@ -13,12 +14,23 @@ from onmt.transformer_encoder import TransformerEncoder
 from onmt.transformer_decoder import TransformerDecoder
 
 from onmt.embeddings import Embeddings
+from onmt.corruption import TokenCorruption
+from onmt.packing import Packing
+from onmt.quantization import quantize_model, save_quantized, load_quantized
+from onmt.export import is_artifact, load_artifact
 from utils.misc import use_gpu
 from utils.logging import logger
-from inputters.dataset import load_fields_from_vocab
+from inputters.dataset import load_fields_from_vocab, vocab_from_itos
 import torch.nn.functional as F
 
 
+# buffers older checkpoints saved but which are now rebuilt on the fly:
+# the per-layer causal masks and the sinusoid position tables
+STALE_BUFFER_KEYS = re.compile(r'(transformer_layers\.\d+\.mask|make_embedding\.pe\.pe)$')
+
+
+def drop_stale_buffers(state_dict):
+  return {k: v for (k, v) in state_dict.items() if not STALE_BUFFER_KEYS.search(k)}
 
 
 class NMTModel(nn.Module):
@@ -34,15 +46,29 @@ class NMTModel(nn.Module):
     self.mlm_prob = model_opt.mlm_prob
     self.sentence_level = model_opt.sentence_level
     self.mlm_distill = model_opt.mlm_distill
-
+    self.packed_execution = model_opt.packed_execution
+    # MLM input corruption, per vocabulary
+    self.corruption = nn.ModuleDict({
+      'tran': TokenCorruption.from_embeddings(decoder.embeddings, model_opt),
+      'src': TokenCorruption.from_embeddings(encoder.embeddings, model_opt)})
+    if mlm_decoder is not None:
+      self.corruption['mlm'] = TokenCorruption.from_embeddings(mlm_decoder.embeddings, model_opt)
+
+  def seed_corruption(self, seed):
+    for corruption in self.corruption.values():
+      corruption.manual_seed(seed)
 
   def get_embeding_and_mask_before_encoding(self, embeddings_layer, seq, src_length):
     
     padding_idx = embeddings_layer.word_padding_idx
-    emb = embeddings_layer(seq, sent_num=src_length.size(-1))
-    emb = emb.transpose(0, 1).contiguous()
     words = seq.transpose(0, 1)
     mask = words.data.eq(padding_idx).unsqueeze(1)  # [B, 1, T]
+    if self.packed_execution:
+      # only embed the real tokens, padding stays zero
+      emb = embeddings_layer.packed_forward(seq, Packing(mask.squeeze(1)), sent_num=src_length.size(-1))
+    else:
+      emb = embeddings_layer(seq, sent_num=src_length.size(-1))
+      emb = emb.transpose(0, 1).contiguous()
 
     return mask, emb
   
@@ -68,60 +94,12 @@ class NMTModel(nn.Module):
 
   def mask_tokens(self, inputs, mlm_probability=0.15, enc_type="tran"):
     # inputs: [bs, seq_len]
-    if enc_type == "tran":
-      embeddings = self.decoder.embeddings
-    elif enc_type == "mlm":
-      embeddings = self.mlm_decoder.embeddings
-    else:
-      embeddings = self.encoder.embeddings
-
-
-    def special_mask(in_l, special_l):
-      return [1 if val in special_l else 0 for val in in_l]
-   
-    labels = inputs.clone() # [bs, seq_len]
-    device = inputs.device
-    probability_matrix = torch.full(labels.shape, mlm_probability)# [bs, seq_len]
-    special_tokens_mask = [special_mask(val, embeddings.special_tokens_idxs) for val in labels.tolist()] #[bs, seq_len]
-
-    special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
-
-    probability_matrix.masked_fill_(special_tokens_mask, value=0.0) # [bs, seq_len]
-    masked_indices = torch.bernoulli(probability_matrix).bool()
-    labels[~masked_indices] = embeddings.word_padding_idx  # We only compute loss on masked tokens
-    
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
-    inputs[indices_replaced] = embeddings.mask_word_idx
-
-    # 10% of the time, we replace masked input tokens with random word
-    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-    random_words = torch.randint(embeddings.word_vocab_size, labels.shape, dtype=torch.long, device=device)
-    indices_random.to(device)
-    inputs[indices_random] = random_words[indices_random]
-
-    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+    inputs, labels = self.corruption[enc_type](inputs, mlm_probability)
     return inputs.transpose(0, 1).contiguous(), labels.transpose(0, 1).contiguous()
   
   def noisy_input(self, inputs, noise_prob=0.15):
-    embeddings = self.mlm_decoder.embeddings
-    
-    def special_mask(in_l, special_l):
-      return [1 if val in special_l else 0 for val in in_l]
-   
-    labels = inputs.clone() # [bs, seq_len]
-    device = inputs.device
-    probability_matrix = torch.full(labels.shape, noise_prob)# [bs, seq_len]
-    special_tokens_mask = [special_mask(val, embeddings.special_tokens_idxs) for val in labels.tolist()] #[bs, seq_len]
-
-    special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
-
-    probability_matrix.masked_fill_(special_tokens_mask, value=0.0) # [bs, seq_len]
-    noise_indices = torch.bernoulli(probability_matrix).bool()
-    random_words = torch.randint(embeddings.word_vocab_size, labels.shape, dtype=torch.long, device=device)
-    inputs[noise_indices] = random_words[noise_indices]
-
-    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+    # every selected token is replaced by a random word
+    inputs, _ = self.corruption['mlm'](inputs, noise_prob, mask_ratio=0.0, random_ratio=1.0)
     return inputs
 
   def forward(self, src, tgt, tgt_tran=None, src_lengths=None, only_nmt=False):
@@ -238,16 +216,46 @@ def build_decoder(opt, embeddings):
 def load_test_model(opt, dummy_opt, model_path=None):
   if model_path is None:
     model_path = opt.models[0]
-  checkpoint = torch.load(model_path,
-                        map_location=lambda storage, loc: storage)
-  model_opt = checkpoint['opt']
+  quantize = opt.quantize != 'none'
+  if quantize and use_gpu(opt):
+    raise AssertionError("int8 quantized models only run on cpu")
+  if quantize and opt.quantized_cache:
+    cache = load_quantized(opt.quantized_cache, model_path, opt.quantize_embeddings)
+    if cache is not None:
+      logger.info('Loading quantized model from %s' % opt.quantized_cache)
+      model, model_opt = cache['model'], cache['opt']
+      fields = load_fields_from_vocab(cache['vocab'], model_opt, opt.tgt_tran)
+      model_opt.packed_execution = opt.packed_execution
+      for module in model.modules():
+        if hasattr(module, 'packed_execution'):
+          module.packed_execution = opt.packed_execution
+      return fields, model, model_opt
+
+  if is_artifact(model_path):
+    logger.info('Loading inference artifact %s' % model_path)
+    checkpoint = load_artifact(model_path)
+    model_opt = argparse.Namespace(**checkpoint['opt'])
+    checkpoint['vocab'] = [(k, vocab_from_itos(itos)) for k, itos in checkpoint['vocab'].items()]
+  else:
+    checkpoint = torch.load(model_path,
+                          map_location=lambda storage, loc: storage)
+    model_opt = checkpoint['opt']
   fields = load_fields_from_vocab(checkpoint['vocab'], model_opt, opt.tgt_tran)
   for arg in dummy_opt:
     if arg not in model_opt:
       model_opt.__dict__[arg] = dummy_opt[arg]
+  # execution options are chosen at translation time
+  model_opt.packed_execution = opt.packed_execution
+  model_opt.activation_checkpointing = 'none'
   model = build_base_model(model_opt, fields, use_gpu(opt), checkpoint, model_opt)
   model.eval()
   model.generator.eval()
+  if quantize:
+    logger.info('Quantizing the model to dynamic int8')
+    model = quantize_model(model, embeddings=opt.quantize_embeddings)
+    if opt.quantized_cache:
+      save_quantized(opt.quantized_cache, model, model_opt, checkpoint['vocab'],
+                     embeddings=opt.quantize_embeddings)
   return fields, model, model_opt
 
 
@@ -366,6 +374,7 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None, opt=None, is_train
 
     checkpoint['model'] = \
       {fix_key(k): v for (k, v) in checkpoint['model'].items()}
+    checkpoint['model'] = drop_stale_buffers(checkpoint['model'])
     # end of patch for backward compatibility
     
     
@@ -4,12 +4,30 @@ Implementation of "Attention is All You Need"
 
 import torch
 import torch.nn as nn
-import numpy as np
 
 import onmt
 from onmt.sublayer import PositionwiseFeedForward
+from onmt.packing import Packing
+from onmt.checkpointing import checkpointed_layers, maybe_checkpoint
 
-MAX_SIZE = 5000
+# one causal mask per device, shared by every decoder layer
+_SUBSEQUENT_MASKS = {}
+
+
+def subsequent_mask(size, device):
+  """
+  `[1, size, size]` bool mask, true above the diagonal. The cached mask
+  is grown by doubling, it is not a module buffer so it is neither saved
+  in checkpoints nor duplicated per layer.
+  """
+  key = str(device)
+  mask = _SUBSEQUENT_MASKS.get(key)
+  if mask is None or mask.size(-1) < size:
+    length = size if mask is None else max(size, 2 * mask.size(-1))
+    mask = torch.ones(length, length, dtype=torch.bool, device=device)
+    mask = torch.triu(mask, diagonal=1).unsqueeze(0)
+    _SUBSEQUENT_MASKS[key] = mask
+  return mask[:, :size, :size]
 
 
 class TransformerDecoderLayer(nn.Module):
@@ -83,10 +101,6 @@ class TransformerDecoderLayer(nn.Module):
     if self.gated_auto_src:
       self.gate_module = onmt.sublayer.GateController(d_model)
     
-    mask = self._get_attn_subsequent_mask(MAX_SIZE)
-    # Register self.mask as a buffer in TransformerDecoderLayer, so
-    # it gets TransformerDecoderLayer's cuda behavior automatically.
-    self.register_buffer('mask', mask)
     # create the modules for a glimpse of next translation.
     # self.tgt_next_attn = tgt_next_attn
     # if self.tgt_next_attn > 0:
@@ -96,7 +110,8 @@ class TransformerDecoderLayer(nn.Module):
       
     
   def forward(self, inputs, memory_bank, src_pad_mask, tgt_pad_mask,
-              layer_cache=None, step=None, beam_size=None, auto_trans_bank=None, auto_trans_mask=None, mlm_decoder=False):
+              layer_cache=None, step=None, beam_size=None, auto_trans_bank=None, auto_trans_mask=None, mlm_decoder=False,
+              packing=None, cache_pos=None):
     
     # F of self attention
     def do_masked_self_attn(v, v_mask):
@@ -104,7 +119,8 @@ class TransformerDecoderLayer(nn.Module):
       v_query, attn = self.self_attn(v_norm, v_norm, v_norm,
                                   mask=v_mask,
                                   layer_cache=layer_cache,
-                                  type="self")
+                                  type="self",
+                                  cache_pos=cache_pos)
       self_attn_out = self.drop(v_query) + v # [doc_num*sent_num, 2*seq_len, hidden]
       return self_attn_out, attn
     # F of cross attention
@@ -139,9 +155,11 @@ class TransformerDecoderLayer(nn.Module):
       if mlm_decoder:
         dec_mask = tgt_pad_mask
       else:
-        dec_mask = torch.gt(tgt_pad_mask +
-                            self.mask[:, :tgt_pad_mask.size(-1),
-                                      :tgt_pad_mask.size(-1)], 0)
+        dec_mask = tgt_pad_mask | subsequent_mask(tgt_pad_mask.size(-1),
+                                                  tgt_pad_mask.device)
+    elif cache_pos is not None:
+      # fixed-size cache, the positions after the step are masked
+      dec_mask = tgt_pad_mask
     if self.share_dec_cross_attn:
       auto_cross = src_cross = "share"
     else:
@@ -180,9 +198,16 @@ class TransformerDecoderLayer(nn.Module):
     #   mid, attn = do_cross_attn(memory_bank, query, src_pad_mask)
     
     # do ffnn
-    mid_norm = self.ffn_layer_norm(mid)
-    output = self.feed_forward(mid_norm)
-    output = self.drop(output) + mid
+    def do_ffnn(mid):
+      mid_norm = self.ffn_layer_norm(mid)
+      output = self.feed_forward(mid_norm)
+      return self.drop(output) + mid
+
+    if packing is not None:
+      # position-wise, only run over the real tokens
+      output = packing.apply(do_ffnn, mid)
+    else:
+      output = do_ffnn(mid)
     
     return output, attn, z
       
@@ -261,12 +286,6 @@ class TransformerDecoderLayer(nn.Module):
 
     # return output, attn, z
 
-  def _get_attn_subsequent_mask(self, size):
-    attn_shape = (1, size, size)
-    subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
-    subsequent_mask = torch.from_numpy(subsequent_mask)
-    return subsequent_mask
-
 
 class TransformerDecoder(nn.Module):
   def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings, model_opt):
@@ -278,6 +297,7 @@ class TransformerDecoder(nn.Module):
     # Basic attributes.
     self.decoder_type = 'transformer'
     self.num_layers = num_layers
+    self.packed_execution = model_opt.packed_execution
     self.embeddings = embeddings
     # self.tgt_next_attn = tgt_next_attn
     # Decoder State
@@ -287,11 +307,19 @@ class TransformerDecoder(nn.Module):
     self.transformer_layers = nn.ModuleList(
       [TransformerDecoderLayer(d_model, heads, d_ff, dropout, model_opt=model_opt, layer_idx=i)
        for i in range(num_layers)])
+    self.checkpointed = checkpointed_layers(self.transformer_layers, model_opt)
+    # set by the translator to run the decoding steps through a compiled graph
+    self.compiled_layers = None
 
     self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
-  def init_state(self, src, src_enc, src_mask=None, segment_embeding=None, auto_trans_bank=None, auto_trans_mask=None):
-    """ Init decoder state """
+  def init_state(self, src, src_enc, src_mask=None, segment_index=None, auto_trans_bank=None, auto_trans_mask=None,
+                 cache_len=None):
+    """
+    Init decoder state. With `cache_len`, the self-attention cache of the
+    decoding steps is allocated once for `cache_len` steps, so every step
+    runs with the same shapes.
+    """
     self.state["src"] = src
     self.state["src_enc"] = src_enc
     self.state["src_mask"] = src_mask
@@ -299,7 +327,9 @@ class TransformerDecoder(nn.Module):
     self.state["auto_trans_bank"] = auto_trans_bank
     self.state["auto_trans_mask"] = auto_trans_mask
     
-    self.state["segment_emb"] = segment_embeding
+    # sentence slot of every row, the segment embedding is looked up per step
+    self.state["segment_index"] = segment_index
+    self.state["cache_len"] = cache_len
     self.state["cache"] = None
 
   def map_state(self, fn):
@@ -316,8 +346,8 @@ class TransformerDecoder(nn.Module):
     
     if self.state["src_mask"] is not None:
       self.state["src_mask"] = fn(self.state["src_mask"], 0)
-    if self.state["segment_emb"] is not None:
-      self.state["segment_emb"] = fn(self.state["segment_emb"], 1)
+    if self.state["segment_index"] is not None:
+      self.state["segment_index"] = fn(self.state["segment_index"], 0)
     
     if self.state["auto_trans_mask"] is not None:
       self.state["auto_trans_mask"] = fn(self.state["auto_trans_mask"], 0)
@@ -348,31 +378,76 @@ class TransformerDecoder(nn.Module):
     attns = {"std": []}
 
     # Run the forward pass of the TransformerDecoder.
-
-    emb = self.embeddings(tgt, step=step, sent_num=sent_num)
-    # add the segment embeding during inference
-    if self.state["segment_emb"] is not None:
-      emb = self.state["segment_emb"] + emb
-    
-    assert emb.dim() == 3  # len x batch x embedding_dim
-
-    output = emb.transpose(0, 1).contiguous()
-    src_memory_bank = memory_bank.transpose(0, 1).contiguous()
-
     pad_idx = self.embeddings.word_padding_idx
     src_pad_mask = self.state["src_mask"]  # [B, 1, T_src]
     tgt_pad_mask = tgt_words.data.eq(pad_idx).unsqueeze(1)  # [B, 1, T_tgt]
-    
+    src_memory_bank = memory_bank.transpose(0, 1).contiguous()
+
     auto_trans_bank = self.state["auto_trans_bank"]
     
     if auto_trans_bank is not None:
       auto_trans_bank = auto_trans_bank.transpose(0, 1).contiguous()
     auto_trans_mask = self.state["auto_trans_mask"]
 
+    packing = None
+    if self.packed_execution and step is None:
+      # drop the entirely padded sentence slots, run position-wise
+      # modules over the real target tokens only
+      packing = Packing(tgt_pad_mask.squeeze(1), Packing.non_empty_rows(tgt_pad_mask.squeeze(1)))
+      tgt_pad_mask = packing.select_rows(tgt_pad_mask)
+      src_memory_bank = packing.select_rows(src_memory_bank)
+      src_pad_mask = packing.select_rows(src_pad_mask)
+      if auto_trans_bank is not None:
+        auto_trans_bank = packing.select_rows(auto_trans_bank)
+        auto_trans_mask = packing.select_rows(auto_trans_mask)
+      output = self.embeddings.packed_forward(tgt, packing, sent_num=sent_num)
+    else:
+      emb = self.embeddings(tgt, step=step, sent_num=sent_num)
+      # add the segment embeding during inference
+      if self.state["segment_index"] is not None:
+        emb = self.embeddings.segment_emb(self.state["segment_index"]) + emb
+      
+      assert emb.dim() == 3  # len x batch x embedding_dim
+
+      output = emb.transpose(0, 1).contiguous()
+
+
+    cache_pos = None
+    layers = self._layers
+    if step is not None and self.state["cache_len"]:
+      # the step is passed as a tensor, the layers see the same shapes and
+      # python values at every step
+      positions = torch.arange(self.state["cache_len"], device=tgt.device)
+      tgt_pad_mask = positions.gt(step).view(1, 1, -1)
+      cache_pos = positions[step:step + 1].clone()
+      step = 0
+      # index_select'ed and fresh masks differ in strides only
+      src_pad_mask = src_pad_mask.contiguous()
+      if auto_trans_mask is not None:
+        auto_trans_mask = auto_trans_mask.contiguous()
+      if self.compiled_layers is not None:
+        layers = self.compiled_layers
+
+    output, attn, z = layers(output, src_memory_bank, src_pad_mask, tgt_pad_mask,
+                             step=step, beam_size=beam_size, auto_trans_bank=auto_trans_bank,
+                             auto_trans_mask=auto_trans_mask, mlm_decoder=mlm_decoder,
+                             packing=packing, cache_pos=cache_pos)
+
+    # Process the result and update the attentions.
+    dec_outs = output.transpose(0, 1).contiguous()
+    attn = attn.transpose(0, 1).contiguous()
+
+    attns["std"] = attn
 
+    # TODO change the way attns is returned dict => list or tuple (onnx)
+    return dec_outs, attns, z
+
+  def _layers(self, output, src_memory_bank, src_pad_mask, tgt_pad_mask, step=None, beam_size=None,
+              auto_trans_bank=None, auto_trans_mask=None, mlm_decoder=False, packing=None, cache_pos=None):
     z = 0.0
     for i in range(self.num_layers):
-      output, attn, z = self.transformer_layers[i](
+      output, attn, z = maybe_checkpoint(
+        self.transformer_layers[i], step is None and i in self.checkpointed,
         output,
         src_memory_bank,
         src_pad_mask,
@@ -380,20 +455,17 @@ class TransformerDecoder(nn.Module):
         layer_cache=(
           self.state["cache"]["layer_{}".format(i)]
           if step is not None else None),
-        step=step, beam_size=beam_size, auto_trans_bank=auto_trans_bank, auto_trans_mask=auto_trans_mask, mlm_decoder=mlm_decoder)
+        step=step, beam_size=beam_size, auto_trans_bank=auto_trans_bank, auto_trans_mask=auto_trans_mask, mlm_decoder=mlm_decoder,
+        packing=packing, cache_pos=cache_pos)
       z = z + z
 
     z = z / self.num_layers
-    output = self.layer_norm(output)
-
-    # Process the result and update the attentions.
-    dec_outs = output.transpose(0, 1).contiguous()
-    attn = attn.transpose(0, 1).contiguous()
-
-    attns["std"] = attn
-
-    # TODO change the way attns is returned dict => list or tuple (onnx)
-    return dec_outs, attns, z
+    if packing is not None:
+      output = packing.expand_rows(packing.apply(self.layer_norm, output))
+      attn = packing.expand_rows(attn)
+    else:
+      output = self.layer_norm(output)
+    return output, attn, z
 
   def _init_cache(self, num_layers):
     self.state["cache"] = {}
@@ -5,6 +5,8 @@ import torch.nn as nn
 import onmt
 from utils.misc import aeq
 from onmt.sublayer import PositionwiseFeedForward
+from onmt.packing import Packing
+from onmt.checkpointing import checkpointed_layers, maybe_checkpoint
 from builtins import input
 
 
@@ -86,7 +88,8 @@ class TransformerEncoderLayer(nn.Module):
   
   
 
-  def forward(self, inputs, mask, doc_num=None, auto_trans_inputs=None, auto_trans_mask=None):
+  def forward(self, inputs, mask, doc_num=None, auto_trans_inputs=None, auto_trans_mask=None,
+              packing=None, auto_trans_packing=None):
     
     def do_self_attn(inputs, mask):
       input_norm = self.att_layer_norm(inputs)
@@ -95,16 +98,25 @@ class TransformerEncoderLayer(nn.Module):
       inputs = self.dropout(outputs) + inputs
       return inputs
     
-    def do_ctx_attn(inputs, mask):
-      sent_hidden = inputs[:, 0, :].view(doc_num, -1, inputs.size(-1))
+    def do_ctx_attn(inputs, mask, inputs_packing=None):
+      sent_hidden = inputs[:, 0, :]
+      sent_pad = mask[:, :, 0]
+      if inputs_packing is not None:
+        # put the kept rows back into their sentence slots of the documents
+        sent_hidden = inputs_packing.expand_rows(sent_hidden)
+        sent_pad = inputs_packing.expand_rows(sent_pad, fill_value=True)
+      sent_hidden = sent_hidden.view(doc_num, -1, inputs.size(-1))
       # [doc_num, 1, sent_num]
-      sent_mask = mask[:, :, 0].view(doc_num, -1).unsqueeze(1)
+      sent_mask = sent_pad.view(doc_num, -1).unsqueeze(1)
       sent_hidden_norm = self.doc_att_layer_norm(sent_hidden)
       # [doc_num, sent_num, hidden]
       sent_output, _ = self.doc_attn(sent_hidden_norm, sent_hidden_norm, sent_hidden_norm,
                                    mask=sent_mask)
       # [doc_num * sent_num, 1, hidden]
-      sent_output = sent_output.view(inputs.size(0), -1).unsqueeze(1)
+      sent_output = sent_output.view(doc_num * sent_output.size(1), -1)
+      if inputs_packing is not None:
+        sent_output = inputs_packing.select_rows(sent_output)
+      sent_output = sent_output.unsqueeze(1)
       inputs = self.dropout(sent_output) + inputs
       return inputs
 
@@ -127,27 +139,31 @@ class TransformerEncoderLayer(nn.Module):
       final_out = self.dropout(val_out) + query
       return final_out
 
-    def do_ffnn(inputs):
-      input_norm = self.att_layer_norm(inputs)
-      outputs = self.feed_forward(input_norm)
-      # [doc_num*sent_num , seq_len, hidden]
-      inputs = self.dropout(outputs) + inputs
-      return inputs
+    def do_ffnn(inputs, inputs_packing=None):
+      def ffnn(inputs):
+        input_norm = self.att_layer_norm(inputs)
+        outputs = self.feed_forward(input_norm)
+        # [doc_num*sent_num , seq_len, hidden]
+        return self.dropout(outputs) + inputs
+      if inputs_packing is not None:
+        # position-wise, only run over the real tokens
+        return inputs_packing.apply(ffnn, inputs)
+      return ffnn(inputs)
     
 
     inputs = do_self_attn(inputs, mask)
     if self.use_ord_ctx and self.doc_ctx_start:
-      inputs = do_ctx_attn(inputs, mask)
+      inputs = do_ctx_attn(inputs, mask, packing)
       if not self.cross_before or auto_trans_inputs is None:
-        inputs = do_ffnn(inputs)
+        inputs = do_ffnn(inputs, packing)
 
 
     if self.use_auto_trans and auto_trans_inputs is not None:
       auto_trans_inputs = do_self_attn(auto_trans_inputs, auto_trans_mask)
       if self.use_ord_ctx and self.doc_ctx_start:
-        auto_trans_inputs = do_ctx_attn(auto_trans_inputs, auto_trans_mask)
+        auto_trans_inputs = do_ctx_attn(auto_trans_inputs, auto_trans_mask, auto_trans_packing)
         if not self.cross_before:
-          auto_trans_inputs = do_ffnn(auto_trans_inputs)
+          auto_trans_inputs = do_ffnn(auto_trans_inputs, auto_trans_packing)
     
     if self.cross_attn and auto_trans_inputs is not None and self.doc_ctx_start:
       if self.share_enc_cross_attn:
@@ -160,8 +176,8 @@ class TransformerEncoderLayer(nn.Module):
       
     if self.cross_before:
       if auto_trans_inputs is not None:
-        auto_trans_inputs = do_ffnn(auto_trans_inputs)
-      inputs = do_ffnn(inputs)
+        auto_trans_inputs = do_ffnn(auto_trans_inputs, auto_trans_packing)
+      inputs = do_ffnn(inputs, packing)
       
     
     return inputs, auto_trans_inputs
@@ -201,6 +217,7 @@ class TransformerEncoder(nn.Module):
                dropout, embeddings, model_opt=None):
     super(TransformerEncoder, self).__init__()
     self.cross_out_encoder = model_opt.cross_out_encoder
+    self.packed_execution = model_opt.packed_execution
     # self.paired_trans = paired_trans
     self.num_layers = num_layers
     self.embeddings = embeddings
@@ -208,6 +225,7 @@ class TransformerEncoder(nn.Module):
     self.transformer = nn.ModuleList(
       [TransformerEncoderLayer(d_model, heads, d_ff, dropout, model_opt=model_opt, layer_idx=i)
        for i in range(num_layers)])
+    self.checkpointed = checkpointed_layers(self.transformer, model_opt)
     
     if self.cross_out_encoder:
       self.cross_attn_layer_norm = nn.LayerNorm(d_model, eps=1e-6)
@@ -269,6 +287,8 @@ class TransformerEncoder(nn.Module):
     # src: (src_seq_len, batch_size)
     
     self._check_args(src)
+    if self.packed_execution:
+      return self._packed_forward(src, src_length, auto_trans_emb, auto_trans_mask, only_trans_encoding)
     padding_idx = self.embeddings.word_padding_idx
     emb = self.embeddings(src, sent_num=src_length.size(-1))
     out = emb.transpose(0, 1).contiguous()
@@ -277,11 +297,14 @@ class TransformerEncoder(nn.Module):
     mask = words.data.eq(padding_idx).unsqueeze(1)  # [B, 1, T]
     # Run the forward pass of every layer of the transformer.
     for i in range(self.num_layers):
+      layer_checkpoint = i in self.checkpointed
       if only_trans_encoding:
-        out, auto_trans_out = self.transformer[i](auto_trans_out, auto_trans_mask, src_length.size(0), None, None)
+        out, auto_trans_out = maybe_checkpoint(self.transformer[i], layer_checkpoint,
+                                               auto_trans_out, auto_trans_mask, src_length.size(0), None, None)
         auto_trans_out = out
       else:
-        out, auto_trans_out = self.transformer[i](out, mask, src_length.size(0), auto_trans_out, auto_trans_mask)
+        out, auto_trans_out = maybe_checkpoint(self.transformer[i], layer_checkpoint,
+                                               out, mask, src_length.size(0), auto_trans_out, auto_trans_mask)
     
     if self.cross_out_encoder and not only_trans_encoding:
       out, auto_trans_out = self.outer_cross_attn(out, auto_trans_out, mask, auto_trans_mask)
@@ -299,6 +322,53 @@ class TransformerEncoder(nn.Module):
     # else:
     return emb, out.transpose(0, 1).contiguous(), mask, auto_trans_out
 
+  def _packed_forward(self, src, src_length, auto_trans_emb=None, auto_trans_mask=None, only_trans_encoding=False):
+    """
+    Same as `forward`, but the entirely padded sentence slots are dropped and
+    the position-wise modules only run over the real tokens.
+    """
+    padding_idx = self.embeddings.word_padding_idx
+    doc_num = src_length.size(0)
+    words = src.transpose(0, 1)
+    mask = words.data.eq(padding_idx).unsqueeze(1)  # [B, 1, T]
+    rows = Packing.non_empty_rows(
+      mask.squeeze(1), None if auto_trans_mask is None else auto_trans_mask.squeeze(1))
+    packing = Packing(mask.squeeze(1), rows)
+    # [rows, seq_len, hidden]
+    out = self.embeddings.packed_forward(src, packing, sent_num=src_length.size(-1))
+    emb = packing.expand_rows(out).transpose(0, 1)
+    out_mask = packing.select_rows(mask)
+    auto_trans_out, auto_trans_packing, out_auto_trans_mask = None, None, None
+    if auto_trans_emb is not None:
+      auto_trans_packing = Packing(auto_trans_mask.squeeze(1), rows)
+      auto_trans_out = auto_trans_packing.select_rows(auto_trans_emb)
+      out_auto_trans_mask = auto_trans_packing.select_rows(auto_trans_mask)
+
+    for i in range(self.num_layers):
+      layer_checkpoint = i in self.checkpointed
+      if only_trans_encoding:
+        out, auto_trans_out = maybe_checkpoint(self.transformer[i], layer_checkpoint,
+                                               auto_trans_out, out_auto_trans_mask, doc_num, None, None,
+                                               packing=auto_trans_packing)
+        auto_trans_out = out
+      else:
+        out, auto_trans_out = maybe_checkpoint(self.transformer[i], layer_checkpoint,
+                                               out, out_mask, doc_num, auto_trans_out, out_auto_trans_mask,
+                                               packing=packing, auto_trans_packing=auto_trans_packing)
+
+    if only_trans_encoding:
+      packing = auto_trans_packing
+    if self.cross_out_encoder and not only_trans_encoding:
+      out, auto_trans_out = self.outer_cross_attn(out, auto_trans_out, out_mask, out_auto_trans_mask)
+
+    out = packing.apply(self.layer_norm, out)
+    out = packing.expand_rows(out)  # [doc_num * sent_num, seq_len, hidden]
+    if auto_trans_out is not None:
+      auto_trans_out = auto_trans_packing.apply(self.layer_norm, auto_trans_out)
+      auto_trans_out = auto_trans_packing.expand_rows(auto_trans_out).transpose(0, 1).contiguous()
+
+    return emb, out.transpose(0, 1).contiguous(), mask, auto_trans_out
+
 
 
 
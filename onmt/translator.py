@@ -8,6 +8,9 @@ import onmt.transformer as nmt_model
 from inputters.dataset import build_dataset, OrderedIterator, make_features
 from onmt.beam import Beam
 from utils.misc import tile
+from utils.precision import Precision
+from onmt.compilation import Compiled, bucket, pad_to_bucket
+from onmt.shortlist import Shortlist
 import onmt.constants as Constants 
 import time
 from tkinter import _flatten
@@ -30,6 +33,19 @@ class Translator(object):
     self.gpu = opt.gpu
     self.cuda = opt.gpu > -1
     self.device = torch.device('cuda' if self.cuda else 'cpu')
+    self.precision = Precision(opt.precision, self.device.type)
+    # lengths are padded to multiples of compile_bucket to bound the
+    # number of compiled graphs
+    self.compile_bucket = opt.compile_bucket if opt.compile else 1
+    if opt.compile:
+      self.encoder = Compiled(self.model.encoder, "encoder")
+      self.model.decoder.compiled_layers = Compiled(self.model.decoder._layers, "decoder step")
+    else:
+      self.encoder = self.model.encoder
+    if opt.shortlist:
+      self.shortlist = Shortlist.from_opt(opt, fields, self.device)
+    else:
+      self.shortlist = None
     self.decode_extra_length = opt.decode_extra_length
     self.decode_min_length = opt.decode_min_length
     self.beam_size = opt.beam_size
@@ -254,14 +270,17 @@ class Translator(object):
       else:
         tgt_tran = None
       # F-prop through the model.
-      with torch.no_grad():
+      with torch.no_grad(), self.precision.autocast():
         outputs, attns, mlm_outputs, mlm_labels = self.model(src, tgt, tgt_tran, src_lengths)
+        word_padding_idx = self.model.decoder.embeddings.word_padding_idx
         bottled_output = outputs.view(-1, outputs.size(2)) # [token_num, hidden]
-        scores = self.model.generator(bottled_output) # [token_num, vocab_size]
-        truth_idx = tgt[1:].view(-1).unsqueeze(1)
-        truth_scores = scores.gather(index=truth_idx, dim=-1) # [token_num, 1]
+        truth_idx = tgt[1:].contiguous().view(-1).unsqueeze(1)
+        # only run the generator over the real target tokens
+        non_pad_idx = truth_idx.squeeze(1).ne(word_padding_idx).nonzero().squeeze(1)
+        scores = self.model.generator(bottled_output[non_pad_idx]).float() # [non_pad_num, vocab_size]
+        truth_scores = scores.new_zeros(truth_idx.size(0), 1)
+        truth_scores[non_pad_idx] = scores.gather(index=truth_idx[non_pad_idx], dim=-1) # [token_num, 1]
         truth_scores = truth_scores.view(tgt[1:].size(0), tgt[1:].size(1)).transpose(0, 1) # [bs, seq_len]
-        word_padding_idx = self.model.decoder.embeddings.word_padding_idx
         mask_scores = tgt[1:] != word_padding_idx
         mask_scores = mask_scores.float().transpose(0, 1)
         all_truth_scores = ((-truth_scores) * mask_scores).sum(dim=1) # [batch_size]
@@ -308,18 +327,23 @@ class Translator(object):
         # dec_seq: (1, batch_size * beam_size)
         dec_output, *_ = self.model.decoder(dec_seq, step=len_dec_seq)
         # dec_output: (1, batch_size * beam_size, hid_size)
-        word_prob = self.model.generator(dec_output.squeeze(0))
-        # word_prob: (batch_size * beam_size, vocab_size)
+        if shortlist is not None:
+          word_prob, vocab_ids = self.shortlist.log_probs(self.model.generator, shortlist, dec_output.squeeze(0))
+        else:
+          word_prob, vocab_ids = self.model.generator(dec_output.squeeze(0)), None
+        # beam scores are accumulated in fp32
+        word_prob = word_prob.float()
+        # word_prob: (batch_size * beam_size, vocab_size or shortlist_size)
         word_prob = word_prob.view(n_active_inst, n_bm, -1)
-        # word_prob: (batch_size, beam_size, vocab_size)
+        # word_prob: (batch_size, beam_size, vocab_size or shortlist_size)
 
-        return word_prob
+        return word_prob, vocab_ids
 
-      def collect_active_inst_idx_list(inst_beams, word_prob, inst_idx_to_position_map):
+      def collect_active_inst_idx_list(inst_beams, word_prob, vocab_ids, inst_idx_to_position_map):
         active_inst_idx_list = []
         select_indices_array = []
         for inst_idx, inst_position in inst_idx_to_position_map.items():
-          is_inst_complete = inst_beams[inst_idx].advance(word_prob[inst_position])
+          is_inst_complete = inst_beams[inst_idx].advance(word_prob[inst_position], vocab_ids)
           if not is_inst_complete:
             active_inst_idx_list += [inst_idx]
             select_indices_array.append(inst_beams[inst_idx].get_current_origin() + inst_position * n_bm)
@@ -333,11 +357,11 @@ class Translator(object):
 
       dec_seq = prepare_beam_dec_seq(inst_dec_beams)
       # dec_seq: (1, batch_size * beam_size)
-      word_prob = predict_word(dec_seq, n_active_inst, n_bm, len_dec_seq)
+      word_prob, vocab_ids = predict_word(dec_seq, n_active_inst, n_bm, len_dec_seq)
 
       # Update the beam with predicted word prob information and collect incomplete instances
       active_inst_idx_list, select_indices = collect_active_inst_idx_list(
-        inst_dec_beams, word_prob, inst_idx_to_position_map)
+        inst_dec_beams, word_prob, vocab_ids, inst_idx_to_position_map)
       
       if select_indices is not None:
         assert len(active_inst_idx_list) > 0
@@ -369,33 +393,43 @@ class Translator(object):
         
       return hyps, scores
 
-    with torch.no_grad():
+    with torch.no_grad(), self.precision.autocast():
       #-- Encode
       src_seq = make_features(batch, 'src')
       src_lengths = batch.src[-1]
+      src_len = src_seq.size(0)
+      src_seq = pad_to_bucket(src_seq, self.model.encoder.embeddings.word_padding_idx, self.compile_bucket)
       # src: (seq_len_src, batch_size)
       if self.segment_embedding:
-        # 1, sent_num*doc_num, hidden
-        tgt_seg_emb = self.model.decoder.embeddings.get_seg_emb(sent_num=src_lengths.size(-1), doc_num=src_lengths.size(0), seq_len=1)
+        # sent_num*doc_num
+        tgt_seg_index = self.model.decoder.embeddings.segment_index(src_lengths.size(-1), src_lengths.size(0), device=src_seq.device)
       else:
-        tgt_seg_emb = None
+        tgt_seg_index = None
       # src_emb, src_enc, src_mask = self.model.encoder(src_seq, batch.src[-1])
       
 
       if self.use_auto_trans:
         tgt_tran = make_features(batch, 'tgt_tran')
+        tgt_tran = pad_to_bucket(tgt_tran, self.model.decoder.embeddings.word_padding_idx, self.compile_bucket)
         tgt_tran_mask, tgt_tran_emb = self.model.get_embeding_and_mask_before_encoding(self.model.decoder.embeddings, tgt_tran, src_lengths)
         if self.only_fixed:
           encode_tran_only = True
         else:
           encode_tran_only = False
         
-        _, memory_bank, enc_mask, auto_trans_out = self.model.encoder(src_seq, src_length=src_lengths, auto_trans_emb=tgt_tran_emb, auto_trans_mask=tgt_tran_mask, only_trans_encoding=encode_tran_only)
+        _, memory_bank, enc_mask, auto_trans_out = self.encoder(src_seq, src_length=src_lengths, auto_trans_emb=tgt_tran_emb, auto_trans_mask=tgt_tran_mask, only_trans_encoding=encode_tran_only)
         
       if not self.use_auto_trans:
-        _, memory_bank, enc_mask, _ = self.model.encoder(src_seq, src_length=src_lengths)
+        _, memory_bank, enc_mask, _ = self.encoder(src_seq, src_length=src_lengths)
         tgt_tran_mask, auto_trans_out = None, None
 
+      # output layer rows of the batch shortlist
+      if self.shortlist is not None:
+        vocab_ids = self.shortlist.vocab_ids(src_seq, tgt_tran if self.use_auto_trans else None)
+        shortlist = self.shortlist.restrict(self.model.generator, vocab_ids)
+      else:
+        shortlist = None
+
 
       # if self.use_auto_trans:
       #   tgt_tran = make_features(batch, 'tgt_tran')
@@ -408,32 +442,51 @@ class Translator(object):
 
       # src_emb: (seq_len_src, batch_size, emb_size)
       # src_enc: (seq_len_src, batch_size, hid_size)
+      decode_length = src_len + self.decode_extra_length
+      # compiled decoding steps run over a self-attention cache of fixed size
+      cache_len = bucket(decode_length, self.compile_bucket) if self.model.decoder.compiled_layers is not None else None
       if self.only_fixed:
-        self.model.decoder.init_state(tgt_tran, auto_trans_out, tgt_tran_mask, segment_embeding=tgt_seg_emb)
+        self.model.decoder.init_state(tgt_tran, auto_trans_out, tgt_tran_mask, segment_index=tgt_seg_index,
+                                      cache_len=cache_len)
       else:
-        self.model.decoder.init_state(src_seq, memory_bank, enc_mask, segment_embeding=tgt_seg_emb, auto_trans_bank=auto_trans_out, auto_trans_mask=tgt_tran_mask)
-      # self.model.decoder.init_state(src_seq, memory_bank, enc_mask, segment_embeding=tgt_seg_emb)
-      src_len = src_seq.size(0)
+        self.model.decoder.init_state(src_seq, memory_bank, enc_mask, segment_index=tgt_seg_index, auto_trans_bank=auto_trans_out, auto_trans_mask=tgt_tran_mask,
+                                      cache_len=cache_len)
+      # self.model.decoder.init_state(src_seq, memory_bank, enc_mask, segment_index=tgt_seg_index)
       
-      #-- Repeat data for beam search
       n_bm = self.beam_size
       n_inst = src_seq.size(1)
-      self.model.decoder.map_state(lambda state, dim: tile(state, n_bm, dim=dim))
-      # src_enc: (seq_len_src, batch_size * beam_size, hid_size)
-      
+
       #-- Prepare beams
-      decode_length = src_len + self.decode_extra_length
       decode_min_length = 0
       if self.decode_min_length >= 0:
         decode_min_length = src_len - self.decode_min_length
       inst_dec_beams = [Beam(n_bm, decode_length=decode_length, minimal_length=decode_min_length, minimal_relative_prob=self.minimal_relative_prob, bos_id=self.tgt_bos_id, eos_id=self.tgt_eos_id, device=self.device) for _ in range(n_inst)]
       
       #-- Bookkeeping for active or not
-      active_inst_idx_list = list(range(n_inst))
+      # Sentence slots which only pad the documents to the same number of
+      # sentences are finished from the start. They have been encoded for
+      # the document context, but are dropped from the decoder state.
+      padded_slots = src_seq.eq(self.model.encoder.embeddings.word_padding_idx).all(0).tolist()
+      active_inst_idx_list = []
+      for inst_idx in range(n_inst):
+        if padded_slots[inst_idx]:
+          inst_dec_beams[inst_idx].finish()
+        else:
+          active_inst_idx_list.append(inst_idx)
+      if len(active_inst_idx_list) < n_inst:
+        active_inst_idx = torch.LongTensor(active_inst_idx_list).to(self.device)
+        self.model.decoder.map_state(
+            lambda state, dim: state.index_select(dim, active_inst_idx))
       inst_idx_to_position_map = get_inst_idx_to_tensor_position_map(active_inst_idx_list)
+
+      #-- Repeat data for beam search
+      self.model.decoder.map_state(lambda state, dim: tile(state, n_bm, dim=dim))
+      # src_enc: (seq_len_src, batch_size * beam_size, hid_size)
       
       #-- Decode
       for len_dec_seq in range(0, decode_length):
+        if not active_inst_idx_list:
+          break  # all instances are padded sentence slots
         active_inst_idx_list = beam_decode_step(
           inst_dec_beams, len_dec_seq, inst_idx_to_position_map, n_bm)
         
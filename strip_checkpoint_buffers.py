@@ -0,0 +1,29 @@
+import argparse
+import os
+import torch
+
+from onmt.transformer import drop_stale_buffers
+
+
+def main(args):
+  for path in args.checkpoints:
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    n_keys = len(checkpoint['model'])
+    checkpoint['model'] = drop_stale_buffers(checkpoint['model'])
+    n_dropped = n_keys - len(checkpoint['model'])
+    if args.in_place:
+      out_path = path
+    else:
+      root, ext = os.path.splitext(path)
+      out_path = root + args.suffix + ext
+    torch.save(checkpoint, out_path)
+    print("{}: dropped {} buffers, saved to {}".format(path, n_dropped, out_path))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Remove the causal mask and position table buffers from old checkpoints")
+  parser.add_argument("checkpoints", nargs='+', help="checkpoint files (*.pt)")
+  parser.add_argument("--in_place", action='store_true', help="overwrite the checkpoints instead of writing copies")
+  parser.add_argument("--suffix", type=str, default="_stripped", help="suffix of the copies when not in place")
+  args = parser.parse_args()
+  main(args)
@@ -5,8 +5,10 @@
 
 import configargparse
 
+import copy
 import os
 import random
+import threading
 import torch
 import torch.nn as nn
 import onmt.opts as opts
@@ -14,8 +16,10 @@ import onmt.opts as opts
 from inputters.dataset import build_dataset_iter, load_dataset, save_fields_to_vocab, load_fields
 from onmt.transformer import build_model
 from utils.optimizers import build_optim
+from utils.ema import build_moving_average
 from trainer import build_trainer
 from utils.logging import init_logger, logger
+from utils.misc import use_gpu
 
 from collections import deque
 
@@ -52,7 +56,7 @@ def training_opt_postprocessing(opt, device_id):
     # unless you tell it to be deterministic
     torch.backends.cudnn.deterministic = True
 
-  if device_id >= 0:
+  if device_id >= 0 and use_gpu(opt):
     torch.cuda.set_device(device_id)
     if opt.seed > 0:
       # These ensure same initialization in multi gpu mode
@@ -99,11 +103,16 @@ def main(opt, device_id):
   # Build optimizer.
   optim = build_optim(model, opt, checkpoint)
 
+  # Build the moving average of the weights
+  moving_average = build_moving_average(model, opt)
+
   # Build model saver
-  model_saver = build_model_saver(model_opt, opt, model, fields, optim)
+  model_saver = build_model_saver(model_opt, opt, model, fields, optim,
+                                  moving_average)
 
   trainer = build_trainer(opt, device_id, model, fields,
-                          optim, model_saver=model_saver)
+                          optim, model_saver=model_saver,
+                          moving_average=moving_average)
   
   def train_iter_fct(): 
     return build_dataset_iter(load_dataset("train", opt), fields, opt)
@@ -118,21 +127,59 @@ def main(opt, device_id):
     logger.info('Starting training on CPU, could be very slow')
   trainer.train(train_iter_fct, valid_iter_fct, opt.train_steps,
                 opt.valid_steps)
+  model_saver.wait()
 
   if opt.tensorboard:
     trainer.report_manager.tensorboard_writer.close()
+  if trainer.report_manager.metrics_file is not None:
+    trainer.report_manager.metrics_file.close()
 
 
-def build_model_saver(model_opt, opt, model, fields, optim):
+def build_model_saver(model_opt, opt, model, fields, optim, moving_average=None):
     model_saver = ModelSaver(opt.save_model,
                              model,
                              model_opt,
                              fields,
                              optim,
                              opt.save_checkpoint_steps,
-                             opt.keep_checkpoint)
+                             opt.keep_checkpoint,
+                             opt.async_save,
+                             moving_average)
     return model_saver
-    
+
+
+def snapshot_to_cpu(obj, buffers, copies=None):
+    """
+    A copy of `obj` whose tensors are CPU copies, in the `buffers` of the
+    previous save when they still fit, pinned for CUDA tensors. Tensors sharing
+    their memory (tied weights, parameters and their state dict entries)
+    share their copy.
+    """
+    if copies is None:
+        copies = {}
+    if isinstance(obj, torch.Tensor):
+        key = (obj.data_ptr() if obj.numel() else id(obj), obj.dtype,
+               obj.size(), obj.stride())
+        if key not in copies:
+            buffer = buffers.get(key)
+            if buffer is None:
+                buffer = torch.empty(obj.size(), dtype=obj.dtype,
+                                     pin_memory=obj.is_cuda)
+            copies[key] = buffer.copy_(obj.detach(), non_blocking=obj.is_cuda)
+        return copies[key]
+    if isinstance(obj, dict):
+        # keeps the dict type, `_metadata` of state dicts and default factories
+        snapshot = copy.copy(obj)
+        snapshot.clear()
+        for k, v in obj.items():
+            snapshot[snapshot_to_cpu(k, buffers, copies)] = \
+                snapshot_to_cpu(v, buffers, copies)
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v, buffers, copies) for v in obj)
+    return obj
+
+
 class ModelSaver(object):
     """
         Base class for model saving operations
@@ -142,7 +189,8 @@ class ModelSaver(object):
     """
 
     def __init__(self, base_path, model, model_opt, fields, optim,
-                 save_checkpoint_steps, keep_checkpoint=-1):
+                 save_checkpoint_steps, keep_checkpoint=-1, async_save=False,
+                 moving_average=None):
         self.base_path = base_path
         self.model = model
         self.model_opt = model_opt
@@ -150,10 +198,20 @@ class ModelSaver(object):
         self.optim = optim
         self.keep_checkpoint = keep_checkpoint
         self.save_checkpoint_steps = save_checkpoint_steps
+        self.async_save = async_save
+        self.moving_average = moving_average
 
         if keep_checkpoint > 0:
             self.checkpoint_queue = deque([], maxlen=keep_checkpoint)
 
+        # the vocabulary does not change during training
+        self.vocab = None
+        # CPU copies of the last checkpoint, reused by the next one
+        self.buffers = {}
+        self.writer = None
+        self.write_error = None
+        self.pending = None
+
     def maybe_save(self, step):
         """
         Main entry point for model saver
@@ -166,7 +224,28 @@ class ModelSaver(object):
         if step % self.save_checkpoint_steps != 0:
             return
 
+        # one checkpoint written at a time, its buffers are reused
+        self.wait()
         chkpt, chkpt_name = self._save(step)
+        self.pending = chkpt_name
+        if not self.async_save:
+            self.wait()
+
+    def wait(self):
+        """
+        Waits for the checkpoint being written, then applies
+        `keep_checkpoint`: only fully written checkpoints enter the queue, so
+        only those are ever removed.
+        """
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        chkpt_name, self.pending = self.pending, None
+        if self.write_error is not None:
+            error, self.write_error = self.write_error, None
+            raise error
+        if chkpt_name is None:
+            return
 
         if self.keep_checkpoint > 0:
             if len(self.checkpoint_queue) == self.checkpoint_queue.maxlen:
@@ -191,22 +270,76 @@ class ModelSaver(object):
                           if isinstance(real_model.generator, nn.DataParallel)
                           else real_model.generator)
 
+        # the asynchronous writer gets CPU copies of the state dicts and
+        # training goes on as soon as the copies are queued on the device
+        copies = {}
+        def snapshot(state):
+            if not self.async_save:
+                return state
+            return snapshot_to_cpu(state, self.buffers, copies)
+
         model_state_dict = real_model.state_dict()
         model_state_dict = {k: v for k, v in model_state_dict.items()
                             if 'generator' not in k}
         generator_state_dict = real_generator.state_dict()
+        if self.vocab is None:
+            self.vocab = save_fields_to_vocab(self.fields)
         checkpoint = {
-            'model': model_state_dict,
-            'generator': generator_state_dict,
-            'vocab': save_fields_to_vocab(self.fields),
+            'model': snapshot(model_state_dict),
+            'generator': snapshot(generator_state_dict),
+            'vocab': self.vocab,
             'opt': self.model_opt,
-            'optim': self.optim,
+            'optim': self.optim.saved(snapshot),
         }
 
         logger.info("Saving checkpoint %s_step_%d.pt" % (self.base_path, step))
         checkpoint_path = '%s_step_%d.pt' % (self.base_path, step)
-        torch.save(checkpoint, checkpoint_path)
-        return checkpoint, checkpoint_path
+        checkpoints = [(checkpoint, checkpoint_path)]
+        if self.moving_average is not None:
+            # weights for translation, without the optimizer
+            ema_state_dict = self.moving_average.state_dict(real_model)
+            ema_checkpoint = {
+                'model': snapshot({k: v for k, v in ema_state_dict.items()
+                                   if 'generator' not in k}),
+                'generator': snapshot(self.moving_average.state_dict(real_generator)),
+                'vocab': self.vocab,
+                'opt': self.model_opt,
+            }
+            checkpoints.append((ema_checkpoint, self._ema_path(checkpoint_path)))
+
+        if not self.async_save:
+            self._write(checkpoints)
+            return checkpoint, checkpoint_path
+
+        self.buffers = copies
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self.writer = threading.Thread(
+            target=self._write_async, args=(checkpoints, copied))
+        self.writer.start()
+        return checkpoints[0]
+
+    @staticmethod
+    def _ema_path(checkpoint_path):
+        return checkpoint_path[:-len('.pt')] + '.ema.pt'
+
+    def _write(self, checkpoints):
+        """ Writes each (checkpoint, path) to a temporary file renamed once complete """
+        for checkpoint, checkpoint_path in checkpoints:
+            tmp_path = checkpoint_path + '.tmp'
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, checkpoint_path)
+
+    def _write_async(self, checkpoints, copied):
+        try:
+            if copied is not None:
+                copied.synchronize()
+            self._write(checkpoints)
+        except Exception as e:
+            logger.error("Saving checkpoint %s failed" % checkpoints[0][1])
+            self.write_error = e
 
     def _rm_checkpoint(self, name):
         """
@@ -217,6 +350,8 @@ class ModelSaver(object):
                 (it may be a filepath)
         """
         os.remove(name)
+        if os.path.exists(self._ema_path(name)):
+            os.remove(self._ema_path(name))
 
 if __name__ == "__main__":
   parser = configargparse.ArgumentParser(
@@ -14,12 +14,18 @@ from utils.loss import build_loss_compute
 from utils.logging import logger
 from utils.report_manager import build_report_manager
 from utils.statistics import Statistics
-from utils.distributed import all_gather_list, all_reduce_and_rescale_tensors
+from utils.precision import Precision
+from utils.teacher_cache import TeacherCache, example_ids
+from utils.profiling import PhaseTimer
+from utils.distributed import all_reduce_and_rescale_tensors, build_ddp_model
+from utils.misc import use_gpu
 from inputters.dataset import make_features
+import onmt.constants as Constants
+import contextlib
 import torch
 
 def build_trainer(opt, device_id, model, fields,
-                  optim, model_saver=None, mlm_model=None):
+                  optim, model_saver=None, mlm_model=None, moving_average=None):
   """
   Simplify `Trainer` creation based on user `opt`s*
 
@@ -30,6 +36,8 @@ def build_trainer(opt, device_id, model, fields,
       optim (:obj:`onmt.utils.Optimizer`): optimizer used during training
       model_saver(:obj:`onmt.models.ModelSaverBase`): the utility object
           used to save the model
+      moving_average(:obj:`utils.ema.MovingAverage`): average of the
+          weights updated after each optimizer step, or None
   """
   train_loss = build_loss_compute(
     model, fields["tgt"].vocab, fields["src"].vocab, opt)
@@ -50,14 +58,42 @@ def build_trainer(opt, device_id, model, fields,
   else:
     gpu_rank = 0
     n_gpu = 0
+  if opt.seed > 0:
+    # a different MLM corruption stream per rank
+    model.seed_corruption(opt.seed + gpu_rank)
   gpu_verbose_level = opt.gpu_verbose_level
+  precision = Precision.from_opt(opt, 'cuda' if use_gpu(opt) else 'cpu')
+  if opt.teacher_cache:
+    teacher_cache = TeacherCache(opt.teacher_cache, opt.teacher_cache_topk)
+  else:
+    teacher_cache = None
+  timer = PhaseTimer.from_opt(opt, 'cuda' if use_gpu(opt) else 'cpu')
+  # the auto-translations share the target vocabulary
+  padding_idxs = {'src': fields["src"].vocab.stoi[Constants.PAD_WORD],
+                  'tgt': fields["tgt"].vocab.stoi[Constants.PAD_WORD],
+                  'tgt_tran': fields["tgt"].vocab.stoi[Constants.PAD_WORD]}
+  train_loss.timer = timer
+  timer.time_modules(model.corruption.values(), 'masking')
+
+  if opt.ddp and n_gpu > 1:
+    ddp_model, unsynced_params = build_ddp_model(
+      model, device_id if use_gpu(opt) else None, opt.ddp_bucket_mb)
+  else:
+    ddp_model, unsynced_params = None, None
 
-  report_manager = build_report_manager(opt)
+  report_manager = build_report_manager(opt, gpu_rank)
   trainer = Trainer(model, train_loss, valid_loss, optim, trunc_size,
                          shard_size, norm_method,
                          grad_accum_count, n_gpu, gpu_rank,
                          gpu_verbose_level, report_manager,
-                         model_saver=model_saver, use_auto_trans=use_auto_trans, mlm_distill=mlm_distill, start_distill_step=start_distill_step, distill_annealing=distill_annealing, mlm_model=mlm_model)
+                         model_saver=model_saver, use_auto_trans=use_auto_trans, mlm_distill=mlm_distill, start_distill_step=start_distill_step, distill_annealing=distill_annealing, mlm_model=mlm_model,
+                         precision=precision, teacher_cache=teacher_cache,
+                         teacher_cache_refresh_steps=opt.teacher_cache_refresh_steps,
+                         distill_topk=opt.distill_topk, ddp_model=ddp_model,
+                         unsynced_params=unsynced_params,
+                         moving_average=moving_average,
+                         average_valid=opt.average_valid, timer=timer,
+                         padding_idxs=padding_idxs)
   return trainer
 
 
@@ -75,7 +111,8 @@ class Trainer(object):
       optim(:obj:`onmt.utils.optimizers.Optimizer`):
          the optimizer responsible for update
       trunc_size(int): length of truncated back propagation through time
-      shard_size(int): compute loss in shards of this size for efficiency
+      shard_size(int): run the generator and loss over chunks of this many
+          target time steps, 0 for all at once
       norm_method(string): normalization methods: [sents|tokens]
       grad_accum_count(int): accumulate gradients this many times.
       report_manager(:obj:`onmt.utils.ReportMgrBase`):
@@ -83,12 +120,35 @@ class Trainer(object):
       model_saver(:obj:`onmt.models.ModelSaverBase`): the saver is
           used to save a checkpoint.
           Thus nothing will be saved if this parameter is None
+      teacher_cache(:obj:`utils.teacher_cache.TeacherCache`): top-k
+          distributions of the frozen MLM teacher read by distillation
+          instead of running `mlm_model`, or None
+      teacher_cache_refresh_steps(int): recompute the cached distributions
+          with the masks of the current student this often, 0 never
+      distill_topk(int): distill from the k best teacher words with the
+          sparse loss, 0 from the full distribution
+      ddp_model(:obj:`DistributedDataParallel`): `model` wrapped to
+          all-reduce the gradients during the backward, or None to
+          all-reduce them all after it
+      unsynced_params(list): parameters `ddp_model` leaves to the
+          all-reduce after the backward
+      moving_average(:obj:`utils.ema.MovingAverage`): average of the
+          weights updated after each optimizer step, or None
+      average_valid(bool): validate with the averaged weights
+      timer(:obj:`utils.profiling.PhaseTimer`): times the phases of the
+          steps, or None
+      padding_idxs(dict): padding index of the `src`, `tgt` and `tgt_tran`
+          batch fields, to count their padding. None to not count it
   """
 
   def __init__(self, model, train_loss, valid_loss, optim,
-               trunc_size=0, shard_size=32,
+               trunc_size=0, shard_size=0,
                norm_method="sents", grad_accum_count=1, n_gpu=1, gpu_rank=1,
-               gpu_verbose_level=0, report_manager=None, model_saver=None, use_auto_trans=0, mlm_distill=False, start_distill_step=100000, distill_annealing=False, mlm_model=None):
+               gpu_verbose_level=0, report_manager=None, model_saver=None, use_auto_trans=0, mlm_distill=False, start_distill_step=100000, distill_annealing=False, mlm_model=None,
+               precision=None, teacher_cache=None, teacher_cache_refresh_steps=0,
+               distill_topk=0, ddp_model=None, unsynced_params=None,
+               moving_average=None, average_valid=False, timer=None,
+               padding_idxs=None):
     # Basic attributes.
     self.model = model
     self.train_loss = train_loss
@@ -108,6 +168,19 @@ class Trainer(object):
     self.start_distill_step = start_distill_step
     self.distill_annealing = distill_annealing
     self.mlm_model = mlm_model
+    self.precision = precision if precision is not None else Precision()
+    self.teacher_cache = teacher_cache
+    self.teacher_cache_refresh_steps = teacher_cache_refresh_steps
+    self.teacher_state = None
+    self.distill_topk = distill_topk
+    self.ddp_model = ddp_model
+    self.unsynced_params = unsynced_params
+    self.moving_average = moving_average
+    self.average_valid = average_valid
+    self.timer = timer if timer is not None else PhaseTimer()
+    self.padding_idxs = padding_idxs
+    # the training forward goes through the DDP wrapper
+    self.train_model = ddp_model if ddp_model is not None else model
     assert grad_accum_count > 0
     if grad_accum_count > 1:
       assert(self.trunc_size == 0), \
@@ -148,6 +221,9 @@ class Trainer(object):
     mlm_report_stats = Statistics()
     self._start_report_manager(start_time=total_stats.start_time)
     freeze_mlm = False
+    refreshed_step = None
+    self.timer.reset()
+    self.timer.maybe_start_profiler(step)
     
     if self.distill_annealing and self.mlm_distill:
       annealing_step = train_steps - self.start_distill_step
@@ -156,7 +232,7 @@ class Trainer(object):
     
     while step <= train_steps:
       reduce_counter = 0
-      for i, batch in enumerate(train_iter):
+      for i, batch in enumerate(self.timer.timed(train_iter, 'data')):
         if self.mlm_distill:
           only_nmt = step > self.start_distill_step
           if only_nmt and self.distill_annealing:
@@ -164,7 +240,15 @@ class Trainer(object):
           else:
             annealing_coef = None  
           # fix the mlm_decoder only for distillation
-          if only_nmt and not freeze_mlm:
+          if only_nmt and not freeze_mlm and self.teacher_cache is not None:
+            self._start_teacher_cache(train_iter_fct)
+            freeze_mlm = True
+          elif only_nmt and self.teacher_cache is not None and self.teacher_cache_refresh_steps > 0 \
+              and (step - self.start_distill_step) % self.teacher_cache_refresh_steps == 0 \
+              and refreshed_step != step:
+            self._build_teacher_cache(train_iter_fct, refresh=True)
+            refreshed_step = step
+          elif only_nmt and not freeze_mlm:
             self.mlm_model.encoder.load_state_dict(self.model.encoder.state_dict())
             self.mlm_model.mlm_decoder.load_state_dict(self.model.mlm_decoder.state_dict())
             self.mlm_model.mlm_generator.load_state_dict(self.model.mlm_generator.state_dict())
@@ -180,15 +264,8 @@ class Trainer(object):
           annealing_coef = 1.0
         
         # if batch is document-level, need to reshape shape of data
-        if len(batch.tgt.shape) > 2:
-          num_doc, num_sents = batch.tgt.size(0), batch.tgt.size(1)
-          batch.src = list(batch.src)
-          batch.src[0] = batch.src[0].view(num_doc * num_sents, -1).transpose(0, 1).contiguous() #(seq_len, sents_num)
-          batch.tgt = batch.tgt.view(num_doc * num_sents, -1).transpose(0, 1).contiguous() #(seq_len, sents_num)
-          batch.src = tuple(batch.src)
-          
-          if self.use_auto_trans:
-            batch.tgt_tran = batch.tgt_tran.view(num_doc * num_sents, -1).transpose(0, 1).contiguous() #(seq_len, sents_num)
+        with self.timer.phase('reshape'):
+          self._flatten_documents(batch)
 
         if self.n_gpu == 0 or (i % self.n_gpu == self.gpu_rank):
           if self.gpu_verbose_level > 1:
@@ -196,11 +273,16 @@ class Trainer(object):
                         % (self.gpu_rank, i, accum))
 
           true_batchs.append(batch)
+          if self.padding_idxs is not None:
+            batch_stats = self._batch_stats(batch)
+            total_stats.update(batch_stats)
+            report_stats.update(batch_stats)
 
           if self.norm_method == "tokens":
+            # a device tensor, read by the loss without a host sync
             num_tokens = batch.tgt[1:].ne(
               self.train_loss.padding_idx).sum()
-            normalization += num_tokens.item()
+            normalization += num_tokens
           else:
             normalization += batch.batch_size
           accum += 1
@@ -220,15 +302,16 @@ class Trainer(object):
               true_batchs, normalization, total_stats,
               report_stats, mlm_total_stats, mlm_report_stats, only_nmt=only_nmt, annealing_coef=annealing_coef)
 
-            report_stats = self._maybe_report_training(
-              step, train_steps,
-              self.optim.learning_rate,
-              report_stats)
             if not only_nmt and self.mlm_distill:
-              mlm_report_stats = self._maybe_report_training(
+              report_stats, mlm_report_stats = self._maybe_report_training(
                 step, train_steps,
                 self.optim.learning_rate,
-                mlm_report_stats)
+                report_stats, mlm_report_stats)
+            else:
+              report_stats, _ = self._maybe_report_training(
+                step, train_steps,
+                self.optim.learning_rate,
+                report_stats)
             
 
             true_batchs = []
@@ -239,26 +322,32 @@ class Trainer(object):
                 logger.info('GpuRank %d: validate step %d'
                               % (self.gpu_rank, step))
               valid_iter = valid_iter_fct()
-              valid_stats, mlm_valid_stats = self.validate(valid_iter)
+              with self.timer.phase('valid'), self._maybe_average_weights():
+                # the MLM decoder is frozen once distillation starts
+                valid_stats, mlm_valid_stats = self.validate(
+                  valid_iter, with_mlm=self.mlm_distill and not only_nmt)
               if self.gpu_verbose_level > 0:
                 logger.info('GpuRank %d: gather valid stat \
                               step %d' % (self.gpu_rank, step))
-              valid_stats = self._maybe_gather_stats(valid_stats)
-              if self.mlm_distill:
-                mlm_valid_stats = self._maybe_gather_stats(mlm_valid_stats)
+              valid_stats, mlm_valid_stats = self._maybe_gather_stats(
+                valid_stats, mlm_valid_stats)
           
               if self.gpu_verbose_level > 0:
                 logger.info('GpuRank %d: report stat step %d'
                               % (self.gpu_rank, step))
               self._report_step(self.optim.learning_rate,
                                 step, valid_stats=valid_stats)
-              if self.mlm_distill:
+              if mlm_valid_stats is not None:
                 self._report_step(self.optim.learning_rate,
-                                  step, valid_stats=mlm_valid_stats)
+                                  step, valid_stats=mlm_valid_stats,
+                                  prefix='mlm_')
             
 
             if self.gpu_rank == 0:
-              self._maybe_save(step)
+              with self.timer.phase('save'):
+                self._maybe_save(step)
+            self.timer.step(step)
+            self._maybe_report_phases(step)
             step += 1
             if step > train_steps:
               break
@@ -269,27 +358,135 @@ class Trainer(object):
 
     return total_stats, mlm_total_stats
 
-  def validate(self, valid_iter):
+  def _flatten_documents(self, batch):
+    """ Reshapes document-level batches to `[seq_len x doc_num * sent_num]` """
+    if len(batch.tgt.shape) > 2:
+      num_doc, num_sents = batch.tgt.size(0), batch.tgt.size(1)
+      batch.src = list(batch.src)
+      batch.src[0] = batch.src[0].view(num_doc * num_sents, -1).transpose(0, 1).contiguous()  # (seq_len, sents_num)
+      batch.tgt = batch.tgt.view(num_doc * num_sents, -1).transpose(0, 1).contiguous()  # (seq_len, sents_num)
+      batch.src = tuple(batch.src)
+      if self.use_auto_trans:
+        batch.tgt_tran = batch.tgt_tran.view(num_doc * num_sents, -1).transpose(0, 1).contiguous() #(seq_len, sents_num)
+
+  def _batch_stats(self, batch):
+    """ Real and padded tokens, documents and sentences of a flattened batch """
+    sides = ['src', 'tgt', 'tgt_tran'] if self.use_auto_trans else ['src', 'tgt']
+    counters, padded = {}, {}
+    for field, side in zip(Statistics.BATCH_FIELDS, sides):
+      data = make_features(batch, side)
+      counters['n_%s_words' % field] = data.ne(self.padding_idxs[side]).sum()
+      padded['n_%s_padded' % field] = data.numel()
+    # the empty sentence slots of the documents are left out
+    counters['n_sents'] = batch.tgt.ne(self.padding_idxs['tgt']).any(0).sum()
+    stats = Statistics.from_tensors(**counters)
+    for name, value in padded.items():
+      setattr(stats, name, value)
+    stats.n_docs = batch.batch_size
+    return stats
+
+  def _start_teacher_cache(self, train_iter_fct):
+    """
+    At `start_distill_step` the model itself is the teacher: its encoder,
+    MLM decoder and generator are kept on cpu for refreshes and the cache
+    is built, unless it exists already.
+    """
+    if self.teacher_cache_refresh_steps > 0:
+      self.teacher_state = {k: v.detach().cpu().clone() for k, v in self.model.state_dict().items()
+                            if k.split('.')[0] in ('encoder', 'mlm_decoder', 'mlm_generator')}
+    if self.teacher_cache.exists():
+      logger.info('Reading the teacher distributions from %s' % self.teacher_cache.path)
+      self.teacher_cache.open()
+    else:
+      self._build_teacher_cache(train_iter_fct)
+
+  def _build_teacher_cache(self, train_iter_fct, refresh=False):
+    """
+    Runs the teacher once over the training data and caches its top-k
+    distributions of all the target tokens. Which tokens the teacher sees
+    masked is chosen by the student, as in live distillation, so a refresh
+    swaps the frozen teacher weights in after the student forward.
+
+    With several processes each one runs the batches of its share, into
+    files of its own or rows of its own of the refreshed copy, and they all
+    read the cache once it is complete. The cache in use is never written
+    to: a refresh is written to a copy that replaces it at the end.
+    """
+    distributed = self.n_gpu > 1
+    logger.info('%s the teacher distributions in %s' %
+                ('Refreshing' if refresh else 'Caching', self.teacher_cache.path))
+    if refresh and self.gpu_rank == 0:
+      self.teacher_cache.prepare_refresh()
+    if refresh and distributed:
+      torch.distributed.barrier()
+    if refresh:
+      device = next(self.model.parameters()).device
+      teacher_state = {k: v.to(device) for k, v in self.teacher_state.items()}
+      student_state = {k: v.detach().clone() for k, v in self.model.state_dict().items()
+                       if k in teacher_state}
+    writer = self.teacher_cache.writer(refresh, self.gpu_rank if distributed else None)
+    self.model.eval()
+    with torch.no_grad(), self.precision.autocast():
+      for batch in train_iter_fct():
+        # the batches are the same in every process, not their order
+        if distributed and example_ids(batch).min() % self.n_gpu != self.gpu_rank:
+          continue
+        self._flatten_documents(batch)
+        src = make_features(batch, 'src')
+        src_lengths = batch.src[-1]
+        tgt = make_features(batch, 'tgt')
+        tgt_tran = make_features(batch, 'tgt_tran') if self.use_auto_trans else None
+        outputs, _, _, _ = self.model(src, tgt, tgt_tran, src_lengths, only_nmt=True)
+        select_prob_mask = self.train_loss.distill_select_mask(outputs, tgt, self.shard_size)
+        if refresh:
+          self.model.load_state_dict(teacher_state, strict=False)
+        mlm_out = self.model.forward_mlm_for_distillation(src, tgt, tgt_tran, src_lengths, mask_id=select_prob_mask)
+        mlm_prob, _ = self.train_loss.only_compute_prob(mlm_out, gen=self.model.mlm_generator)
+        if refresh:
+          self.model.load_state_dict(student_state, strict=False)
+        writer.add(batch, tgt[1:].ne(self.train_loss.padding_idx), mlm_prob)
+    writer.close()
+    if distributed:
+      torch.distributed.barrier()
+    if self.gpu_rank == 0:
+      self.teacher_cache.commit(refresh, self.n_gpu if distributed else 0)
+    if distributed:
+      torch.distributed.barrier()
+    self.teacher_cache.open()
+    self.model.train()
+
+  def _cached_teacher_topk(self, batch, tgt_outer, j, trunc_size):
+    """
+    Cached teacher word ids and log-probabilities `[token_num x k]` of the
+    target tokens `j + 1 .. j + trunc_size - 1`, -inf on padding. k is
+    `distill_topk`, or all the cached entries.
+    """
+    non_pad = tgt_outer[1:].ne(self.train_loss.padding_idx)
+    ids, logp = self.teacher_cache.lookup(batch, non_pad)
+    k = min(self.distill_topk, ids.size(-1)) if self.distill_topk > 0 else ids.size(-1)
+    ids, logp = ids[j:j + trunc_size - 1, :, :k], logp[j:j + trunc_size - 1, :, :k]
+    return ids.reshape(-1, k), logp.reshape(-1, k)
+
+  def validate(self, valid_iter, with_mlm=True):
     """ Validate model.
-        valid_iter: validate data iterator
+        valid_iter: validate data iterator, each process validates its
+            share of the batches
+        with_mlm: also run the MLM decoder and return its statistics
     Returns:
-        :obj:`nmt.Statistics`: validation loss statistics
+        :obj:`nmt.Statistics`: validation loss statistics, and those of the
+        MLM decoder or None
     """
     # Set model in validating mode.
     self.model.eval()
 
     stats = Statistics()
-    mlm_stats = Statistics()
-    for batch in valid_iter:
+    mlm_stats = Statistics() if with_mlm and self.mlm_distill else None
+    for i, batch in enumerate(valid_iter):
+      # the statistics are summed over the processes afterwards
+      if self.n_gpu > 1 and i % self.n_gpu != self.gpu_rank:
+        continue
       # if document-level, need to proprecess batch
-      if len(batch.tgt.shape) > 2:
-        num_doc, num_sents = batch.tgt.size(0), batch.tgt.size(1)
-        batch.src = list(batch.src)
-        batch.src[0] = batch.src[0].view(num_doc * num_sents, -1).transpose(0, 1).contiguous()  # (seq_len, sents_num)
-        batch.tgt = batch.tgt.view(num_doc * num_sents, -1).transpose(0, 1).contiguous()  # (seq_len, sents_num)
-        batch.src = tuple(batch.src)
-        if self.use_auto_trans:
-          batch.tgt_tran = batch.tgt_tran.view(num_doc * num_sents, -1).transpose(0, 1).contiguous() #(seq_len, sents_num)
+      self._flatten_documents(batch)
       src = make_features(batch, 'src')
       if len(batch.src) > 2:
           _, _, src_lengths = batch.src
@@ -303,8 +500,9 @@ class Trainer(object):
       else:
         tgt_tran = None
       # F-prop through the model.
-      with torch.no_grad():
-        outputs, attns, mlm_outputs, mlm_labels = self.model(src, tgt, tgt_tran, src_lengths)
+      with torch.no_grad(), self.precision.autocast():
+        outputs, attns, mlm_outputs, mlm_labels = self.model(
+          src, tgt, tgt_tran, src_lengths, only_nmt=mlm_stats is None)
 
       # Compute loss.
         batch_stats, mlm_batch_stats = self.valid_loss.monolithic_compute_loss(
@@ -324,109 +522,125 @@ class Trainer(object):
   def _gradient_accumulation(self, true_batchs, normalization, total_stats,
                              report_stats, mlm_total_stats, mlm_report_stats, only_nmt=False, annealing_coef=1.0):
       if self.grad_accum_count > 1:
-          self.model.zero_grad()
-      for batch in true_batchs:
-          target_size = batch.tgt.size(0)
-          # Truncated BPTT: reminder not compatible with accum > 1
-          if self.trunc_size:
-              trunc_size = self.trunc_size
-          else:
-              trunc_size = target_size
+          self.optim.zero_grad()
+      for k, batch in enumerate(true_batchs):
+          # only the backward of the last batch communicates
+          with self._maybe_no_sync(k < len(true_batchs) - 1):
+              target_size = batch.tgt.size(0)
+              # Truncated BPTT: reminder not compatible with accum > 1
+              if self.trunc_size:
+                  trunc_size = self.trunc_size
+              else:
+                  trunc_size = target_size
 
-          # dec_state = None
-          src = make_features(batch, 'src')
-          if len(batch.src) > 2:
-              _, _, src_lengths = batch.src
-          else:
-              _, src_lengths = batch.src
-          if self.use_auto_trans:
-            tgt_tran = make_features(batch, 'tgt_tran')
-          else:
-            tgt_tran = None
-          tgt_outer = make_features(batch, 'tgt')
-          for j in range(0, target_size-1, trunc_size):
-              # 1. Create truncated target.
-              tgt = tgt_outer[j: j + trunc_size]
-              # 2. F-prop all but generator.
-              if self.grad_accum_count == 1:
-                  self.model.zero_grad()
-              # only_nmt = self.optim._step > self.mlm_train_step
-              if self.optim.mixed_precision:
-                with torch.cuda.amp.autocast():
-                  outputs, attns, mlm_outputs, mlm_labels = \
-                      self.model(src, tgt, tgt_tran, src_lengths, only_nmt=only_nmt)
+              # dec_state = None
+              src = make_features(batch, 'src')
+              if len(batch.src) > 2:
+                  _, _, src_lengths = batch.src
               else:
-                outputs, attns, mlm_outputs, mlm_labels = \
-                      self.model(src, tgt, tgt_tran, src_lengths, only_nmt=only_nmt)
-              
-              # 3. Compute loss in shards for memory efficiency.
-              if self.optim.mixed_precision:
-                with torch.cuda.amp.autocast():
-                  if only_nmt:
-                    # select_prob_mask: [seq_len, batch_size], nmt_prob: [seq_len * batch_size, vocab_size]
-                    nmt_prob, select_prob_mask = self.train_loss.only_compute_prob(outputs, tgt, select_prob=True)
-                    with torch.no_grad():
-                      mlm_out = self.mlm_model.forward_mlm_for_distillation(src, tgt, tgt_tran, src_lengths, mask_id=select_prob_mask)
-                      mlm_prob, _ = self.train_loss.only_compute_prob(mlm_out, gen=self.mlm_model.mlm_generator)
-                    
-                    batch_stats = self.train_loss.compute_distillation_loss(tgt, nmt_prob, mlm_prob.detach(), select_prob_mask, \
-                                                     normalization, self.optim.scaler, annealing_coef=annealing_coef)
-                    mlm_stats = None
-                  else:
-                    batch_stats, mlm_stats = self.train_loss.sharded_compute_loss(
-                        batch, outputs, attns, j,
-                        trunc_size, self.shard_size, normalization, self.optim.scaler, mlm_outputs, mlm_labels, self.grad_accum_count * self.n_gpu)
+                  _, src_lengths = batch.src
+              if self.use_auto_trans:
+                tgt_tran = make_features(batch, 'tgt_tran')
               else:
-                if only_nmt:
-                  # select_prob_mask: [seq_len, batch_size], nmt_prob: [seq_len * batch_size, vocab_size]
-                  nmt_prob, select_prob_mask = self.train_loss.only_compute_prob(outputs, tgt, select_prob=True)
-                  with torch.no_grad():
-                    outputs = self.mlm_model.forward_mlm_for_distillation(src, tgt, tgt_tran, src_lengths, mask_id=select_prob_mask)
-                    mlm_prob, _ = self.train_loss.only_compute_prob(mlm_out, gen=self.mlm_model.mlm_generator)
-                  
-                  batch_stats = self.train_loss.compute_distillation_loss(tgt, nmt_prob, mlm_prob.detach(), select_prob_mask, \
-                                                    normalization, self.optim.scaler, annealing_coef=annealing_coef)
-                  mlm_stats = None
-                else:
-                  batch_stats, mlm_stats = self.train_loss.sharded_compute_loss(
-                      batch, outputs, attns, j,
-                      trunc_size, self.shard_size, normalization, self.optim.scaler, mlm_outputs, mlm_labels, self.grad_accum_count * self.n_gpu)
+                tgt_tran = None
+              tgt_outer = make_features(batch, 'tgt')
+              for j in range(0, target_size-1, trunc_size):
+                  # 1. Create truncated target.
+                  tgt = tgt_outer[j: j + trunc_size]
+                  # 2. F-prop all but generator.
+                  if self.grad_accum_count == 1:
+                      self.optim.zero_grad()
+                  # only_nmt = self.optim._step > self.mlm_train_step
+                  with self.precision.autocast():
+                    with self.timer.phase('forward'):
+                      outputs, attns, mlm_outputs, mlm_labels = \
+                          self.train_model(src, tgt, tgt_tran, src_lengths, only_nmt=only_nmt)
+
+                    # 3. Compute loss in shards for memory efficiency.
+                    if only_nmt:
+                      # select_prob_mask: [seq_len, batch_size]
+                      select_prob_mask = self.train_loss.distill_select_mask(outputs, tgt, self.shard_size)
+                      with self.timer.phase('teacher'):
+                        if self.teacher_cache is not None:
+                          teacher_ids, teacher_logp = self._cached_teacher_topk(batch, tgt_outer, j, trunc_size)
+                          mlm_out, mlm_generator = None, None
+                        else:
+                          teacher_ids, teacher_logp = None, None
+                          mlm_generator = self.mlm_model.mlm_generator
+                          with torch.no_grad():
+                            mlm_out = self.mlm_model.forward_mlm_for_distillation(src, tgt, tgt_tran, src_lengths, mask_id=select_prob_mask)
+
+                      with self.timer.phase('loss'):
+                        batch_stats = self.train_loss.compute_distillation_loss(
+                            tgt, outputs, select_prob_mask, normalization, self.optim.scaler,
+                            annealing_coef=annealing_coef, shard_size=self.shard_size,
+                            mlm_out=mlm_out, mlm_generator=mlm_generator,
+                            teacher_ids=teacher_ids, teacher_logp=teacher_logp, topk=self.distill_topk)
+                      mlm_stats = None
+                    else:
+                      with self.timer.phase('loss'):
+                        batch_stats, mlm_stats = self.train_loss.sharded_compute_loss(
+                            batch, outputs, attns, j,
+                            trunc_size, self.shard_size, normalization, self.optim.scaler, mlm_outputs, mlm_labels, self.grad_accum_count * self.n_gpu)
               
-              total_stats.update(batch_stats)
-              report_stats.update(batch_stats)
-              if mlm_stats is not None:
-                mlm_total_stats.update(mlm_stats)
-                mlm_report_stats.update(mlm_stats)
+                  total_stats.update(batch_stats)
+                  report_stats.update(batch_stats)
+                  if mlm_stats is not None:
+                    mlm_total_stats.update(mlm_stats)
+                    mlm_report_stats.update(mlm_stats)
               
 
-              # 4. Update the parameters and statistics.
-              if self.grad_accum_count == 1:
-                  # Multi GPU gradient gather
-                  if self.n_gpu > 1:
-                      grads = [p.grad.data for p in self.model.parameters()
-                               if p.requires_grad
-                               and p.grad is not None]
-                      all_reduce_and_rescale_tensors(
-                          grads, float(1))
-                  self.optim.step()
-
-              # If truncated, don't backprop fully.
-              # TO CHECK
-              # if dec_state is not None:
-              #    dec_state.detach()
-              if self.model.decoder.state is not None:
-                  self.model.decoder.detach_state()
+                  # 4. Update the parameters and statistics.
+                  if self.grad_accum_count == 1:
+                      # Multi GPU gradient gather
+                      self._optimizer_step()
+
+                  # If truncated, don't backprop fully.
+                  # TO CHECK
+                  # if dec_state is not None:
+                  #    dec_state.detach()
+                  if self.model.decoder.state is not None:
+                      self.model.decoder.detach_state()
 
       # in case of multi step gradient accumulation,
       # update only after accum batches
       if self.grad_accum_count > 1:
-          if self.n_gpu > 1:
-              grads = [p.grad.data for p in self.model.parameters()
-                       if p.requires_grad
-                       and p.grad is not None]
-              all_reduce_and_rescale_tensors(
-                  grads, float(1))
+          self._optimizer_step()
+
+  def _optimizer_step(self):
+      """ Gathers the gradients and updates the parameters """
+      with self.timer.phase('all_reduce'):
+          self._all_reduce_gradients()
+      with self.timer.phase('optim'):
           self.optim.step()
+          self._maybe_update_average()
+
+  def _maybe_update_average(self):
+      if self.moving_average is not None:
+          self.moving_average.update(self.optim._step)
+
+  def _maybe_average_weights(self):
+      """ Context running the model with the averaged weights if asked """
+      if self.average_valid and self.moving_average is not None:
+          return self.moving_average.average_weights()
+      return contextlib.nullcontext()
+
+  def _maybe_no_sync(self, no_sync):
+      """ Context skipping the gradient all-reduce of `ddp_model` """
+      if no_sync and self.ddp_model is not None:
+          return self.ddp_model.no_sync()
+      return contextlib.nullcontext()
+
+  def _all_reduce_gradients(self):
+      """ Sums the gradients over the processes, those `ddp_model` does not """
+      if self.n_gpu <= 1:
+          return
+      params = self.unsynced_params if self.ddp_model is not None \
+          else self.model.parameters()
+      grads = [p.grad.data for p in params
+               if p.requires_grad and p.grad is not None]
+      if grads:
+          all_reduce_and_rescale_tensors(grads, float(1))
 
   def _start_report_manager(self, start_time=None):
       """
@@ -438,34 +652,47 @@ class Trainer(object):
           else:
               self.report_manager.start_time = start_time
 
-  def _maybe_gather_stats(self, stat):
+  def _maybe_gather_stats(self, *stats):
       """
-      Gather statistics in multi-processes cases
+      Gather statistics in multi-processes cases, with a single all-reduce
 
       Args:
-          stat(:obj:onmt.utils.Statistics): a Statistics object to gather
-              or None (it returns None in this case)
+          stats(:obj:onmt.utils.Statistics): Statistics objects to gather
+              or None (left unchanged)
 
       Returns:
-          stat: the updated (or unchanged) stat object
+          list of the updated (or unchanged) stat objects
       """
-      if stat is not None and self.n_gpu > 1:
-          return Statistics.all_gather_stats(stat)
-      return stat
+      if self.n_gpu > 1:
+          Statistics.all_reduce_stats_list([s for s in stats if s is not None])
+      return list(stats)
 
   def _maybe_report_training(self, step, num_steps, learning_rate,
-                             report_stats):
+                             report_stats, mlm_report_stats=None):
       """
       Simple function to report training stats (if report_manager is set)
-      see `onmt.utils.ReportManagerBase.report_training` for doc
+      see `onmt.utils.ReportManagerBase.report_training` for doc. The MLM
+      stats, if any, are reported too and gathered with the others.
       """
-      if self.report_manager is not None:
-          return self.report_manager.report_training(
-              step, num_steps, learning_rate, report_stats,
-              multigpu=self.n_gpu > 1)
+      if self.report_manager is None:
+          return report_stats, mlm_report_stats
+      if step % self.report_manager.report_every == 0:
+          self._maybe_gather_stats(report_stats, mlm_report_stats)
+      report_stats = self.report_manager.report_training(
+          step, num_steps, learning_rate, report_stats)
+      if mlm_report_stats is not None:
+          mlm_report_stats = self.report_manager.report_training(
+              step, num_steps, learning_rate, mlm_report_stats, prefix='mlm_')
+      return report_stats, mlm_report_stats
+
+  def _maybe_report_phases(self, step):
+      """ Reports the time per phase of the steps every `report_every` """
+      if self.timer.enabled and self.report_manager is not None \
+              and step % self.report_manager.report_every == 0:
+          self.report_manager.report_phases(step, self.timer.report())
 
   def _report_step(self, learning_rate, step, train_stats=None,
-                   valid_stats=None):
+                   valid_stats=None, prefix=''):
       """
       Simple function to report stats (if report_manager is set)
       see `onmt.utils.ReportManagerBase.report_step` for doc
@@ -473,7 +700,7 @@ class Trainer(object):
       if self.report_manager is not None:
           return self.report_manager.report_step(
               learning_rate, step, train_stats=train_stats,
-              valid_stats=valid_stats)
+              valid_stats=valid_stats, prefix=prefix)
 
   def _maybe_save(self, step):
       """
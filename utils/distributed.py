@@ -7,8 +7,8 @@
 from __future__ import print_function
 
 import math
-import pickle
 import torch.distributed
+from torch.nn.parallel import DistributedDataParallel
 
 from utils.logging import logger
 
@@ -32,6 +32,63 @@ def multi_init(opt, device_id):
     return gpu_rank
 
 
+def backend_device():
+    """ Device of the tensors the default process group communicates """
+    if torch.distributed.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def allreduce_sum_hook(process_group, bucket):
+    """
+    DDP communication hook summing the gradients of a bucket instead of
+    averaging them: the losses are already divided by the world size.
+    """
+    work = torch.distributed.all_reduce(bucket.buffer(), group=process_group,
+                                        async_op=True)
+    return work.get_future().then(lambda fut: fut.value()[0])
+
+
+def build_ddp_model(model, device_id=None, bucket_cap_mb=25):
+    """
+    Wraps `model` in DistributedDataParallel: gradients are all-reduced in
+    buckets while the backward runs. The generators are called outside of
+    the model forward, with one backward per loss chunk, so their
+    parameters are left to `all_reduce_and_rescale_tensors` after the
+    backward. Parameters unused in a training phase (the MLM decoder during
+    distillation) are found at each forward.
+
+    Returns:
+        (DistributedDataParallel, list of the parameters it does not reduce)
+    """
+    generators = [model.generator]
+    if getattr(model, 'mlm_generator', None) is not None:
+        generators.append(model.mlm_generator)
+    unsynced = {id(p): p for gen in generators for p in gen.parameters()}
+    # every name of the tied weights
+    ignored = [prefix + ('.' if prefix else '') + name
+               for prefix, module in model.named_modules()
+               for name, p in module.named_parameters(recurse=False)
+               if id(p) in unsynced]
+    # the only way to leave parameters of the wrapped module out of DDP,
+    # a private method of torch
+    if not hasattr(DistributedDataParallel,
+                   '_set_params_and_buffers_to_ignore_for_model'):
+        raise RuntimeError(
+            "This version of torch cannot leave the generators out of "
+            "DistributedDataParallel, train without -ddp")
+    DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, ignored)
+    ddp_model = DistributedDataParallel(
+        model, device_ids=[device_id] if device_id is not None else None,
+        bucket_cap_mb=bucket_cap_mb, broadcast_buffers=False,
+        find_unused_parameters=True)
+    ddp_model.register_comm_hook(None, allreduce_sum_hook)
+    # DDP only broadcasts the initial weights it reduces
+    for p in unsynced.values():
+        torch.distributed.broadcast(p.data, 0)
+    return ddp_model, list(unsynced.values())
+
+
 def all_reduce_and_rescale_tensors(tensors, rescale_denom,
                                    buffer_size=10485760):
     """All-reduce and rescale tensors in chunks of the specified size.
@@ -84,39 +141,3 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom,
 
     if len(buffer) > 0:
         all_reduce_buffer()
-
-
-def all_gather_list(data, max_size=4096):
-    """Gathers arbitrary data from all nodes into a list."""
-    world_size = torch.distributed.get_world_size()
-    if not hasattr(all_gather_list, '_in_buffer') or \
-            max_size != all_gather_list._in_buffer.size():
-        all_gather_list._in_buffer = torch.cuda.ByteTensor(max_size)
-        all_gather_list._out_buffers = [
-            torch.cuda.ByteTensor(max_size)
-            for i in range(world_size)
-        ]
-    in_buffer = all_gather_list._in_buffer
-    out_buffers = all_gather_list._out_buffers
-
-    enc = pickle.dumps(data)
-    enc_size = len(enc)
-    if enc_size + 2 > max_size:
-        raise ValueError(
-            'encoded data exceeds max_size: {}'.format(enc_size + 2))
-    assert max_size < 255*256
-    in_buffer[0] = enc_size // 255  # this encoding works for max_size < 65k
-    in_buffer[1] = enc_size % 255
-    in_buffer[2:enc_size+2] = torch.ByteTensor(list(enc))
-
-    torch.distributed.all_gather(out_buffers, in_buffer.cuda())
-
-    results = []
-    for i in range(world_size):
-        out_buffer = out_buffers[i]
-        size = (255 * out_buffer[0].item()) + out_buffer[1].item()
-
-        bytes_list = bytes(out_buffer[2:size+2].tolist())
-        result = pickle.loads(bytes_list)
-        results.append(result)
-    return results
@@ -0,0 +1,63 @@
+""" Exponential moving average of the model weights """
+import contextlib
+import torch
+
+
+def build_moving_average(model, opt):
+    """ The moving average of `opt.average_decay`, or None """
+    if opt.average_decay <= 0:
+        return None
+    return MovingAverage(model, opt.average_decay, opt.average_every,
+                         'cpu' if opt.average_cpu else None)
+
+
+class MovingAverage(object):
+    """
+    fp32 shadow copy of the trainable weights of `model` (generator
+    included), moved towards the weights every `every` optimizer steps with
+    the multi-tensor `torch._foreach` kernels. The decay warms up as
+    `(1 + step) / (10 + step)` so that the first weights are soon forgotten.
+
+    Args:
+        model (nn.Module): the model trained
+        decay (float): weight of the average at each update
+        every (int): update the average every this many steps
+        device (str): device of the copy, that of the weights if None
+    """
+
+    def __init__(self, model, decay, every=1, device=None):
+        self.decay = decay
+        self.every = every
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.averages = [p.detach().to(device or p.device, torch.float32,
+                                       copy=True)
+                         for p in self.params]
+
+    def update(self, step):
+        if step % self.every != 0:
+            return
+        decay = min(self.decay, (1. + step) / (10. + step))
+        params = [p.detach().to(a.device, a.dtype)
+                  for p, a in zip(self.params, self.averages)]
+        torch._foreach_mul_(self.averages, decay)
+        torch._foreach_add_(self.averages, params, alpha=1. - decay)
+
+    def state_dict(self, module):
+        """ `module.state_dict()` with the averaged weights """
+        averages = dict(zip(self.params, self.averages))
+        return {k: averages.get(v, v).detach()
+                for k, v in module.state_dict(keep_vars=True).items()}
+
+    @contextlib.contextmanager
+    def average_weights(self):
+        """ Context in which the model runs with the averaged weights """
+        with torch.no_grad():
+            backup = [p.detach().clone() for p in self.params]
+            for p, a in zip(self.params, self.averages):
+                p.copy_(a)
+        try:
+            yield
+        finally:
+            with torch.no_grad():
+                for p, b in zip(self.params, backup):
+                    p.copy_(b)
@@ -11,6 +11,7 @@ import torch.nn.functional as F
 import onmt
 import onmt.constants as Constants
 from utils.misc import use_gpu
+from utils.profiling import PhaseTimer
 from utils.statistics import Statistics
 
 
@@ -30,7 +31,7 @@ def build_loss_compute(model, tgt_vocab, src_vocab, opt, train=True):
   padding_idx = tgt_vocab.stoi[Constants.PAD_WORD]
   src_padding_idx = src_vocab.stoi[Constants.PAD_WORD]
   if opt.label_smoothing > 0 and train:
-    criterion = LabelSmoothingLoss(
+    criterion = ClosedFormLabelSmoothingLoss(
       opt.label_smoothing, len(tgt_vocab), ignore_index=padding_idx
     )
     # if opt.src_mlm:
@@ -82,6 +83,8 @@ class LossComputeBase(nn.Module):
         super(LossComputeBase, self).__init__()
         self.criterion = criterion
         self.generator = generator
+        # times the backward through the decoders
+        self.timer = PhaseTimer()
 
     @property
     def padding_idx(self):
@@ -164,48 +167,69 @@ class LossComputeBase(nn.Module):
               `[tgt_len x batch x src_len]`
           cur_trunc (int) : starting position of truncation window
           trunc_size (int) : length of truncation window
-          shard_size (int) : maximum number of examples in a shard
+          shard_size (int) : maximum number of target time steps in a
+              shard, times the batch width in tokens, 0 for a single shard
           normalization (int) : Loss is divided by this number
 
         Returns:
             :obj:`onmt.utils.Statistics`: validation loss statistics
 
         """
-        batch_stats = Statistics()
-        mlm_batch_stats = Statistics() if mlm_labels is not None else None
-        # all_loss = 0.0
-        # range_ = (cur_trunc, cur_trunc + trunc_size)
-        # shard_state = self._make_shard_state(batch, output, range_, attns)
-        # for shard in shards(shard_state, shard_size, creat_graph=True):
-        #     loss, stats = self._compute_loss(batch, **shard)
-        #     all_loss = loss.div(float(normalization)) + all_loss
-        #     batch_stats.update(stats)
-        non_pad_mask = batch.tgt[1:] != self.criterion.ignore_index # [seq_len, batch]
-        non_pad_idx = non_pad_mask.float().view(-1).nonzero().squeeze(1)
-        loss, stats = self._compute_loss(batch, output, batch.tgt[1:], select_mask=non_pad_idx)
-        loss = loss.div(float(normalization)) / accum_norm
-        # compute MLM loss
+        # (decoder output, target, generator, loss weight) of each loss
+        losses = [(output, batch.tgt[1:], "tgt_gen",
+                   (1 - self.mlm_weight) / (normalization * accum_norm))]
         if mlm_labels is not None:
-          non_pad_mask = mlm_labels != self.criterion.ignore_index # [seq_len, batch]
-          non_pad_idx = non_pad_mask.float().view(-1).nonzero().squeeze(1)
           mlm_normalization = (mlm_labels != self.criterion.ignore_index).float().sum()
-          mlm_loss, mlm_stats = self._compute_loss(batch, mlm_out, mlm_labels, gen_type="mlm_gen", select_mask=non_pad_idx)
-          mlm_loss = mlm_loss.div(float(mlm_normalization) * accum_norm)
-          mlm_batch_stats.update(mlm_stats)
-        else:
-          mlm_loss = 0.0
-          mlm_batch_stats = None
-        
-        loss = self.mlm_weight * mlm_loss + (1 - self.mlm_weight) * loss
-        # use auto-mixed precision
-        if scaler is not None:
-          scaler.scale(loss).backward()
-        else:
-          loss.backward()
-        
-        batch_stats.update(stats)
+          losses.append((mlm_out, mlm_labels, "mlm_gen",
+                         self.mlm_weight / (mlm_normalization * accum_norm)))
+
+        all_stats, outputs, grads = [], [], []
+        for out, target, gen_type, weight in losses:
+          non_pad_mask = target != self.criterion.ignore_index # [seq_len, batch]
+          non_pad_idx = non_pad_mask.float().view(-1).nonzero().squeeze(1)
+
+          def chunk_loss(out_detached, chunk):
+            loss, stats = self._compute_loss(batch, out_detached, target, gen_type=gen_type,
+                                             select_mask=non_pad_idx[chunk])
+            return loss * weight, stats
+
+          stats, grad = self._chunked_backward(out, non_pad_idx.size(0), shard_size, chunk_loss, scaler)
+          all_stats.append(stats)
+          if grad is not None:
+            outputs.append(out)
+            grads.append(grad)
+        # a single backward pass through the decoders
+        if outputs:
+          with self.timer.phase('backward'):
+            torch.autograd.backward(outputs, grads)
+
+        batch_stats = all_stats[0]
+        mlm_batch_stats = all_stats[1] if mlm_labels is not None else None
         return batch_stats, mlm_batch_stats
-    
+
+    def _chunked_backward(self, output, n_rows, shard_size, chunk_loss, scaler=None):
+        """
+        Runs `chunk_loss(output, chunk)`, the loss and statistics of the
+        `chunk` slice of `n_rows` token rows, on `output` detached from the
+        decoder, `shard_size` time steps of `output` `[len x batch x hidden]`
+        (times its batch width) rows at a time, and backpropagates each loss
+        through the generator. Only one chunk of scores and their gradient is
+        alive at a time.
+
+        Returns:
+            (:obj:`Statistics`, gradient of `output` or None)
+        """
+        batch_stats = Statistics()
+        output = output.detach().requires_grad_()
+        for chunk in token_chunks(n_rows, shard_size * output.size(1)):
+          loss, stats = chunk_loss(output, chunk)
+          batch_stats.update(stats)
+          if scaler is not None:
+            scaler.scale(loss).backward()
+          else:
+            loss.backward()
+        return batch_stats, output.grad
+
     def _stats(self, loss, scores, target):
         """
         Args:
@@ -218,9 +242,8 @@ class LossComputeBase(nn.Module):
         """
         pred = scores.max(1)[1]
         non_padding = target.ne(self.padding_idx)
-        num_correct = pred.eq(target).masked_select(non_padding).sum().item()
-        num_non_padding = non_padding.sum().item()
-        return Statistics(loss.item(), num_non_padding, num_correct)
+        num_correct = (pred.eq(target) & non_padding).sum()
+        return Statistics.from_tensors(loss=loss, n_words=non_padding.sum(), n_correct=num_correct)
 
     def _bottle(self, _v):
         return _v.view(-1, _v.size(2))
@@ -229,6 +252,23 @@ class LossComputeBase(nn.Module):
         return _v.view(-1, batch_size, _v.size(1))
 
 
+def label_smoothed_kl(output, target, confidence, smoothing_value, ignore_index):
+  """
+  KL-divergence of each row of `output` (log-probabilities) from the
+  smoothed ground truth of `LabelSmoothingLoss`: `confidence` on the target,
+  0 on `ignore_index` and `smoothing_value` on the other words. Computed
+  from the target and padding columns and the row sum, 0 for padding rows.
+  """
+  n_smoothed = output.size(1) - 2
+  truth_prob = output.new_tensor(confidence)
+  smoothing = output.new_tensor(smoothing_value)
+  entropy = torch.xlogy(truth_prob, truth_prob) + n_smoothed * torch.xlogy(smoothing, smoothing)
+  truth_lp = output.gather(1, target.unsqueeze(1)).squeeze(1)
+  other_lp = output.sum(1) - truth_lp - output[:, ignore_index]
+  loss = entropy - confidence * truth_lp - smoothing_value * other_lp
+  return loss.masked_fill(target == ignore_index, 0.)
+
+
 class LabelSmoothingLoss(nn.Module):
   """
   With label smoothing,
@@ -244,6 +284,7 @@ class LabelSmoothingLoss(nn.Module):
     one_hot = torch.full((tgt_vocab_size,), smoothing_value)
     one_hot[self.ignore_index] = 0
     self.register_buffer('one_hot', one_hot.unsqueeze(0))
+    self.smoothing_value = smoothing_value
 
     self.confidence = 1.0 - label_smoothing
 
@@ -259,6 +300,20 @@ class LabelSmoothingLoss(nn.Module):
     return F.kl_div(output, model_prob, reduction='sum')
 
 
+class ClosedFormLabelSmoothingLoss(LabelSmoothingLoss):
+  """
+  `LabelSmoothingLoss` computed with `label_smoothed_kl`, without the
+  `[batch_size x n_classes]` smoothed target distribution.
+  """
+  def forward(self, output, target):
+    """
+    output (FloatTensor): batch_size x n_classes
+    target (LongTensor): batch_size
+    """
+    return label_smoothed_kl(output, target, self.confidence, self.smoothing_value,
+                             self.ignore_index).sum()
+
+
 class NMTLossCompute(LossComputeBase):
   """
   Standard NMT Loss Computation.
@@ -283,22 +338,60 @@ class NMTLossCompute(LossComputeBase):
         "target": target[range_[0] + 1: range_[1]],
     }
   
-  def compute_distillation_loss(self, tgt, nmt_prob, mlm_prob, select_prob_mask, normalization, scaler=None, annealing_coef=1.0):
-    # select_prob_mask: [seq_len, batch_size] 1: use distillation 0: not use
-    # nmt_prob, mlm_prob: [seq_len * batch_size, vocab_size]
-    batch_stats = Statistics()
+  def compute_distillation_loss(self, tgt, output, select_prob_mask, normalization, scaler=None, annealing_coef=1.0,
+                                shard_size=0, mlm_out=None, mlm_generator=None, teacher_ids=None, teacher_logp=None, topk=0):
+    """
+    Ground truth and distillation loss of the student decoder `output`
+    `[seq_len x batch x hidden]`, backpropagated. The teacher is either its
+    decoder output `mlm_out` through `mlm_generator`, or its top-k
+    `teacher_ids`, `teacher_logp` `[seq_len * batch_size x k]` (cached).
+    With `topk` > 0 only the k best teacher words are used (sparse loss),
+    otherwise the full teacher distribution (dense loss). Generator, loss
+    and backward run over chunks of `shard_size` time steps.
+
+    select_prob_mask: [seq_len, batch_size] 1: use distillation 0: not use
+    """
     truth = tgt[1:].contiguous().view(-1) # [seq_len-1 * batch_size]
-    label_s_prob = self.criterion.one_hot.repeat(truth.size(0), 1) # [seq_len-1 * batch_size, vocab_size]
+    select_mask = select_prob_mask.contiguous().view(-1)
+
+    def chunk_loss(out, chunk):
+      nmt_prob = self.generator(self._bottle(out)[chunk]) # [chunk_size, vocab_size]
+      if mlm_out is not None:
+        with torch.no_grad():
+          mlm_prob = mlm_generator(self._bottle(mlm_out)[chunk])
+          if topk > 0:
+            chunk_logp, chunk_ids = mlm_prob.topk(topk, dim=-1)
+      else:
+        chunk_ids, chunk_logp = teacher_ids[chunk], teacher_logp[chunk]
+        if topk == 0:
+          mlm_prob = dense_log_probs(chunk_ids, chunk_logp, nmt_prob.size(-1))
+      if topk > 0:
+        loss = self._sparse_distillation_loss(truth[chunk], nmt_prob, chunk_ids, chunk_logp,
+                                              select_mask[chunk], annealing_coef)
+      else:
+        loss = self._dense_distillation_loss(truth[chunk], nmt_prob, mlm_prob.detach(),
+                                             select_mask[chunk], annealing_coef)
+      stats = self._stats(loss.clone(), nmt_prob, truth[chunk])
+      return loss.div(normalization), stats
+
+    batch_stats, grad = self._chunked_backward(output, truth.size(0), shard_size, chunk_loss, scaler)
+    if grad is not None:
+      with self.timer.phase('backward'):
+        output.backward(grad)
+    return batch_stats
+
+  def _dense_distillation_loss(self, truth, nmt_prob, mlm_prob, select_prob_mask, annealing_coef):
+    # nmt_prob, mlm_prob: [token_num, vocab_size]
+    label_s_prob = self.criterion.one_hot.repeat(truth.size(0), 1) # [token_num, vocab_size]
     label_s_prob.scatter_(1, truth.unsqueeze(1), self.criterion.confidence)
     label_s_prob.masked_fill_((truth == self.criterion.ignore_index).unsqueeze(1), 0) # [token_num, vocab_size]
     mlm_prob = torch.exp(mlm_prob)
     # final_truth_prob = label_s_prob
     # truth label loss of selected words
-    select_prob_mask = select_prob_mask.contiguous().view(-1)
     select_idx = select_prob_mask.nonzero().squeeze(1) # [non_zero_num]
     
     # non_select_idx = (1 - select_prob_mask).nonzero().squeeze(1) # [zero_num]
-    non_pad_mask = truth != self.criterion.ignore_index # [seq_len, batch]
+    non_pad_mask = truth != self.criterion.ignore_index # [token_num]
     non_select_mask = (1-select_prob_mask).bool() & non_pad_mask
     non_select_idx = non_select_mask.float().nonzero().squeeze(1)
     distill_label_loss = F.kl_div(nmt_prob[select_idx], mlm_prob[select_idx], reduction='sum')
@@ -315,15 +408,44 @@ class NMTLossCompute(LossComputeBase):
     # final_truth_prob = mlm_prob * (select_prob_mask.contiguous().view(-1).unsqueeze(1)) \
     #        + label_s_prob * ((1 - select_prob_mask).contiguous().view(-1).unsqueeze(1))
     # loss = F.kl_div(nmt_prob, final_truth_prob, reduction='sum')
-    stats = self._stats(loss.clone(), nmt_prob, truth)
-    batch_stats.update(stats)
-    loss = loss.div(float(normalization))
-    if scaler is not None:
-      scaler.scale(loss).backward()
-    else:
-      loss.backward()
-    
-    return batch_stats
+    return loss
+
+  def _sparse_distillation_loss(self, truth, nmt_prob, teacher_ids, teacher_logp, select_prob_mask, annealing_coef):
+    """
+    `_dense_distillation_loss` with the teacher reduced to its k best
+    words per token, renormalized, and the smoothed ground truth terms in
+    closed form: nothing of size `[token_num, vocab_size]` is built besides
+    `nmt_prob`. Equal to the dense loss when k is the vocabulary size.
+
+    teacher_ids, teacher_logp: [token_num, k] teacher top-k
+    """
+    select_mask = select_prob_mask.bool()
+    non_select_mask = ~select_mask & (truth != self.criterion.ignore_index)
+    truth_loss = label_smoothed_kl(nmt_prob, truth, self.criterion.confidence,
+                                   self.criterion.smoothing_value, self.criterion.ignore_index) # [token_num]
+    teacher_logp = teacher_logp[select_mask].float().log_softmax(-1) # [select_num, k]
+    teacher_prob = teacher_logp.exp()
+    student_logp = nmt_prob.gather(1, teacher_ids)[select_mask] # [select_num, k]
+    distill_label_loss = (torch.xlogy(teacher_prob, teacher_prob) - teacher_prob * student_logp).sum()
+    masked_truth_label_loss = truth_loss[select_mask].sum()
+    unmasked_truth_label_loss = truth_loss[non_select_mask].sum()
+    return unmasked_truth_label_loss + annealing_coef * masked_truth_label_loss + (1-annealing_coef) * distill_label_loss
+
+  def distill_select_mask(self, output, target, shard_size=0):
+    """
+    `[seq_len x batch_size]` float mask of the target tokens to distill,
+    those given less than `distill_threshold` probability by the student,
+    computed over chunks of `shard_size` time steps.
+    """
+    truth = target[1:].contiguous().view(-1)
+    bottled_output = self._bottle(output)
+    with torch.no_grad():
+      truth_prob = torch.cat([
+        self.generator(bottled_output[chunk]).gather(1, truth[chunk].unsqueeze(1)).squeeze(1)
+        for chunk in token_chunks(truth.size(0), shard_size * output.size(1))])
+    truth_prob.masked_fill_(truth == self.criterion.ignore_index, 0.0)
+    distill_prob_mask = torch.exp(truth_prob) < self.distill_threshold
+    return distill_prob_mask.view(target[1:].size(0), -1).float()
 
   def only_compute_prob(self, output, target=None, select_prob=False, gen_type='tgt_gen', gen=None):
     # output: seq_len, batch_size, hidden
@@ -368,66 +490,15 @@ class NMTLossCompute(LossComputeBase):
     return loss, stats
 
 
-def filter_shard_state(state, shard_size=None):
-    for k, v in state.items():
-        if shard_size is None:
-            yield k, v
-
-        if v is not None:
-            v_split = []
-            if isinstance(v, torch.Tensor):
-                for v_chunk in torch.split(v, shard_size):
-                    v_chunk = v_chunk.data.clone()
-                    v_chunk.requires_grad = v.requires_grad
-                    v_split.append(v_chunk)
-            yield k, (v, v_split)
+def dense_log_probs(ids, logp, vocab_size):
+  """ Top-k log-probabilities renormalized, as `[token_num x vocab_size]` with -inf elsewhere """
+  norm = logp.logsumexp(-1, keepdim=True)
+  norm = norm.masked_fill(norm.isinf(), 0.)
+  return logp.new_full((logp.size(0), vocab_size), float('-inf')).scatter_(1, ids, logp - norm)
 
 
-def shards(state, shard_size, eval_only=False, creat_graph=False):
-    """
-    Args:
-        state: A dictionary which corresponds to the output of
-               *LossCompute._make_shard_state(). The values for
-               those keys are Tensor-like or None.
-        shard_size: The maximum size of the shards yielded by the model.
-        eval_only: If True, only yield the state, nothing else.
-              Otherwise, yield shards.
-
-    Yields:
-        Each yielded shard is a dict.
-
-    Side effect:
-        After the last shard, this function does back-propagation.
-    """
-    if eval_only:
-        yield filter_shard_state(state)
-    else:
-        # non_none: the subdict of the state dictionary where the values
-        # are not None.
-        non_none = dict(filter_shard_state(state, shard_size))
-
-        # Now, the iteration:
-        # state is a dictionary of sequences of tensor-like but we
-        # want a sequence of dictionaries of tensors.
-        # First, unzip the dictionary into a sequence of keys and a
-        # sequence of tensor-like sequences.
-        keys, values = zip(*((k, [v_chunk for v_chunk in v_split])
-                             for k, (_, v_split) in non_none.items()))
-
-        # Now, yield a dictionary for each shard. The keys are always
-        # the same. values is a sequence of length #keys where each
-        # element is a sequence of length #shards. We want to iterate
-        # over the shards, not over the keys: therefore, the values need
-        # to be re-zipped by shard and then each shard can be paired
-        # with the keys.
-        for shard_tensors in zip(*values):
-            yield dict(zip(keys, shard_tensors))
-
-        # Assumed backprop'd
-        variables = []
-        for k, (v, v_split) in non_none.items():
-            if isinstance(v, torch.Tensor) and state[k].requires_grad:
-                variables.extend(zip(torch.split(state[k], shard_size),
-                                     [v_chunk.grad for v_chunk in v_split]))
-        inputs, grads = zip(*variables)
-        torch.autograd.backward(inputs, grads, creat_graph=creat_graph)
+def token_chunks(n_rows, shard_size):
+  """ Slices of at most `shard_size` of `n_rows` rows, a single one if 0 """
+  if shard_size <= 0:
+    return [slice(0, n_rows)]
+  return [slice(start, start + shard_size) for start in range(0, n_rows, shard_size)]
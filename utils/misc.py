@@ -51,5 +51,7 @@ def use_gpu(opt):
     """
     Creates a boolean if gpu used
     """
+    if getattr(opt, 'ddp_cpu', False):
+        return False
     return (hasattr(opt, 'gpu_ranks') and len(opt.gpu_ranks) > 0) or \
         (hasattr(opt, 'gpu') and opt.gpu > -1)
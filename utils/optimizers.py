@@ -1,17 +1,27 @@
 """ Optimizers class """
+import copy
 import torch
 import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
 import re
 from utils.misc import use_gpu
+from utils.precision import Precision
 from torch.cuda.amp import GradScaler
 
 def build_optim(model, opt, checkpoint):
     """ Build optimizer """
     saved_optimizer_state_dict = None
+    # losses are only scaled for fp16 autocast
+    precision = Precision.from_opt(opt, 'cuda' if use_gpu(opt) else 'cpu')
 
     if opt.train_from and opt.reset_optim != 'all':
         optim = checkpoint['optim']
+        optim.mixed_precision = precision.loss_scaling
+        # older checkpoints have no loss scaler state
+        scaler_state = optim.__dict__.pop('scaler_state', None)
+        # older checkpoints have no implementation options
+        optim.impl = opt.optim_impl
+        optim.flat_buffers = opt.optim_flat_buffers
         # We need to save a copy of optim.optimizer.state_dict() for setting
         # the, optimizer state later on in Stage 2 in this method, since
         # the method optim.set_parameters(model.parameters()) will overwrite
@@ -32,7 +42,6 @@ def build_optim(model, opt, checkpoint):
                 optim.decay_method = opt.decay_method
                 optim.warmup_steps = opt.warmup_steps
                 optim.model_size = opt.dec_rnn_size
-                optim.mixed_precision = opt.mixed_precision
                 optim.doc_double_lr=opt.doc_double_lr
                 optim.doc_lr=opt.doc_double_lr
     else:
@@ -47,8 +56,9 @@ def build_optim(model, opt, checkpoint):
             decay_method=opt.decay_method,
             warmup_steps=opt.warmup_steps,
             model_size=opt.dec_rnn_size,
-            mixed_precision=opt.mixed_precision,
-            doc_double_lr=opt.doc_double_lr, doc_lr=opt.doc_double_lr
+            mixed_precision=precision.loss_scaling,
+            doc_double_lr=opt.doc_double_lr, doc_lr=opt.doc_double_lr,
+            impl=opt.optim_impl, flat_buffers=opt.optim_flat_buffers
             )
 
     # Stage 1:
@@ -97,11 +107,16 @@ def build_optim(model, opt, checkpoint):
         # this purpose.
         # See also: https://github.com/pytorch/pytorch/issues/2830
         optim.optimizer.load_state_dict(saved_optimizer_state_dict)
-        # Convert back the state values to cuda type if applicable
+        if optim.scaler is not None and scaler_state:
+            optim.scaler.load_state_dict(scaler_state)
+        # the saved param groups carry the implementation they were saved with
+        optim.set_implementation()
+        # Convert back the state values to cuda type if applicable, the
+        # step counts stay on cpu unless fused kernels read them
         if use_gpu(opt):
             for state in optim.optimizer.state.values():
                 for k, v in state.items():
-                    if torch.is_tensor(v):
+                    if torch.is_tensor(v) and (k != 'step' or optim.fused):
                         state[k] = v.cuda()
 
         # We want to make sure that indeed we have a non-empty optimizer state
@@ -116,6 +131,44 @@ def build_optim(model, opt, checkpoint):
     return optim
 
 
+def flatten_parameters(params):
+    """
+    Moves `params` and their gradients into one flat buffer per device and
+    dtype each, the parameters and gradients becoming views of them.
+
+    Returns:
+        (list of flat parameters, list of flat gradients)
+    """
+    groups = {}
+    for p in params:
+        groups.setdefault((p.device, p.dtype), []).append(p)
+    flat_params, flat_grads = [], []
+    for group in groups.values():
+        flat = torch.cat([p.detach().view(-1) for p in group])
+        grad = torch.zeros_like(flat)
+        offset = 0
+        for p in group:
+            n = p.numel()
+            if p.grad is not None:
+                grad[offset:offset + n].copy_(p.grad.view(-1))
+            p.data = flat[offset:offset + n].view_as(p)
+            p.grad = grad[offset:offset + n].view_as(p)
+            offset += n
+        flat_params.append(flat)
+        flat_grads.append(grad)
+    return flat_params, flat_grads
+
+
+def clip_flat_grads_(flat_grads, max_norm):
+    """ `clip_grad_norm_` of flat gradient buffers, without host sync """
+    device = flat_grads[0].device
+    total_norm = torch.stack([g.norm().to(device) for g in flat_grads]).norm()
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for g in flat_grads:
+        g.mul_(clip_coef.to(g.device))
+    return total_norm
+
+
 class MultipleOptimizer(object):
     """ Implement multiple optimizers needed for sparse adam """
 
@@ -149,6 +202,16 @@ class MultipleOptimizer(object):
             self.optimizers[i].load_state_dict(state_dicts[i])
 
 
+class SavedOptimizer(object):
+    """ The state dict of a torch optimizer in a checkpoint, see `Optimizer.saved` """
+
+    def __init__(self, state_dict):
+        self._state_dict = state_dict
+
+    def state_dict(self):
+        return self._state_dict
+
+
 class Optimizer(object):
     """
     Controller class for optimization. Mostly a thin
@@ -167,6 +230,10 @@ class Optimizer(object):
       decay_method (str, option): custom decay options
       warmup_steps (int, option): parameter for `noam` decay
       model_size (int, option): parameter for `noam` decay
+      impl (str, option): `loop`, `foreach` (multi-tensor) or `fused`
+          kernels for the step and the gradient clipping
+      flat_buffers (bool, option): keep the parameters and gradients in
+          flat buffers, see `flatten_parameters`
 
     We use the default parameters for Adam that are suggested by
     the original paper https://arxiv.org/pdf/1412.6980.pdf
@@ -186,7 +253,8 @@ class Optimizer(object):
                  adagrad_accum=0.0,
                  decay_method=None,
                  warmup_steps=4000,
-                 model_size=None, mixed_precision=False, doc_double_lr=0, doc_lr=1.0):
+                 model_size=None, mixed_precision=False, doc_double_lr=0, doc_lr=1.0,
+                 impl='foreach', flat_buffers=False):
         self.last_ppl = None
         self.learning_rate = learning_rate
         self.original_lr = learning_rate
@@ -209,6 +277,8 @@ class Optimizer(object):
         
         self.doc_double_lr = doc_double_lr
         self.doc_lr = doc_lr
+        self.impl = impl
+        self.flat_buffers = flat_buffers
         # for inverse_sqrt LR
         if self.decay_method == "inverse_sqrt":
           self.learn_rate = 0.0
@@ -219,13 +289,13 @@ class Optimizer(object):
         """ ? """
         self.params = []
         self.sparse_params = []
-        if self.mixed_precision:
-           self.scaler = GradScaler()
+        self.scaler = GradScaler() if self.mixed_precision else None
         
         if params_g:
            self.params = params_g
            self.params[0]['lr'] = self.learning_rate * self.doc_lr
            self.params[1]['lr'] = self.learning_rate
+           self.grad_params = [p for group in params_g for p in group['params']]
         else:
            for k, p in params:
                if p.requires_grad:
@@ -233,6 +303,12 @@ class Optimizer(object):
                       self.params.append(p)
                    else:
                       self.sparse_params.append(p)
+           self.grad_params = self.params
+
+        self.flat_params, self.flat_grads = [], []
+        if self.flat_buffers:
+            self.flat_params, self.flat_grads = \
+                flatten_parameters(self.grad_params)
         
         # for k, p in params:
         #        if p.requires_grad:
@@ -272,6 +348,66 @@ class Optimizer(object):
                                   betas=self.betas, eps=1e-8)])
         else:
             raise RuntimeError("Invalid optim method: " + self.method)
+        self.set_implementation()
+
+    @property
+    def fused(self):
+        """ Whether Adam runs its fused kernel, for CUDA parameters only """
+        return self.impl == 'fused' and self.method == 'adam' \
+            and all(p.is_cuda for p in self.grad_params)
+
+    def set_implementation(self):
+        """
+        Selects the per-parameter loop, the multi-tensor (foreach) or the
+        fused kernels of the torch optimizers after `impl`
+        """
+        optimizers = self.optimizer.optimizers \
+            if isinstance(self.optimizer, MultipleOptimizer) else [self.optimizer]
+        for optimizer in optimizers:
+            for group in optimizer.param_groups:
+                if 'foreach' in group:
+                    group['foreach'] = self.impl != 'loop' and not self.fused
+                if 'fused' in group:
+                    group['fused'] = self.fused
+        if self.fused:
+            # the fused kernel reads its step counts on the device
+            for state in self.optimizer.state.values():
+                if torch.is_tensor(state.get('step')):
+                    state['step'] = state['step'].to(
+                        device=state['exp_avg'].device, dtype=torch.float32)
+
+    def __getstate__(self):
+        # the flat buffers are views of the model, rebuilt by set_parameters
+        state = self.__dict__.copy()
+        state.pop('flat_params', None)
+        state.pop('flat_grads', None)
+        return state
+
+    def saved(self, snapshot=None):
+        """
+        The optimizer as saved in checkpoints, sharing nothing with this one:
+        a copy of its settings and step, and the state dicts of the torch
+        optimizer and of the loss scaler, passed through `snapshot` (e.g. a
+        copy of their tensors) if given. `build_optim` resumes from it.
+        """
+        snapshot = snapshot or (lambda state: state)
+        saved = Optimizer.__new__(Optimizer)
+        saved.__dict__ = copy.deepcopy(
+            {k: v for k, v in self.__getstate__().items()
+             if k not in ('params', 'sparse_params', 'grad_params', 'optimizer', 'scaler')})
+        saved.optimizer = SavedOptimizer(snapshot(self.optimizer.state_dict()))
+        saved.scaler = None
+        saved.scaler_state = snapshot(self.scaler.state_dict()) \
+            if self.scaler is not None else None
+        return saved
+
+    def zero_grad(self):
+        """ Zeroes the gradients, in place in the flat buffers if any """
+        if self.flat_grads:
+            for grad in self.flat_grads:
+                grad.zero_()
+        else:
+            self.optimizer.zero_grad()
 
     def _set_rate(self, learning_rate):
         self.learning_rate = learning_rate
@@ -329,8 +465,12 @@ class Optimizer(object):
         if self.mixed_precision and self.max_grad_norm > 0:
           self.scaler.unscale_(self.optimizer)
         
-        if self.max_grad_norm:
-          clip_grad_norm_(self.params, self.max_grad_norm)
+        if self.max_grad_norm and self.flat_grads:
+          clip_flat_grads_(self.flat_grads, self.max_grad_norm)
+        elif self.max_grad_norm:
+          # one multi-tensor norm over all the gradients
+          clip_grad_norm_(self.grad_params, self.max_grad_norm,
+                          foreach=self.impl != 'loop')
         
         if self.mixed_precision:
           self.scaler.step(self.optimizer)
@@ -0,0 +1,50 @@
+""" Autocast precision for training and translation """
+import torch
+
+from utils.logging import logger
+
+
+class Precision(object):
+    """
+    Autocast dtype for a device type, and whether losses need scaling.
+
+    Args:
+        mode (str): fp32, fp16, bf16 or auto (fp16 on cuda, bf16 on cpu)
+        device_type (str): cuda or cpu
+    """
+
+    def __init__(self, mode="fp32", device_type="cpu"):
+        self.device_type = device_type
+        if mode == "auto":
+            mode = "fp16" if device_type == "cuda" else "bf16"
+        if mode == "fp16" and device_type == "cpu":
+            logger.info("fp16 autocast is not available on cpu, using bf16")
+            mode = "bf16"
+        if mode == "bf16" and device_type == "cuda" \
+                and not torch.cuda.is_bf16_supported():
+            logger.info("bf16 is not supported by this gpu, using fp16")
+            mode = "fp16"
+        self.mode = mode
+        self.dtype = {"fp16": torch.float16,
+                      "bf16": torch.bfloat16}.get(mode, torch.float32)
+
+    @classmethod
+    def from_opt(cls, opt, device_type):
+        mode = opt.precision
+        # -mixed_precision predates -precision
+        if mode == "fp32" and getattr(opt, "mixed_precision", False):
+            mode = "auto"
+        return cls(mode, device_type)
+
+    @property
+    def enabled(self):
+        return self.mode != "fp32"
+
+    @property
+    def loss_scaling(self):
+        """ fp16 gradients underflow, bf16 has the exponent range of fp32 """
+        return self.mode == "fp16"
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype,
+                              enabled=self.enabled)
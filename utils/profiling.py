@@ -0,0 +1,140 @@
+""" Time per phase of the training steps """
+import contextlib
+import time
+from collections import OrderedDict
+
+import torch
+
+from utils.logging import logger
+
+
+class PhaseTimer(object):
+    """
+    Wall time of the phases of the training steps (data, forward, loss, ...),
+    synchronizing the device around each phase so that its kernels are
+    counted in it. The time of a phase excludes its nested phases. When
+    disabled, `phase` is a no-op context and nothing is synchronized.
+
+    It also captures a `torch.profiler` trace of the steps `profile_steps`
+    (first and last included), with the phases as labelled ranges.
+
+    Args:
+        enabled (bool): time the phases
+        device (str): device whose kernels are waited for
+        profile_steps (list): first and last step of the trace, or None
+        profile_dir (str): directory of the trace, for tensorboard
+    """
+
+    def __init__(self, enabled=False, device='cpu', profile_steps=None,
+                 profile_dir=None):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.stack = []
+        self.reset()
+
+    @classmethod
+    def from_opt(cls, opt, device):
+        return cls(opt.profile_phases, device, opt.profile_steps,
+                   opt.profile_dir)
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.steps = 0
+        self.start_time = time.perf_counter()
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def start(self, name):
+        self._sync()
+        self.stack.append((name, time.perf_counter()))
+
+    def stop(self):
+        self._sync()
+        name, start = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self.times[name] = self.times.get(name, 0.) + elapsed
+        if self.stack:
+            parent = self.stack[-1][0]
+            self.times[parent] = self.times.get(parent, 0.) - elapsed
+
+    def phase(self, name):
+        """ Context timing `name` """
+        if not self.enabled and self.profiler is None:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        label = torch.profiler.record_function(name) \
+            if self.profiler is not None else contextlib.nullcontext()
+        with label:
+            if not self.enabled:
+                yield
+                return
+            self.start(name)
+            try:
+                yield
+            finally:
+                self.stop()
+
+    def timed(self, iterable, name):
+        """ `iterable` with the time waiting for each item in `name` """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def time_modules(self, modules, name):
+        """ Times the forward of `modules` in `name` """
+        if not self.enabled:
+            return
+        for module in modules:
+            module.register_forward_pre_hook(lambda *args: self.start(name))
+            module.register_forward_hook(lambda *args: self.stop())
+
+    def maybe_start_profiler(self, step):
+        if self.profile_steps is None or self.profiler is not None:
+            return
+        first, last = self.profile_steps
+        if first <= step <= last:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    self.profile_dir))
+            self.profiler.start()
+            logger.info('Profiling steps %d to %d' % (step, last))
+
+    def step(self, step):
+        """ End of training step `step` """
+        self.steps += 1
+        if self.profiler is not None and step >= self.profile_steps[1]:
+            self.profiler.stop()
+            self.profiler = None
+            self.profile_steps = None
+            logger.info('Profiler trace written to %s' % self.profile_dir)
+        self.maybe_start_profiler(step + 1)
+
+    def report(self):
+        """
+        Milliseconds per step of each phase since the last report, with
+        the `total` and the time out of any phase (`other`), then resets.
+        """
+        steps = max(self.steps, 1)
+        total = time.perf_counter() - self.start_time
+        times = OrderedDict([('total', total)])
+        times.update(self.times)
+        times['other'] = total - sum(self.times.values())
+        self.reset()
+        return OrderedDict((name, 1000. * t / steps) for name, t in times.items())
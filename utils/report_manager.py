@@ -1,5 +1,6 @@
 """ Report manager utility """
 from __future__ import print_function
+import json
 import time
 from datetime import datetime
 
@@ -9,7 +10,7 @@ from utils.logging import logger
 from utils.statistics import Statistics
 
 
-def build_report_manager(opt):
+def build_report_manager(opt, gpu_rank=0):
     if opt.tensorboard:
         from tensorboardX import SummaryWriter
         tensorboard_log_dir = opt.tensorboard_log_dir
@@ -22,8 +23,15 @@ def build_report_manager(opt):
     else:
         writer = None
 
+    # a single writer of the metrics
+    if opt.metrics_file and gpu_rank == 0:
+        metrics_file = open(opt.metrics_file, 'a')
+    else:
+        metrics_file = None
+
     report_mgr = ReportMgr(opt.report_every, start_time=-1,
-                           tensorboard_writer=writer)
+                           tensorboard_writer=writer,
+                           metrics_file=metrics_file)
     return report_mgr
 
 
@@ -53,7 +61,7 @@ class ReportMgrBase(object):
         logger.info(*args, **kwargs)
 
     def report_training(self, step, num_steps, learning_rate,
-                        report_stats, multigpu=False):
+                        report_stats, multigpu=False, prefix=''):
         """
         This is the user-defined batch-level traing progress
         report function.
@@ -63,6 +71,8 @@ class ReportMgrBase(object):
             num_steps(int): total number of batches.
             learning_rate(float): current learning rate.
             report_stats(Statistics): old Statistics instance.
+            prefix(str): prefix of the record type and of the tensorboard
+                scalars, e.g. 'mlm_' for the MLM decoder
         Returns:
             report_stats(Statistics): updated Statistics instance.
         """
@@ -73,10 +83,12 @@ class ReportMgrBase(object):
         if step % self.report_every == 0:
             if multigpu:
                 report_stats = \
-                    Statistics.all_gather_stats(report_stats)
+                    Statistics.all_reduce_stats(report_stats)
             self._report_training(
-                step, num_steps, learning_rate, report_stats)
-            self.progress_step += 1
+                step, num_steps, learning_rate, report_stats, prefix)
+            # one progress step per report, whatever the models reported
+            if not prefix:
+                self.progress_step += 1
             return Statistics()
         else:
             return report_stats
@@ -85,7 +97,8 @@ class ReportMgrBase(object):
         """ To be overridden """
         raise NotImplementedError()
 
-    def report_step(self, lr, step, train_stats=None, valid_stats=None):
+    def report_step(self, lr, step, train_stats=None, valid_stats=None,
+                    prefix=''):
         """
         Report stats of a step
 
@@ -93,27 +106,53 @@ class ReportMgrBase(object):
             train_stats(Statistics): training stats
             valid_stats(Statistics): validation stats
             lr(float): current learning rate
+            prefix(str): see `report_training`
         """
         self._report_step(
-            lr, step, train_stats=train_stats, valid_stats=valid_stats)
+            lr, step, train_stats=train_stats, valid_stats=valid_stats,
+            prefix=prefix)
 
     def _report_step(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def report_phases(self, step, phase_times):
+        """
+        Report the time of the phases of the training steps
+
+        Args:
+            step(int): current step count.
+            phase_times(OrderedDict): milliseconds per step of each phase
+        """
+        self._report_phases(step, phase_times)
+
+    def _report_phases(self, *args, **kwargs):
+        raise NotImplementedError()
+
 
 class ReportMgr(ReportMgrBase):
-    def __init__(self, report_every, start_time=-1., tensorboard_writer=None):
+    def __init__(self, report_every, start_time=-1., tensorboard_writer=None,
+                 metrics_file=None):
         """
         A report manager that writes statistics on standard output as well as
-        (optionally) TensorBoard
+        (optionally) TensorBoard and a JSON lines file
 
         Args:
             report_every(int): Report status every this many sentences
             tensorboard_writer(:obj:`tensorboard.SummaryWriter`):
                 The TensorBoard Summary writer to use or None
+            metrics_file(file): file receiving a JSON object per report,
+                or None
         """
         super(ReportMgr, self).__init__(report_every, start_time)
         self.tensorboard_writer = tensorboard_writer
+        self.metrics_file = metrics_file
+
+    def maybe_write_metrics(self, kind, step, metrics):
+        if self.metrics_file is not None:
+            record = {'type': kind, 'step': step, 'time': time.time()}
+            record.update(metrics)
+            self.metrics_file.write(json.dumps(record) + '\n')
+            self.metrics_file.flush()
 
     def maybe_log_tensorboard(self, stats, prefix, learning_rate, step):
         if self.tensorboard_writer is not None:
@@ -121,23 +160,30 @@ class ReportMgr(ReportMgrBase):
                 prefix, self.tensorboard_writer, learning_rate, step)
 
     def _report_training(self, step, num_steps, learning_rate,
-                         report_stats):
+                         report_stats, prefix=''):
         """
         See base class method `ReportMgrBase.report_training`.
         """
         report_stats.output(step, num_steps,
                             learning_rate, self.start_time)
+        metrics = {'lr': learning_rate, 'xent': report_stats.xent(),
+                   'ppl': report_stats.ppl(),
+                   'accuracy': report_stats.accuracy(),
+                   'tgt_loss_tok_per_sec': report_stats.n_words / (report_stats.elapsed_time() + 1e-5)}
+        metrics.update(report_stats.throughput())
+        self.maybe_write_metrics(prefix + 'train', step, metrics)
 
         # Log the progress using the number of batches on the x-axis.
         self.maybe_log_tensorboard(report_stats,
-                                   "progress",
+                                   prefix + "progress",
                                    learning_rate,
                                    self.progress_step)
         report_stats = Statistics()
 
         return report_stats
 
-    def _report_step(self, lr, step, train_stats=None, valid_stats=None):
+    def _report_step(self, lr, step, train_stats=None, valid_stats=None,
+                     prefix=''):
         """
         See base class method `ReportMgrBase.report_step`.
         """
@@ -146,7 +192,7 @@ class ReportMgr(ReportMgrBase):
             self.log('Train accuracy: %g' % train_stats.accuracy())
 
             self.maybe_log_tensorboard(train_stats,
-                                       "train",
+                                       prefix + "train",
                                        lr,
                                        step)
 
@@ -155,6 +201,23 @@ class ReportMgr(ReportMgrBase):
             self.log('Step: %2d; Validation accuracy: %g' % (step, valid_stats.accuracy()))
 
             self.maybe_log_tensorboard(valid_stats,
-                                       "valid",
+                                       prefix + "valid",
                                        lr,
                                        step)
+            self.maybe_write_metrics(prefix + 'valid', step, {
+                'xent': valid_stats.xent(), 'ppl': valid_stats.ppl(),
+                'accuracy': valid_stats.accuracy()})
+
+    def _report_phases(self, step, phase_times):
+        """
+        See base class method `ReportMgrBase.report_phases`.
+        """
+        total = phase_times['total']
+        self.log('Step %d; ms per step: %s' % (step, '; '.join(
+            '%s %.1f (%.0f%%)' % (name, t, 100. * t / total)
+            if name != 'total' else '%s %.1f' % (name, t)
+            for name, t in phase_times.items())))
+        if self.tensorboard_writer is not None:
+            for name, t in phase_times.items():
+                self.tensorboard_writer.add_scalar('phases/' + name, t, step)
+        self.maybe_write_metrics('phases', step, phase_times)
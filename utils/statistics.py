@@ -3,9 +3,11 @@ from __future__ import division
 import time
 import math
 import sys
+from collections import OrderedDict
 
-from torch.distributed import get_rank
-from utils.distributed import all_gather_list
+import torch
+import torch.distributed
+from utils.distributed import backend_device
 from utils.logging import logger
 
 
@@ -17,89 +19,148 @@ class Statistics(object):
   * accuracy
   * perplexity
   * elapsed time
+  * throughput: tokens per second of each field, padding of the
+    batches, documents and sentences per second
   """
+  # counters summed over the processes, `n_words` is the loss tokens,
+  # `n_<field>_words` the real tokens of the batches and
+  # `n_<field>_padded` all their positions (`tran` is the auto-translation)
+  FIELDS = ('loss', 'n_words', 'n_correct',
+            'n_src_words', 'n_src_padded', 'n_tgt_words', 'n_tgt_padded',
+            'n_tran_words', 'n_tran_padded', 'n_docs', 'n_sents')
+  # the sides of the batches counted
+  BATCH_FIELDS = ('src', 'tgt', 'tran')
 
   def __init__(self, loss=0, n_words=0.1, n_correct=0):
     self.loss = loss
     self.n_words = n_words
     self.n_correct = n_correct
-    self.n_src_words = 0
+    for name in Statistics.FIELDS[3:]:
+      setattr(self, name, 0)
+    # processes the counters were summed over
+    self.n_ranks = 1
     self.start_time = time.time()
+    # float64 device tensor of the `FIELDS` not yet read, or None
+    self.pending = None
 
   @staticmethod
-  def all_gather_stats(stat, max_size=4096):
+  def from_tensors(**counters):
     """
-    Gather a `Statistics` object accross multiple process/nodes
+    Statistics of 0-dim device tensors, by field name. They are summed on
+    the device by `update` and only read (one host sync) by `materialize`.
+    """
+    stat = Statistics(0, 0, 0)
+    tensors = {name: counter.detach().double() for name, counter in counters.items()}
+    zero = next(iter(tensors.values())).new_zeros(())
+    stat.pending = torch.stack([tensors.get(name, zero) for name in Statistics.FIELDS])
+    return stat
+
+  def materialize(self):
+    """ Adds the device counters to the python ones """
+    if self.pending is not None:
+      values = self.pending.tolist()
+      self.pending = None
+      for name, value in zip(Statistics.FIELDS, values):
+        setattr(self, name, getattr(self, name) + (value if name == 'loss' else int(value)))
+    return self
+
+  @staticmethod
+  def all_reduce_stats(stat):
+    """
+    Sums a `Statistics` object accross multiple process/nodes
 
     Args:
-        stat(:obj:Statistics): the statistics object to gather
+        stat(:obj:Statistics): the statistics object to sum
             accross all processes/nodes
-        max_size(int): max buffer size to use
 
     Returns:
         `Statistics`, the update stats object
     """
-    stats = Statistics.all_gather_stats_list([stat], max_size=max_size)
-    return stats[0]
+    return Statistics.all_reduce_stats_list([stat])[0]
 
   @staticmethod
-  def all_gather_stats_list(stat_list, max_size=4096):
+  def all_reduce_stats_list(stat_list):
     """
-    Gather a `Statistics` list accross all processes/nodes
+    Sums a `Statistics` list accross all processes/nodes, with a single
+    all-reduce of their `FIELDS` packed in one tensor
 
     Args:
         stat_list(list([`Statistics`])): list of statistics objects to
-            gather accross all processes/nodes
-        max_size(int): max buffer size to use
+            sum accross all processes/nodes
 
     Returns:
         our_stats(list([`Statistics`])): list of updated stats
     """
-    # Get a list of world_size lists with len(stat_list) Statistics objects
-    all_stats = all_gather_list(stat_list, max_size=max_size)
-
-    our_rank = get_rank()
-    our_stats = all_stats[our_rank]
-    for other_rank, stats in enumerate(all_stats):
-        if other_rank == our_rank:
-            continue
-        for i, stat in enumerate(stats):
-            our_stats[i].update(stat, update_n_src_words=True)
-    return our_stats
-
-  def update(self, stat, update_n_src_words=False):
+    device = backend_device()
+    rows = []
+    for stat in stat_list:
+      row = torch.tensor([float(getattr(stat, name)) for name in Statistics.FIELDS],
+                         dtype=torch.float64, device=device)
+      if stat.pending is not None:
+        row += stat.pending.to(device)
+        stat.pending = None
+      rows.append(row)
+    values = torch.stack(rows)
+    torch.distributed.all_reduce(values)
+    for stat, row in zip(stat_list, values.tolist()):
+      for name, value in zip(Statistics.FIELDS, row):
+        setattr(stat, name, value if name in ('loss', 'n_words') else int(value))
+      stat.n_ranks = torch.distributed.get_world_size()
+    return stat_list
+
+  def update(self, stat):
     """
     Update statistics by suming values with another `Statistics` object
 
     Args:
         stat: another statistic object
-        update_n_src_words(bool): whether to update (sum) `n_src_words`
-            or not
-
     """
-    self.loss += stat.loss
-    self.n_words += stat.n_words
-    self.n_correct += stat.n_correct
-
-    if update_n_src_words:
-      self.n_src_words += stat.n_src_words
+    for name in Statistics.FIELDS:
+      setattr(self, name, getattr(self, name) + getattr(stat, name))
+    if stat.pending is not None:
+      self.pending = stat.pending if self.pending is None else self.pending + stat.pending
 
   def accuracy(self):
     """ compute accuracy """
+    self.materialize()
     return 100 * (self.n_correct / self.n_words)
 
   def xent(self):
     """ compute cross entropy """
+    self.materialize()
     return self.loss / self.n_words
 
   def ppl(self):
     """ compute perplexity """
+    self.materialize()
     return math.exp(min(self.loss / self.n_words, 100))
 
   def elapsed_time(self):
     """ compute elapsed time """
     return time.time() - self.start_time
 
+  def throughput(self):
+    """
+    Tokens per second and padding fraction of each batch field counted,
+    over all processes and per process, documents and sentences per second
+    """
+    self.materialize()
+    t = self.elapsed_time() + 1e-5
+    metrics = OrderedDict()
+    for field in Statistics.BATCH_FIELDS:
+      words = getattr(self, 'n_%s_words' % field)
+      padded = getattr(self, 'n_%s_padded' % field)
+      if padded == 0:
+        continue
+      metrics['%s_tok_per_sec' % field] = words / t
+      metrics['%s_tok_per_sec_per_rank' % field] = words / t / self.n_ranks
+      metrics['%s_tokens' % field] = words
+      metrics['%s_padded_tokens' % field] = padded
+      metrics['%s_padding' % field] = 1. - words / padded
+    metrics['docs_per_sec'] = self.n_docs / t
+    metrics['sents_per_sec'] = self.n_sents / t
+    return metrics
+
   def output(self, step, num_steps, learning_rate, start):
     """Write out statistics to stdout.
 
@@ -108,6 +169,7 @@ class Statistics(object):
        n_batch (int): total batches
        start (int): start time of step.
     """
+    self.materialize()
     t = self.elapsed_time()
     logger.info(
         ("Step %2d/%5d; acc: %6.2f; ppl: %5.2f; xent: %4.2f; " +
@@ -120,13 +182,28 @@ class Statistics(object):
            self.n_src_words / (t + 1e-5),
            self.n_words / (t + 1e-5),
            time.time() - start))
+    metrics = self.throughput()
+    if self.n_docs:
+      logger.info("Step %2d; %s; %.1f doc/s; %.1f sent/s"
+                  % (step, "; ".join(
+                      "%s %.0f tok/s (%.0f/rank), %.1f%% pad"
+                      % (field, metrics['%s_tok_per_sec' % field],
+                         metrics['%s_tok_per_sec_per_rank' % field],
+                         100 * metrics['%s_padding' % field])
+                      for field in Statistics.BATCH_FIELDS
+                      if '%s_padding' % field in metrics),
+                     metrics['docs_per_sec'], metrics['sents_per_sec']))
     sys.stdout.flush()
 
   def log_tensorboard(self, prefix, writer, learning_rate, step):
     """ display statistics to tensorboard """
+    self.materialize()
     t = self.elapsed_time()
     writer.add_scalar(prefix + "/xent", self.xent(), step)
     writer.add_scalar(prefix + "/ppl", self.ppl(), step)
     writer.add_scalar(prefix + "/accuracy", self.accuracy(), step)
     writer.add_scalar(prefix + "/tgtper", self.n_words / t, step)
     writer.add_scalar(prefix + "/lr", learning_rate, step)
+    if self.n_docs:
+      for name, value in self.throughput().items():
+        writer.add_scalar(prefix + "/" + name, value, step)
@@ -0,0 +1,183 @@
+""" Offline top-k distributions of the frozen MLM teacher """
+import os
+import shutil
+import numpy as np
+import torch
+
+
+def example_ids(batch):
+    """ Examples of `batch` numbered across the dataset shards """
+    return batch.indices.cpu().numpy() + getattr(batch, "example_offset", 0)
+
+
+class TeacherCache(object):
+    """
+    The `topk` best teacher log-probabilities of every target token of the
+    training set, with their word ids. The rows of an example are its real
+    target tokens (after `<s>`), sentence by sentence, so they don't depend
+    on how the example is padded in a batch.
+
+    Files: `path.ids` (int32) and `path.logp` (float16), both
+    `[tokens x topk]` memory maps, and `path.index.npy`, the first row and
+    the number of rows of each example.
+
+    Args:
+        path (str): prefix of the cache files
+        topk (int): entries kept per target token
+    """
+
+    def __init__(self, path, topk):
+        self.path = path
+        self.topk = topk
+        self.ids = None
+        self.logp = None
+        self.index = None
+
+    def exists(self):
+        return os.path.exists(self.path + ".index.npy")
+
+    def part(self, rank):
+        """ The files written by rank `rank` in a distributed build """
+        return TeacherCache("%s.part%d" % (self.path, rank), self.topk)
+
+    def refreshed(self):
+        """ The files a refresh is written to, the cache keeps being read """
+        return TeacherCache(self.path + ".refresh", self.topk)
+
+    def open(self):
+        self.index = np.load(self.path + ".index.npy")
+        n_rows = int(self.index[:, 1].sum())
+        self.ids = np.memmap(self.path + ".ids", dtype=np.int32, mode="r",
+                             shape=(n_rows, self.topk))
+        self.logp = np.memmap(self.path + ".logp", dtype=np.float16, mode="r",
+                              shape=(n_rows, self.topk))
+
+    def writer(self, refresh=False, rank=None):
+        """
+        A `TeacherCacheWriter` of a new cache, or of the `.part<rank>` files
+        of `rank`. On refresh it overwrites the rows of the `refreshed` copy,
+        see `prepare_refresh`.
+        """
+        if refresh:
+            return TeacherCacheWriter(self.refreshed(), self.index)
+        if rank is not None:
+            return TeacherCacheWriter(self.part(rank))
+        return TeacherCacheWriter(self)
+
+    def prepare_refresh(self):
+        """ Copies the cache to the files of the refresh """
+        refreshed = self.refreshed()
+        for ext in (".ids", ".logp"):
+            shutil.copyfile(self.path + ext, refreshed.path + ext)
+
+    def commit(self, refresh=False, n_parts=0):
+        """
+        Replaces the cache files by the refreshed ones, or merges the
+        `n_parts` parts of a distributed build. The readers `open` the cache
+        again afterwards, the files they have open are left unchanged.
+        """
+        if refresh:
+            refreshed = self.refreshed()
+            for ext in (".ids", ".logp"):
+                os.replace(refreshed.path + ext, self.path + ext)
+            return
+        if n_parts == 0:
+            return
+        parts = [self.part(rank) for rank in range(n_parts)]
+        indexes = [np.load(part.path + ".index.npy") for part in parts]
+        index = np.zeros((max(len(i) for i in indexes), 2), dtype=np.int64)
+        n_rows = 0
+        for part, part_index in zip(parts, indexes):
+            written = part_index[:, 1] > 0
+            index[:len(part_index)][written] = part_index[written] + [n_rows, 0]
+            n_rows += int(part_index[:, 1].sum())
+        for ext in (".ids", ".logp"):
+            with open(self.path + ext, "wb") as out:
+                for part in parts:
+                    with open(part.path + ext, "rb") as f:
+                        shutil.copyfileobj(f, out)
+        _save_index(self.path, index)
+        for part in parts:
+            for ext in (".ids", ".logp", ".index.npy"):
+                os.remove(part.path + ext)
+
+    @staticmethod
+    def _rows(non_pad, n_examples):
+        """ `[tgt_len x batch]` non-padding mask in row order and rows per example """
+        rows = non_pad.t()
+        counts = rows.reshape(n_examples, -1).sum(1).cpu().numpy()
+        return rows, counts
+
+    def lookup(self, batch, non_pad):
+        """
+        Word ids and log-probabilities `[tgt_len x batch x topk]` of the
+        teacher for the target tokens of `batch` in `non_pad`, -inf on
+        padding.
+        """
+        examples = example_ids(batch)
+        rows, counts = self._rows(non_pad, len(examples))
+        starts = self.index[examples, 0]
+        assert (self.index[examples, 1] == counts).all(), \
+            "the teacher cache does not match the training data"
+        selected = np.concatenate([np.arange(s, s + n) for s, n in zip(starts, counts)])
+        ids = non_pad.new_zeros(rows.size() + (self.topk,), dtype=torch.long)
+        logp = non_pad.new_full(rows.size() + (self.topk,), float("-inf"), dtype=torch.float)
+        ids[rows] = torch.from_numpy(self.ids[selected].astype(np.int64)).to(ids.device)
+        logp[rows] = torch.from_numpy(self.logp[selected].astype(np.float32)).to(logp.device)
+        return ids.transpose(0, 1).contiguous(), logp.transpose(0, 1).contiguous()
+
+
+class TeacherCacheWriter(object):
+    """ Appends the rows of a new cache, or rewrites those of an existing one """
+
+    def __init__(self, cache, index=None):
+        self.cache = cache
+        self.index = index
+        mode = "r+b" if index is not None else "wb"
+        self.ids_file = open(cache.path + ".ids", mode)
+        self.logp_file = open(cache.path + ".logp", mode)
+        self.new_index = {}
+        self.n_rows = 0
+
+    def add(self, batch, non_pad, log_probs):
+        """
+        Keeps the top-k of the teacher `log_probs` `[tgt_len * batch x vocab]`
+        for the target tokens in `non_pad` `[tgt_len x batch]`.
+        """
+        examples = example_ids(batch)
+        rows, counts = TeacherCache._rows(non_pad, len(examples))
+        logp, ids = log_probs.float().topk(self.cache.topk, dim=-1)
+        logp = logp.view(non_pad.size() + (-1,)).transpose(0, 1)[rows]
+        ids = ids.view(non_pad.size() + (-1,)).transpose(0, 1)[rows]
+        logp = logp.clamp(min=np.finfo(np.float16).min).cpu().numpy().astype(np.float16)
+        ids = ids.cpu().numpy().astype(np.int32)
+        start = 0
+        for example, count in zip(examples, counts):
+            if self.index is not None:
+                assert self.index[example, 1] == count, \
+                    "the teacher cache does not match the training data"
+                offset = self.index[example, 0] * self.cache.topk
+                self.ids_file.seek(offset * 4)
+                self.logp_file.seek(offset * 2)
+            else:
+                self.new_index[example] = (self.n_rows, count)
+                self.n_rows += count
+            self.ids_file.write(ids[start:start + count].tobytes())
+            self.logp_file.write(logp[start:start + count].tobytes())
+            start += count
+
+    def close(self):
+        """ Writes the index of a new cache, which is not opened """
+        self.ids_file.close()
+        self.logp_file.close()
+        if self.index is None:
+            index = np.zeros((max(self.new_index, default=-1) + 1, 2), dtype=np.int64)
+            for example, rows in self.new_index.items():
+                index[example] = rows
+            _save_index(self.cache.path, index)
+
+
+def _save_index(path, index):
+    # written last: the cache exists once its index does
+    np.save(path + ".index.tmp.npy", index)
+    os.replace(path + ".index.tmp.npy", path + ".index.npy")